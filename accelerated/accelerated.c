@@ -29,6 +29,30 @@
 #define _WIRETYPE_MAX 5
 
 
+// Sets rdfvalue.DecodeError, the exception raised by the python decoder. Falls
+// back to ValueError, its base class, if grr.lib.rdfvalue can't be imported.
+static void set_decode_error(const char *message) {
+  static PyObject *decode_error = NULL;
+
+  if (!decode_error) {
+    PyObject *module = PyImport_ImportModule("grr.lib.rdfvalue");
+
+    if (module) {
+      decode_error = PyObject_GetAttrString(module, "DecodeError");
+      Py_DECREF(module);
+    }
+
+    if (!decode_error) {
+      PyErr_Clear();
+      PyErr_SetString(PyExc_ValueError, message);
+      return;
+    }
+  }
+
+  PyErr_SetString(decode_error, message);
+}
+
+
 // Encode the value into the buffer as a Varint.  length contains the size of
 // the buffer, we set it to the total length of the written Varint.  Returns 1
 // on success and 0 if an error occurs. The only possible error is that value
@@ -98,7 +122,7 @@ int varint_decode(unsigned PY_LONG_LONG *result,
     }
 
     shift += 7;
-  } while (shift < 64);
+  }
 
   // Error decoding varint - buffer too short.
   return 0;
@@ -114,199 +138,343 @@ PyObject *py_varint_decode(PyObject *self, PyObject *args) {
   if (!PyArg_ParseTuple(args, "s#n", &buffer, &length, &pos))
     return NULL;
 
-  if (varint_decode(&result, buffer+pos, length, &length)) {
+  if (pos < 0 || pos > length) {
+    PyErr_SetString(PyExc_ValueError, "Invalid parameters.");
+    return NULL;
+  }
+
+  if (varint_decode(&result, buffer+pos, length - pos, &length)) {
     return Py_BuildValue("Kn", result, pos + length);
   }
 
-  PyErr_SetString(PyExc_RuntimeError, "Too many bytes when decoding varint.");
+  set_decode_error("Invalid varint.");
   return NULL;
 }
 
 
-PyObject *py_split_buffer(PyObject *self, PyObject *args, PyObject *kwargs) {
-  char *buffer;
-  Py_ssize_t buffer_len = 0;
-  Py_ssize_t length = 0;
-  Py_ssize_t index = 0;
-  static const char *kwlist[] = {"buffer", "index", "length", NULL};
-  PyObject *encoded_tag = NULL;
+// Split the next field off the buffer. On success returns a new reference to
+// an (encoded_tag, encoded_length, wire_format) tuple and advances buffer and
+// length past the field. On error sets a python exception and returns NULL.
+//
+// This matches the python SplitBuffer: a field which is cut off by the end of
+// the buffer is returned truncated, only invalid tags and varints are errors.
+static PyObject *split_next(const char **buffer, Py_ssize_t *length) {
+  Py_ssize_t tag_length = 0;
+  Py_ssize_t data_offset = 0;
+  Py_ssize_t data_size = 0;
+  unsigned PY_LONG_LONG tag;
+  unsigned PY_LONG_LONG value;
+  PyObject *entry = NULL;
 
-  PyObject *result = PyList_New(0);
-  if (!result)
+  // Read the tag off the buffer.
+  if (!varint_decode(&tag, *buffer, *length, &tag_length)) {
+    set_decode_error("Invalid tag");
     return NULL;
+  }
 
-  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s#|nn", (char **)kwlist,
-                                   &buffer, &buffer_len, &index, &length))
-    return NULL;
+  // Handle the tag depending on its type.
+  switch (tag & TAG_TYPE_MASK) {
+    case WIRETYPE_VARINT: {
+      Py_ssize_t varint_length = 0;
 
-  if (index < 0 || length < 0 || index > buffer_len) {
+      if (!varint_decode(&value, *buffer + tag_length, *length - tag_length,
+                         &varint_length)) {
+        set_decode_error("Invalid varint.");
+        return NULL;
+      }
+      data_offset = tag_length;
+      data_size = varint_length;
+      break;
+    }
+
+    case WIRETYPE_FIXED64:
+      data_offset = tag_length;
+      data_size = 8;
+      break;
+
+    case WIRETYPE_FIXED32:
+      data_offset = tag_length;
+      data_size = 4;
+      break;
+
+    case WIRETYPE_LENGTH_DELIMITED: {
+      // Decode the length varint and position ourselves at the start of the
+      // data.
+      Py_ssize_t decoded_length = 0;
+
+      if (!varint_decode(&value, *buffer + tag_length, *length - tag_length,
+                         &decoded_length)) {
+        set_decode_error("Invalid varint.");
+        return NULL;
+      }
+      data_offset = tag_length + decoded_length;
+
+      if (value > (unsigned PY_LONG_LONG)(*length - data_offset)) {
+        data_size = *length - data_offset;
+      } else {
+        data_size = (Py_ssize_t)value;
+      }
+      break;
+    }
+
+    default:
+      set_decode_error("Unexpected Tag.");
+      return NULL;
+  }
+
+  // Truncate fixed size fields at the end of the buffer.
+  if (data_size > *length - data_offset) {
+    data_size = *length - data_offset;
+  }
+
+  // The encoded length is empty unless the field is length delimited.
+  entry = Py_BuildValue("(s#s#s#)",
+                        *buffer, tag_length,
+                        *buffer + tag_length, data_offset - tag_length,
+                        *buffer + data_offset, data_size);
+  if (entry) {
+    *buffer += data_offset + data_size;
+    *length -= data_offset + data_size;
+  }
+
+  return entry;
+}
+
+
+// Checks the index and length arguments and positions the buffer at the
+// start of the region to split. Returns 0 and sets an exception on error.
+static int prepare_buffer(const char **buffer, Py_ssize_t buffer_len,
+                          Py_ssize_t index, Py_ssize_t *length) {
+  if (index < 0 || *length < 0 || index > buffer_len) {
     PyErr_SetString(
         PyExc_ValueError, "Invalid parameters.");
-    return NULL;
+    return 0;
   }
 
   // Advance the buffer to the required start index.
-  buffer += index;
+  *buffer += index;
 
   // Determine the length we will be splitting.
-  if (length == 0 || length > buffer_len - index) {
-    length = buffer_len - index;
+  if (*length == 0 || *length > buffer_len - index) {
+    *length = buffer_len - index;
   }
 
+  return 1;
+}
+
+
+PyObject *py_split_buffer(PyObject *self, PyObject *args, PyObject *kwargs) {
+  const char *buffer;
+  Py_ssize_t buffer_len = 0;
+  Py_ssize_t length = 0;
+  Py_ssize_t index = 0;
+  static const char *kwlist[] = {"buffer", "index", "length", NULL};
+  PyObject *result = NULL;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s#|nn", (char **)kwlist,
+                                   &buffer, &buffer_len, &index, &length))
+    return NULL;
+
+  if (!prepare_buffer(&buffer, buffer_len, index, &length))
+    return NULL;
+
+  result = PyList_New(0);
+  if (!result)
+    return NULL;
+
   // We advance the buffer and decrement the length until there is no more
   // buffer space left.
   while (length > 0) {
-    Py_ssize_t decoded_length = 0;
-    unsigned PY_LONG_LONG tag;
-    int tag_type;
-
-    // Read the tag off the buffer.
-    varint_decode(&tag, buffer, length, &decoded_length);
-
-    // Prepare to pass the encoded tag into the result tuple.
-    encoded_tag = PyString_FromStringAndSize(buffer, decoded_length);
-    buffer += decoded_length;
-    length -= decoded_length;
-
-    // Handle the tag depending on its type.
-    tag_type = tag & TAG_TYPE_MASK;
-    switch (tag_type) {
-      case WIRETYPE_VARINT: {
-        // Decode the varint and position ourselves at the next tag.
-        Py_ssize_t tag_length = 0;
-        PyObject *entry = NULL;
-
-        varint_decode(&tag, buffer, length, &tag_length);
-
-        // Create an entry to add to the result set. Note: We use
-        // PyTuple_SetItem which steals the references here instead of
-        // PyTuple_Pack which does not (meaning its more involved to use).
-        entry = PyTuple_New(3);
-        PyTuple_SET_ITEM(
-            entry, 0, encoded_tag);
-
-        // Empty string "".
-        PyTuple_SET_ITEM(
-            entry, 1,
-            PyString_FromStringAndSize(buffer, 0));
-
-        PyTuple_SET_ITEM(
-            entry, 2,
-            PyString_FromStringAndSize(buffer, tag_length));
-
-        PyList_Append(result, entry);
-        Py_DECREF(entry);
-
-        buffer += tag_length;
-        length -= tag_length;
-
-        break;
-      }
+    PyObject *entry = split_next(&buffer, &length);
 
-      case WIRETYPE_FIXED64: {
-        // Fixed size data.
-        Py_ssize_t tag_length = 8;
-
-        PyObject *entry = PyTuple_New(3);
-        PyTuple_SET_ITEM(
-            entry, 0, encoded_tag);
-
-        // Empty string "".
-        PyTuple_SET_ITEM(
-            entry, 1,
-            PyString_FromStringAndSize(buffer, 0));
+    if (!entry || PyList_Append(result, entry) < 0) {
+      Py_XDECREF(entry);
+      Py_DECREF(result);
+      return NULL;
+    }
+    Py_DECREF(entry);
+  }
 
-        PyTuple_SET_ITEM(
-            entry, 2,
-            PyString_FromStringAndSize(buffer, tag_length));
+  return result;
+}
 
-        PyList_Append(result, entry);
-        Py_DECREF(entry);
 
-        buffer += tag_length;
-        length -= tag_length;
+// Decodes a whole serialized message into the raw data dict of an RDFStruct.
+//
+// Fields are looked up in the type_infos_by_encoded_tag dict of the struct
+// class and stored as (None, wire_format, type_info) so they are only
+// converted to python objects when accessed. Unknown fields are stored under
+// integer keys so they are written back unchanged. Repeated fields (type infos
+// of class repeated_class) need the python RepeatedFieldHelper, so they are
+// returned as a list of (type_info, wire_format) tuples to be appended by the
+// caller in order.
+PyObject *py_read_into_dict(PyObject *self, PyObject *args, PyObject *kwargs) {
+  const char *buffer;
+  Py_ssize_t buffer_len = 0;
+  Py_ssize_t length = 0;
+  Py_ssize_t index = 0;
+  long count = 0;
+  PyObject *type_infos = NULL;
+  PyObject *raw_data = NULL;
+  PyObject *repeated_class = NULL;
+  PyObject *repeated = NULL;
+  static const char *kwlist[] = {
+    "buffer", "index", "length", "type_infos", "raw_data", "repeated_class",
+    NULL};
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s#nnO!O!O", (char **)kwlist,
+                                   &buffer, &buffer_len, &index, &length,
+                                   &PyDict_Type, &type_infos,
+                                   &PyDict_Type, &raw_data,
+                                   &repeated_class))
+    return NULL;
 
-        break;
-      }
+  if (!prepare_buffer(&buffer, buffer_len, index, &length))
+    return NULL;
 
-      case WIRETYPE_FIXED32: {
-        // Fixed size data.
-        Py_ssize_t tag_length = 4;
+  repeated = PyList_New(0);
+  if (!repeated)
+    return NULL;
 
-        PyObject *entry = PyTuple_New(3);
-        PyTuple_SET_ITEM(
-            entry, 0, encoded_tag);
+  while (length > 0) {
+    PyObject *wire_format = split_next(&buffer, &length);
+    PyObject *type_info = NULL;
+    PyObject *key = NULL;
+    PyObject *value = NULL;
+    int res = -1;
+
+    if (!wire_format)
+      goto error;
+
+    // Borrowed reference, NULL if the tag is unknown.
+    type_info = PyDict_GetItem(type_infos, PyTuple_GET_ITEM(wire_format, 0));
+
+    if (!type_info) {
+      key = PyInt_FromLong(count++);
+      value = Py_BuildValue("(OOO)", Py_None, wire_format, Py_None);
+      if (key && value)
+        res = PyDict_SetItem(raw_data, key, value);
+
+    } else if ((PyObject *)Py_TYPE(type_info) == repeated_class) {
+      value = PyTuple_Pack(2, type_info, wire_format);
+      if (value)
+        res = PyList_Append(repeated, value);
+
+    } else {
+      key = PyObject_GetAttrString(type_info, "name");
+      value = Py_BuildValue("(OOO)", Py_None, wire_format, type_info);
+      if (key && value)
+        res = PyDict_SetItem(raw_data, key, value);
+    }
 
-        // Empty string "".
-        PyTuple_SET_ITEM(
-            entry, 1,
-            PyString_FromStringAndSize(buffer, 0));
+    Py_XDECREF(key);
+    Py_XDECREF(value);
+    Py_DECREF(wire_format);
 
-        PyTuple_SET_ITEM(
-            entry, 2,
-            PyString_FromStringAndSize(buffer, tag_length));
+    if (res < 0)
+      goto error;
+  }
 
-        PyList_Append(result, entry);
-        Py_DECREF(entry);
+  return repeated;
 
-        buffer += tag_length;
-        length -= tag_length;
+error:
+  Py_DECREF(repeated);
+  return NULL;
+}
 
-        break;
-      }
 
-      case WIRETYPE_LENGTH_DELIMITED: {
-        // Decode the length varint and position ourselves at the start of the
-        // data.
-        Py_ssize_t decoded_length = 0;
-        unsigned PY_LONG_LONG data_size;
-        PyObject *entry = NULL;
+// Serializes (python_format, wire_format, type_descriptor) triplets.
+//
+// Entries with a clean wire format are copied directly. Only entries which
+// were never serialized or whose python object was modified call back into
+// type_descriptor.ConvertToWireFormat().
+PyObject *py_serialize_entries(PyObject *self, PyObject *entries) {
+  PyObject *iterator = NULL;
+  PyObject *entry = NULL;
+  PyObject *empty = NULL;
+  PyObject *result = NULL;
+  PyObject *parts = PyList_New(0);
+
+  if (!parts)
+    return NULL;
 
-        varint_decode(&data_size, buffer, length, &decoded_length);
+  iterator = PyObject_GetIter(entries);
+  if (!iterator)
+    goto exit;
 
-        // Check that we do not exceed the available buffer here.
-        if (data_size + decoded_length > (unsigned int)length) {
-          PyErr_SetString(
-              PyExc_ValueError, "Length tag exceeds available buffer.");
+  while ((entry = PyIter_Next(iterator))) {
+    PyObject *python_format = NULL;
+    PyObject *wire_format = NULL;
+    PyObject *type_descriptor = NULL;
+    PyObject *items = NULL;
+    Py_ssize_t i;
 
-          goto error;
-        }
+    if (!PyTuple_Check(entry) || PyTuple_GET_SIZE(entry) != 3) {
+      PyErr_SetString(PyExc_ValueError, "Entries must be triplets.");
+      goto exit;
+    }
 
-        entry = PyTuple_New(3);
-        PyTuple_SET_ITEM(
-            entry, 0, encoded_tag);
+    python_format = PyTuple_GET_ITEM(entry, 0);
+    type_descriptor = PyTuple_GET_ITEM(entry, 2);
+    wire_format = PyTuple_GET_ITEM(entry, 1);
+    Py_INCREF(wire_format);
 
-        // Empty string "".
-        PyTuple_SET_ITEM(
-            entry, 1,
-            PyString_FromStringAndSize(buffer, decoded_length));
+    if (wire_format == Py_None) {
+      Py_DECREF(wire_format);
+      wire_format = PyObject_CallMethod(
+          type_descriptor, "ConvertToWireFormat", "O", python_format);
 
-        PyTuple_SET_ITEM(
-            entry, 2,
-            PyString_FromStringAndSize(buffer + decoded_length, data_size));
+    } else {
+      int truth = PyObject_IsTrue(python_format);
 
-        PyList_Append(result, entry);
-        Py_DECREF(entry);
+      if (truth > 0) {
+        PyObject *dirty = PyObject_CallMethod(
+            type_descriptor, "IsDirty", "O", python_format);
 
-        buffer += decoded_length + data_size;
-        length -= decoded_length + data_size;
+        truth = dirty ? PyObject_IsTrue(dirty) : -1;
+        Py_XDECREF(dirty);
+      }
 
-        break;
+      if (truth > 0) {
+        Py_DECREF(wire_format);
+        wire_format = PyObject_CallMethod(
+            type_descriptor, "ConvertToWireFormat", "O", python_format);
+      } else if (truth < 0) {
+        Py_CLEAR(wire_format);
       }
+    }
+
+    if (wire_format)
+      items = PySequence_Fast(wire_format, "Wire format must be a sequence.");
 
-      default:
-        PyErr_SetString(
-            PyExc_ValueError, "Unexpected Tag");
+    Py_XDECREF(wire_format);
+    if (!items)
+      goto exit;
 
-        goto error;
+    for (i = 0; i < PySequence_Fast_GET_SIZE(items); i++) {
+      if (PyList_Append(parts, PySequence_Fast_GET_ITEM(items, i)) < 0) {
+        Py_DECREF(items);
+        goto exit;
+      }
     }
+
+    Py_DECREF(items);
+    Py_CLEAR(entry);
   }
 
-  return result;
+  if (PyErr_Occurred())
+    goto exit;
 
-error:
-  Py_DECREF(encoded_tag);
-  return NULL;
+  empty = PyString_FromStringAndSize(NULL, 0);
+  if (empty)
+    result = _PyString_Join(empty, parts);
+
+exit:
+  Py_XDECREF(entry);
+  Py_XDECREF(empty);
+  Py_XDECREF(iterator);
+  Py_DECREF(parts);
+  return result;
 }
 
 /* Retrieves the semantic protobuf version
@@ -314,7 +482,7 @@ error:
  */
 PyObject *py_semantic_get_version(PyObject *self, PyObject *arguments) {
     const char *errors = NULL;
-    return(PyUnicode_DecodeUTF8("20150518", (Py_ssize_t) 8, errors));
+    return(PyUnicode_DecodeUTF8("20171020", (Py_ssize_t) 8, errors));
 }
 
 static PyMethodDef _semantic_methods[] = {
@@ -340,6 +508,16 @@ static PyMethodDef _semantic_methods[] = {
      METH_VARARGS | METH_KEYWORDS,
      "Split a buffer into tags and wire format data."},
 
+    {"read_into_dict",
+     (PyCFunction)py_read_into_dict,
+     METH_VARARGS | METH_KEYWORDS,
+     "Decode a serialized message into the raw data dict of a struct."},
+
+    {"serialize_entries",
+     (PyCFunction)py_serialize_entries,
+     METH_O,
+     "Serialize the raw data entries of a struct."},
+
     {NULL}  /* Sentinel */
 };
 
@@ -35,6 +35,10 @@ class NetworkBytesExceededError(Error):
   """Exceeded the maximum number of bytes allowed to be sent for this action."""
 
 
+class UploadCancelledError(Error):
+  """A background upload was cancelled."""
+
+
 class ActionPlugin(object):
   """Baseclass for plugins.
 
@@ -1,18 +1,22 @@
 #!/usr/bin/env python
 """The file finder client action."""
 
+import collections
 import errno
 import fnmatch
 import functools
 import itertools
 import logging
+from multiprocessing import pool as mp_pool
 import os
 import platform
 import re
 import stat
+import threading
 
 import psutil
 
+from grr import config
 from grr.client import actions
 from grr.client.client_actions import standard as standard_actions
 from grr.client.vfs_handlers import files
@@ -23,6 +27,100 @@ from grr.lib.rdfvalues import crypto as rdf_crypto
 from grr.lib.rdfvalues import file_finder as rdf_file_finder
 from grr.lib.rdfvalues import paths as rdf_paths
 
+try:
+  # The scandir backport returns the file type along with the directory
+  # entries so most entries don't need to be stat'ed during recursive searches.
+  from scandir import scandir  # pylint: disable=g-import-not-at-top
+except ImportError:
+  scandir = None
+
+
+class DirectoryCache(object):
+  """Caches directory listings and stat results for the duration of an action.
+
+  Globs sharing a prefix and components matching in the same directory (e.g.
+  /home/*/.bashrc and /home/**) list and stat every directory only once.
+  """
+
+  # The cache is dropped when it holds more entries than this so that searches
+  # of huge file systems don't use unbounded memory.
+  MAX_ENTRIES = 100000
+
+  def __init__(self):
+    self._listings = {}
+    self._entries = {}
+    self._stats = {}
+    self._lstats = {}
+    self._size = 0
+
+  def Flush(self):
+    for cache in [self._listings, self._entries, self._stats, self._lstats]:
+      cache.clear()
+    self._size = 0
+
+  def _Reserve(self, count):
+    if self._size + count > self.MAX_ENTRIES:
+      self.Flush()
+    self._size += count
+
+  def _Cached(self, cache, function, path):
+    try:
+      result = cache[path]
+    except KeyError:
+      try:
+        result = function(path)
+      except OSError as e:
+        result = e
+      self._Reserve(1)
+      cache[path] = result
+
+    if isinstance(result, OSError):
+      raise result
+    return result
+
+  def ListDir(self, path):
+    """Returns the names in a directory, an empty list if it can't be listed."""
+    names = self._listings.get(path)
+    if names is not None:
+      return names
+
+    entries = []
+    try:
+      if scandir is None:
+        names = os.listdir(path)
+      else:
+        entries = list(scandir(path))
+        names = [entry.name for entry in entries]
+    except OSError as e:
+      if e.errno == errno.EACCES:  # permission denied.
+        logging.info(e)
+      names = []
+
+    self._Reserve(len(names) + 1)
+    self._listings[path] = names
+    for entry in entries:
+      self._entries[os.path.join(path, entry.name)] = entry
+    return names
+
+  def Stat(self, path):
+    return self._Cached(self._stats, os.stat, path)
+
+  def LStat(self, path):
+    return self._Cached(self._lstats, os.lstat, path)
+
+  def IsDirectory(self, path):
+    """Returns True if path is a directory or a link to one."""
+    entry = self._entries.get(path)
+    if entry is not None:
+      return entry.is_dir()
+    return stat.S_ISDIR(self.Stat(path).st_mode)
+
+  def IsLink(self, path):
+    entry = self._entries.get(path)
+    if entry is not None:
+      return entry.is_symlink()
+    return stat.S_ISLNK(self.LStat(path).st_mode)
+
 
 class Component(object):
   """A component of a path."""
@@ -30,6 +128,12 @@ class Component(object):
   def __hash__(self):
     return hash(self.__str__())
 
+  def __eq__(self, other):
+    return isinstance(other, Component) and str(self) == str(other)
+
+  def __ne__(self, other):
+    return not self == other
+
   def Generate(self, base_path):
     raise NotImplementedError()
 
@@ -37,10 +141,15 @@ class Component(object):
 class RecursiveComponent(Component):
   """A recursive component."""
 
-  def __init__(self, depth, follow_links=False, mountpoints_blacklist=None):
+  def __init__(self,
+               depth,
+               follow_links=False,
+               mountpoints_blacklist=None,
+               cache=None):
     self.depth = depth
     self.follow_links = follow_links
     self.mountpoints_blacklist = mountpoints_blacklist
+    self.cache = cache or DirectoryCache()
 
   def Generate(self, base_path):
     for f in self._Generate(base_path, []):
@@ -52,26 +161,18 @@ class RecursiveComponent(Component):
     new_base = os.path.join(base_path, *relative_components)
     if not relative_components:
       yield new_base
-    try:
-      filenames = os.listdir(new_base)
-    except OSError as e:
-      if e.errno == errno.EACCES:  # permission denied.
-        logging.info(e)
-      return
 
-    for f in filenames:
+    for f in self.cache.ListDir(new_base):
       new_components = relative_components + [f]
       relative_name = os.path.join(*new_components)
       yield relative_name
       if len(new_components) < self.depth:
         try:
           filename = os.path.join(base_path, relative_name)
-          stat_entry = os.stat(filename)
-          if stat.S_ISDIR(stat_entry.st_mode):
+          if self.cache.IsDirectory(filename):
             if filename in self.mountpoints_blacklist:
               continue
-            if (self.follow_links or
-                not stat.S_ISLNK(os.lstat(filename).st_mode)):
+            if self.follow_links or not self.cache.IsLink(filename):
               for res in self._Generate(base_path, new_components):
                 yield res
         except OSError as e:
@@ -85,20 +186,17 @@ class RecursiveComponent(Component):
 class RegexComponent(Component):
   """A component matching the file name against a regex."""
 
-  def __init__(self, regex):
+  def __init__(self, regex, cache=None):
     self.regex = re.compile(regex)
+    self.cache = cache or DirectoryCache()
 
   def Generate(self, base_path):
-    try:
-      for f in os.listdir(base_path):
-        if self.regex.match(f):
-          yield f
-    except OSError as e:
-      if e.errno == errno.EACCES:  # permission denied.
-        logging.error(e)
+    for f in self.cache.ListDir(base_path):
+      if self.regex.match(f):
+        yield f
 
   def __str__(self):
-    return "%s:%s" % (self.__class__, self.regex)
+    return "%s:%s" % (self.__class__, self.regex.pattern)
 
 
 class LiteralComponent(Component):
@@ -114,6 +212,154 @@ class LiteralComponent(Component):
     return "%s:%s" % (self.__class__, self.literal)
 
 
+class ContentMatcher(object):
+  """Collects the hits of a single content condition in a file."""
+
+  def __init__(self, params):
+    self.params = params
+    self.start_offset = params.start_offset
+    self.end_offset = params.start_offset + params.length
+    self.findings = []
+    self.done = False
+
+  def Search(self, data, pos, end):
+    """Returns offset and length of the first hit in data[pos:end]."""
+    raise NotImplementedError()
+
+  def Scan(self, data, data_offset, length, rescanned):
+    """Collects the hits in data[:length].
+
+    Args:
+      data: The buffer to scan.
+      data_offset: The file offset of data[0].
+      length: The number of valid bytes in data.
+      rescanned: The number of bytes at the start of data which were already
+        scanned as part of the previous block. Hits which end within them have
+        already been collected.
+    """
+    start = max(self.start_offset - data_offset, 0)
+    end = min(self.end_offset - data_offset, length)
+
+    pos = start
+    while pos < end:
+      hit, hit_length = self.Search(data, pos, end)
+      if hit is None:
+        return
+
+      if hit + hit_length > rescanned:
+        # This might cut off some data if the hit is at the block border.
+        context_start = max(hit - self.params.bytes_before, start)
+        context_end = min(hit + hit_length + self.params.bytes_after, end)
+        self.findings.append(
+            rdf_client.BufferReference(
+                offset=data_offset + context_start,
+                length=context_end - context_start,
+                data=str(data[context_start:context_end])))
+        if self.params.mode == self.params.Mode.FIRST_HIT:
+          self.done = True
+          return
+
+      pos = hit + 1
+
+
+class LiteralMatcher(ContentMatcher):
+  """Finds the hits of a literal."""
+
+  def __init__(self, params):
+    super(LiteralMatcher, self).__init__(params)
+    self.literal = utils.SmartStr(params.literal)
+
+  def Search(self, data, pos, end):
+    hit = data.find(self.literal, pos, end)
+    if hit == -1:
+      return None, 0
+    return hit, len(self.literal)
+
+
+class RegexMatcher(ContentMatcher):
+  """Finds the hits of a regular expression."""
+
+  def Search(self, data, pos, end):
+    # A buffer is a view of the data, searching it does not copy the block.
+    match = self.params.regex.Search(buffer(data, pos, end - pos))
+    if not match:
+      return None, 0
+    start, end = match.span()
+    return start + pos, end - start
+
+
+class ContentScanner(object):
+  """Reads a file once and passes it to all content matchers.
+
+  The file is read block by block into a buffer which is reused for all
+  files. The last OVERLAP_SIZE bytes of each block are moved to the start of
+  the buffer and scanned again with the next block so that hits across block
+  borders are found.
+  """
+
+  OVERLAP_SIZE = 1024 * 1024
+  CHUNK_SIZE = 10 * 1024 * 1024
+
+  def __init__(self):
+    self.data = bytearray(self.OVERLAP_SIZE + self.CHUNK_SIZE)
+
+  def _ReadInto(self, fd, view):
+    """Fills the view with file data, returns the number of bytes read."""
+    total = 0
+    while total < len(view):
+      read = fd.readinto(view[total:])
+      if not read:
+        break
+      total += read
+    return total
+
+  def Scan(self, path, matchers):
+    """Scans the file at path for the hits of all matchers.
+
+    Args:
+      path: The file to scan.
+      matchers: A list of ContentMatchers.
+
+    Returns:
+      True if the file could be read.
+    """
+    try:
+      fd = open(path, mode="rb")
+    except IOError:
+      return False
+
+    with fd:
+      data_offset = min(m.start_offset for m in matchers)
+      end_offset = max(m.end_offset for m in matchers)
+      view = memoryview(self.data)
+      rescanned = 0
+
+      fd.seek(data_offset)
+      while True:
+        to_read = min(self.CHUNK_SIZE, end_offset - data_offset - rescanned)
+        read = self._ReadInto(fd, view[rescanned:rescanned + to_read])
+        if not read:
+          break
+
+        length = rescanned + read
+        pending = [m for m in matchers if not m.done]
+        for matcher in pending:
+          matcher.Scan(self.data, data_offset, length, rescanned)
+
+        if read < to_read or all(m.done for m in pending):
+          break
+
+        overlap = min(self.OVERLAP_SIZE, length)
+        if length - overlap >= overlap:
+          view[:overlap] = view[length - overlap:length]
+        else:
+          self.data[:overlap] = str(self.data[length - overlap:length])
+        data_offset += length - overlap
+        rescanned = overlap
+
+    return True
+
+
 class FileFinderOS(actions.ActionPlugin):
   """The file finder implementation using the OS file api."""
 
@@ -131,6 +377,9 @@ class FileFinderOS(actions.ActionPlugin):
   # A regex indicating if there are shell globs in this path.
   GLOB_MAGIC_CHECK = re.compile("[*?[]")
 
+  # The number of files which are uploaded or queued for upload at a time.
+  MAX_PENDING_UPLOADS = 10
+
   def Run(self, args):
     self.follow_links = args.follow_links
     self.process_non_regular_files = args.process_non_regular_files
@@ -149,30 +398,44 @@ class FileFinderOS(actions.ActionPlugin):
       # Never stop at any device boundary.
       self.mountpoints_blacklist = set()
 
-    for fname in self.CollectGlobs(args.paths):
-      self.Progress()
-      self.conditions = self.ParseConditions(args)
-
+    self.directory_cache = DirectoryCache()
+    self.conditions = self.ParseConditions(args)
+    # Uploads of the DOWNLOAD action run in the background, their results are
+    # sent in the order the files were found.
+    self.pending_uploads = collections.deque()
+    try:
+      self._Search(args)
+      while self.pending_uploads:
+        self._SendUploadResult()
+    finally:
+      self._CancelUploads()
+
+  def _SendUploadResult(self):
+    """Waits for the oldest pending upload and sends its result."""
+    result, stat_entry, pending_upload = self.pending_uploads.popleft()
+    uploaded_file = pending_upload.Result(progress_callback=self.Progress)
+
+    uploaded_file.stat_entry = stat_entry
+    result.uploaded_file = uploaded_file
+    self.SendReply(result)
+
+  def _CancelUploads(self):
+    """Stops the pending uploads once the action failed."""
+    for _, _, pending_upload in self.pending_uploads:
+      pending_upload.Cancel()
+
+    # Wait for the uploads to stop so they can't charge bytes to the session
+    # after its status was sent.
+    for _, _, pending_upload in self.pending_uploads:
       try:
-        stat_object = os.lstat(fname)
-      except OSError:
-        continue
-
-      if (not self.process_non_regular_files and
-          not stat.S_ISREG(stat_object.st_mode)):
-        continue
-
-      result = rdf_file_finder.FileFinderResult()
-
-      conditions_apply = True
-      for c in self.conditions:
-        if not c(fname, stat_object, result):
-          conditions_apply = False
-          break
-
-      if not conditions_apply:
-        continue
-
+        pending_upload.Result()
+      except Exception:  # pylint: disable=broad-except
+        pass
+
+  def _Search(self, args):
+    """Sends the results for all matching files."""
+    candidates = self._MatchMetadata(self.CollectGlobs(args.paths))
+    for fname, stat_object, result in self._MatchContents(args, candidates):
       if args.action.action_type == args.action.Action.STAT:
 
         result.stat_entry = self.Stat(fname, stat_object,
@@ -203,16 +466,20 @@ class FileFinderOS(actions.ActionPlugin):
           else:
             raise ValueError("Unknown oversized file policy %s." % int(policy))
 
-        uploaded_file = self.grr_worker.UploadFile(
+        pending_upload = self.grr_worker.StartFileUpload(
             open(fname, "rb"),
             args.upload_token,
             max_bytes=max_bytes,
             network_bytes_limit=self.network_bytes_limit,
             session_id=self.session_id,
             progress_callback=self.Progress)
+        self.pending_uploads.append((result, stat_entry, pending_upload))
 
-        uploaded_file.stat_entry = stat_entry
-        result.uploaded_file = uploaded_file
+        # Keep the next files queued so that the upload threads don't idle
+        # while we wait for the oldest upload, but bound the open files.
+        while len(self.pending_uploads) > self.MAX_PENDING_UPLOADS:
+          self._SendUploadResult()
+        continue
 
       elif args.action.action_type == args.action.Action.HASH:
         result.stat_entry = stat_entry
@@ -262,6 +529,18 @@ class FileFinderOS(actions.ActionPlugin):
     return result
 
   def CollectGlobs(self, globs):
+    """Yields the paths matching any of the globs.
+
+    The globs are compiled into a single tree of path components so globs
+    sharing a prefix are expanded together. A None key in a subtree marks the
+    end of a glob.
+
+    Args:
+      globs: The glob expressions.
+
+    Yields:
+      The matching paths.
+    """
     expanded_globs = {}
     for glob in globs:
       initial_component, path = self._SplitInitialPathComponent(
@@ -275,6 +554,7 @@ class FileFinderOS(actions.ActionPlugin):
         node = component_tree.setdefault(initial_component, {})
         for component in self._ConvertGlobIntoPathComponents(glob):
           node = node.setdefault(component, {})
+        node[None] = {}
 
     for initial_component in component_tree:
       for f in self._TraverseComponentTree(component_tree[initial_component],
@@ -311,13 +591,16 @@ class FileFinderOS(actions.ActionPlugin):
   def _TraverseComponentTree(self, component_tree, base_path):
 
     for component, subtree in component_tree.iteritems():
+      if component is None:
+        continue
+
       for f in component.Generate(base_path):
-        if subtree:
-          for res in self._TraverseComponentTree(subtree,
-                                                 os.path.join(base_path, f)):
+        path = os.path.join(base_path, f)
+        if None in subtree:
+          yield path
+        if any(c is not None for c in subtree):
+          for res in self._TraverseComponentTree(subtree, path):
             yield res
-        else:
-          yield os.path.join(base_path, f)
 
   def _InterpolateGrouping(self, pattern):
     """Takes the pattern and splits it into components.
@@ -410,10 +693,12 @@ class FileFinderOS(actions.ActionPlugin):
         component = RecursiveComponent(
             depth=depth,
             follow_links=self.follow_links,
-            mountpoints_blacklist=self.mountpoints_blacklist)
+            mountpoints_blacklist=self.mountpoints_blacklist,
+            cache=self.directory_cache)
 
       elif self.GLOB_MAGIC_CHECK.search(path_component):
-        component = RegexComponent(fnmatch.translate(path_component))
+        component = RegexComponent(
+            fnmatch.translate(path_component), cache=self.directory_cache)
 
       else:
         component = LiteralComponent(path_component)
@@ -444,129 +729,116 @@ class FileFinderOS(actions.ActionPlugin):
     params = condition_obj.size
     return params.min_file_size <= stat_obj.st_size <= params.max_file_size
 
-  OVERLAP_SIZE = 1024 * 1024
-  CHUNK_SIZE = 10 * 1024 * 1024
-
-  def _StreamFile(self, fd, offset, length):
-    """Generates overlapping blocks of data read from a file."""
-    to_read = length
-    fd.seek(offset)
-
-    overlap = fd.read(min(self.OVERLAP_SIZE, to_read))
-    to_read -= len(overlap)
-
-    yield overlap
-
-    while to_read > 0:
-      data = fd.read(min(self.CHUNK_SIZE, to_read))
-      if not data:
-        return
-      to_read -= len(data)
+  def ParseConditions(self, args):
+    """Returns the conditions on file metadata as callables."""
+    type_enum = rdf_file_finder.FileFinderCondition.Type
+    condition_handlers = {
+        type_enum.MODIFICATION_TIME: self.ModificationTimeCondition,
+        type_enum.ACCESS_TIME: self.AccessTimeCondition,
+        type_enum.INODE_CHANGE_TIME: self.InodeChangeTimeCondition,
+        type_enum.SIZE: self.SizeCondition,
+    }
 
-      combined_data = overlap + data
-      yield combined_data
-      overlap = combined_data[-self.OVERLAP_SIZE:]
+    conditions = []
+    for cond in args.conditions:
+      if cond.condition_type in condition_handlers:
+        conditions.append(
+            functools.partial(condition_handlers[cond.condition_type], cond))
+    return conditions
 
-  def _MatchRegex(self, regex, chunk, pos):
-    match = regex.Search(chunk[pos:])
-    if not match:
-      return None, 0
-    else:
-      start, end = match.span()
-      return start + pos, end - start
+  def CreateContentMatchers(self, args):
+    """Returns fresh matchers for the content conditions of args."""
+    type_enum = rdf_file_finder.FileFinderCondition.Type
+    matchers = []
+    for cond in args.conditions:
+      if cond.condition_type == type_enum.CONTENTS_REGEX_MATCH:
+        matchers.append(RegexMatcher(cond.contents_regex_match))
+      elif cond.condition_type == type_enum.CONTENTS_LITERAL_MATCH:
+        matchers.append(LiteralMatcher(cond.contents_literal_match))
+    return matchers
 
-  def ContentsRegexMatchCondition(self, condition_obj, path, stat_obj, result):
-    params = condition_obj.contents_regex_match
-    regex = params.regex
+  def _ScanFile(self, args, fname):
+    """Scans the contents of a file for all content conditions.
 
-    return self._ScanForMatches(params, path,
-                                functools.partial(self._MatchRegex, regex),
-                                result)
+    Args:
+      args: The FileFinderArgs.
+      fname: The file to scan.
 
-  def _MatchLiteral(self, literal, chunk, pos):
-    pos = chunk.find(literal, pos)
-    if pos == -1:
-      return None, 0
-    else:
-      return pos, len(literal)
+    Returns:
+      A FileFinderResult with the hits if all content conditions match,
+      otherwise None.
+    """
+    scanner = getattr(self._scanners, "scanner", None)
+    if scanner is None:
+      scanner = self._scanners.scanner = ContentScanner()
 
-  def ContentsLiteralMatchCondition(self, condition_obj, path, stat_obj,
-                                    result):
-    params = condition_obj.contents_literal_match
+    matchers = self.CreateContentMatchers(args)
+    if not scanner.Scan(fname, matchers):
+      return None
 
-    literal = utils.SmartStr(params.literal)
+    if not all(matcher.findings for matcher in matchers):
+      return None
 
-    return self._ScanForMatches(params, path,
-                                functools.partial(self._MatchLiteral, literal),
-                                result)
+    result = rdf_file_finder.FileFinderResult()
+    for matcher in matchers:
+      for finding in matcher.findings:
+        result.matches.append(finding)
+    return result
 
-  def _ScanForMatches(self, params, path, matching_func, result):
-    try:
-      fd = open(path, mode="rb")
-    except IOError:
-      return False
+  def _MatchMetadata(self, globs):
+    """Yields the files whose metadata match all metadata conditions."""
+    for fname in globs:
+      self.Progress()
 
-    current_offset = params.start_offset
-    findings = []
-    for chunk in self._StreamFile(fd, current_offset, params.length):
-      pos, match_length = matching_func(chunk, 0)
-      while pos is not None:
-        if (len(chunk) > self.OVERLAP_SIZE and
-            pos + match_length < self.OVERLAP_SIZE):
-          # We already processed this hit.
-          pos, match_length = matching_func(chunk, pos + 1)
-          continue
+      try:
+        stat_object = self.directory_cache.LStat(fname)
+      except OSError:
+        continue
 
-        context_start = max(pos - params.bytes_before, 0)
-        # This might cut off some data if the hit is at the chunk border.
-        context_end = min(pos + match_length + params.bytes_after, len(chunk))
-        data = chunk[context_start:context_end]
-        findings.append(
-            rdf_client.BufferReference(
-                offset=current_offset + context_start,
-                length=len(data),
-                data=data,))
-        if params.mode == params.Mode.FIRST_HIT:
-          for finding in findings:
-            result.matches.append(finding)
-          return True
+      if (not self.process_non_regular_files and
+          not stat.S_ISREG(stat_object.st_mode)):
+        continue
 
-        pos, match_length = matching_func(chunk, pos + 1)
+      if all(c(fname, stat_object, None) for c in self.conditions):
+        yield fname, stat_object
 
-      current_offset += len(chunk) - self.OVERLAP_SIZE
+  def _MatchContents(self, args, candidates):
+    """Yields (fname, stat_object, result) for files matching all conditions.
 
-    if findings:
-      for finding in findings:
-        result.matches.append(finding)
-      return True
-    else:
-      return False
+    Files are scanned for the content conditions on up to
+    Client.file_finder_scan_threads threads, results are yielded in the order
+    of candidates.
 
-  def ParseConditions(self, args):
-    type_enum = rdf_file_finder.FileFinderCondition.Type
-    condition_weights = {
-        type_enum.MODIFICATION_TIME: 0,
-        type_enum.ACCESS_TIME: 0,
-        type_enum.INODE_CHANGE_TIME: 0,
-        type_enum.SIZE: 0,
-        type_enum.CONTENTS_REGEX_MATCH: 1,
-        type_enum.CONTENTS_LITERAL_MATCH: 1,
-    }
-    condition_handlers = {
-        type_enum.MODIFICATION_TIME: self.ModificationTimeCondition,
-        type_enum.ACCESS_TIME: self.AccessTimeCondition,
-        type_enum.INODE_CHANGE_TIME: self.InodeChangeTimeCondition,
-        type_enum.SIZE: self.SizeCondition,
-        type_enum.CONTENTS_REGEX_MATCH: self.ContentsRegexMatchCondition,
-        type_enum.CONTENTS_LITERAL_MATCH: self.ContentsLiteralMatchCondition
-    }
+    Args:
+      args: The FileFinderArgs.
+      candidates: (fname, stat_object) tuples of files matching the metadata
+        conditions.
+    """
+    if not self.CreateContentMatchers(args):
+      for fname, stat_object in candidates:
+        yield fname, stat_object, rdf_file_finder.FileFinderResult()
+      return
 
-    sorted_conditions = sorted(
-        args.conditions,
-        key=lambda cond: condition_weights[cond.condition_type])
+    self._scanners = threading.local()
+    threads = config.CONFIG["Client.file_finder_scan_threads"]
+    if threads <= 1:
+      for fname, stat_object in candidates:
+        result = self._ScanFile(args, fname)
+        if result is not None:
+          yield fname, stat_object, result
+      return
 
-    conditions = []
-    for cond in sorted_conditions:
-      conditions.append(
-          functools.partial(condition_handlers[cond.condition_type], cond))
-    return conditions
+    scan_pool = mp_pool.ThreadPool(threads)
+    try:
+      # Batches are handed to the pool from this thread so that progress is
+      # still reported (and resource limits enforced) by the action thread.
+      for batch in utils.Grouper(candidates, threads * 2):
+        results = scan_pool.map(
+            functools.partial(self._ScanFile, args),
+            [fname for fname, _ in batch])
+        for (fname, stat_object), result in itertools.izip(batch, results):
+          self.Progress()
+          if result is not None:
+            yield fname, stat_object, result
+    finally:
+      scan_pool.terminate()
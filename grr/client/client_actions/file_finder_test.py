@@ -190,6 +190,41 @@ class FileFinderTest(client_test_lib.EmptyActionTest):
       except OSError:
         pass
 
+  def testGlobsSharingAPrefixListEachDirectoryOnce(self):
+    test_dir = os.path.join(self.temp_dir, "prefix_test")
+    for subdir in ["sub1", "sub2"]:
+      os.makedirs(os.path.join(test_dir, subdir))
+      for name in ["x.txt", "y.log"]:
+        with open(os.path.join(test_dir, subdir, name), "wb") as fd:
+          fd.write("data")
+
+    listed = []
+
+    def MyListDir(path):
+      listed.append(path)
+      return MyListDir.old_target(path)
+
+    MyListDir.old_target = os.listdir
+
+    paths = [test_dir + "/*", test_dir + "/*/*.txt", test_dir + "/**2"]
+    with utils.MultiStubber((os, "listdir", MyListDir),
+                            (client_file_finder, "scandir", None)):
+      results = self._RunFileFinder(paths, self.stat_action)
+
+    self.assertEqual(
+        sorted(listed), [
+            test_dir,
+            os.path.join(test_dir, "sub1"),
+            os.path.join(test_dir, "sub2")
+        ])
+
+    relative_results = self._GetRelativeResults(results, base_path=test_dir)
+    # sub1 is matched by the first glob even though it's also a prefix of the
+    # second one.
+    self.assertEqual(relative_results.count("sub1"), 2)
+    self.assertEqual(relative_results.count("sub1/x.txt"), 2)
+    self.assertEqual(relative_results.count("sub1/y.log"), 1)
+
   def _PrepareTimestampedFiles(self):
     searching_path = os.path.join(self.base_path, "searching")
     test_dir = os.path.join(self.temp_dir, "times_test")
@@ -354,6 +389,80 @@ class FileFinderTest(client_test_lib.EmptyActionTest):
       self.assertEqual(buffer_ref.data[bytes_before:bytes_before + len(needle)],
                        needle)
 
+  def _WriteTestFiles(self):
+    paths = []
+    for i in range(5):
+      path = os.path.join(self.temp_dir, "scan%d" % i)
+      with open(path, "wb") as fd:
+        fd.write("x" * i + "foo12barfoobar" * 3 + "xx" + "bar34foo")
+      paths.append(path)
+    return paths
+
+  def testMultipleContentConditionsAreScannedTogether(self):
+    paths = self._WriteTestFiles()
+
+    clmc = rdf_file_finder.FileFinderContentsLiteralMatchCondition
+    crmc = rdf_file_finder.FileFinderContentsRegexMatchCondition
+    conditions = [
+        rdf_file_finder.FileFinderCondition(
+            condition_type="CONTENTS_LITERAL_MATCH",
+            contents_literal_match=clmc(literal="foo", mode="ALL_HITS")),
+        rdf_file_finder.FileFinderCondition(
+            condition_type="CONTENTS_REGEX_MATCH",
+            contents_regex_match=crmc(regex="bar[0-9][0-9]", mode="FIRST_HIT")),
+        rdf_file_finder.FileFinderCondition(
+            condition_type="CONTENTS_LITERAL_MATCH",
+            contents_literal_match=clmc(
+                literal="bar", mode="ALL_HITS", start_offset=10, length=30)),
+    ]
+
+    # Blocks much smaller than the file, hits span block borders.
+    with utils.MultiStubber(
+        (client_file_finder.ContentScanner, "OVERLAP_SIZE", 4),
+        (client_file_finder.ContentScanner, "CHUNK_SIZE", 5)):
+      for threads in [0, 3]:
+        with test_lib.ConfigOverrider({
+            "Client.file_finder_scan_threads": threads
+        }):
+          results = self._RunFileFinder(
+              paths, self.stat_action, conditions=conditions)
+
+        self.assertEqual(
+            sorted(result.stat_entry.pathspec.path for result in results),
+            paths)
+
+        for result in results:
+          data = open(result.stat_entry.pathspec.path, "rb").read()
+          expected = []
+          pos = data.find("foo")
+          while pos != -1:
+            expected.append((pos, "foo"))
+            pos = data.find("foo", pos + 1)
+          expected.append((data.find("bar34"), "bar34"))
+          pos = data.find("bar", 10)
+          while pos != -1 and pos + 3 <= 40:
+            expected.append((pos, "bar"))
+            pos = data.find("bar", pos + 1)
+
+          self.assertEqual([(m.offset, m.data) for m in result.matches],
+                           expected)
+          for match in result.matches:
+            self.assertEqual(match.length, len(match.data))
+
+  def testContentConditionsMustAllMatch(self):
+    paths = self._WriteTestFiles()
+
+    clmc = rdf_file_finder.FileFinderContentsLiteralMatchCondition
+    conditions = [
+        rdf_file_finder.FileFinderCondition(
+            condition_type="CONTENTS_LITERAL_MATCH",
+            contents_literal_match=clmc(literal=literal))
+        for literal in ["foo", "not in the file"]
+    ]
+    results = self._RunFileFinder(
+        paths, self.stat_action, conditions=conditions)
+    self.assertEqual(results, [])
+
   def testHashAction(self):
     paths = [os.path.join(self.base_path, "hello.exe")]
 
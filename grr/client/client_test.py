@@ -2,6 +2,9 @@
 """Tests for the client."""
 
 
+import functools
+import threading
+import time
 
 # Need to import client to add the flags.
 from grr.client import actions
@@ -15,6 +18,7 @@ from grr.lib import flags
 from grr.lib import rdfvalue
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import flows as rdf_flows
+from grr.test_lib import benchmark_test_lib
 from grr.test_lib import test_lib
 
 
@@ -181,6 +185,116 @@ class BasicContextTests(test_lib.GRRBaseTest):
       result.append(item)
     self.assertEqual(result, ["C"] * 10 + ["A", "B"] * 10)
 
+  def testSizeQueueWakesUpBlockedWriters(self):
+    queue = comms.SizeQueue(maxsize=10)
+    queue.Put("A" * 10)
+
+    done = threading.Event()
+
+    def Writer():
+      queue.Put("B", timeout=10)
+      done.set()
+
+    writer = threading.Thread(target=Writer)
+    writer.start()
+    self.assertFalse(done.wait(0.1))
+
+    # High priority messages are never blocked.
+    queue.Put("C", rdf_flows.GrrMessage.Priority.HIGH_PRIORITY)
+
+    start = time.time()
+    self.assertEqual(list(queue.Get())[:2], ["C", "A" * 10])
+    self.assertTrue(done.wait(10))
+    self.assertLess(time.time() - start, queue.HEARTBEAT_INTERVAL)
+    writer.join()
+
+  def testTimerWakesUpInterruptibleWait(self):
+    timer = comms.Timer()
+    timer.SlowPoll()
+    timer.Wake()
+
+    start = time.time()
+    timer.Wait(interruptible=True)
+    self.assertLess(time.time() - start, 1)
+    self.assertEqual(timer.sleep_time, timer.poll_max)
+
+  def testUploadManagerRunsUploadsConcurrently(self):
+    manager = comms.UploadManager(2)
+    started = [threading.Event(), threading.Event()]
+
+    def Upload(index, http_manager, pending_upload):
+      self.assertIsInstance(http_manager, comms.HTTPManager)
+      self.assertFalse(pending_upload.cancelled)
+      started[index].set()
+      # Only returns if the other upload runs at the same time.
+      if not started[1 - index].wait(10):
+        raise IOError("Uploads ran one after the other.")
+      return index
+
+    pending = [
+        manager.Start(functools.partial(Upload, index)) for index in range(2)
+    ]
+    self.assertEqual([p.Result() for p in pending], [0, 1])
+    self.assertTrue(all(p.Done() for p in pending))
+
+  def testPendingUploadRaisesUploadErrors(self):
+    manager = comms.UploadManager(1)
+
+    def Upload(**_):
+      raise IOError("Unable to upload file.")
+
+    with self.assertRaises(IOError):
+      manager.Start(Upload).Result()
+
+
+class SizeQueueBenchmarks(benchmark_test_lib.MicroBenchmarks):
+  """Measures how fast responses pass through the client output queue."""
+
+  units = "ms"
+
+  MESSAGE_SIZE = 64 * 1024
+  MESSAGE_COUNT = 1000
+  MAX_POST_SIZE = 1024 * 1024
+
+  def setUp(self):
+    super(SizeQueueBenchmarks, self).setUp(["Throughput (MB/s)"], ["<20"])
+
+  def _RunUpload(self, maxsize):
+    """Drains a queue filled by a worker thread like the posting thread."""
+    queue = comms.SizeQueue(maxsize=maxsize)
+    latencies = []
+
+    def Worker():
+      for _ in xrange(self.MESSAGE_COUNT):
+        # The message contains the time it was queued at.
+        queue.Put("%-*f" % (self.MESSAGE_SIZE, time.time()))
+
+    worker = threading.Thread(target=Worker)
+    start = time.time()
+    worker.start()
+
+    while len(latencies) < self.MESSAGE_COUNT:
+      length = 0
+      for message in queue.Get():
+        latencies.append(time.time() - float(message))
+        length += len(message)
+        if length > self.MAX_POST_SIZE:
+          break
+
+    duration = time.time() - start
+    worker.join()
+
+    throughput = self.MESSAGE_SIZE * self.MESSAGE_COUNT / duration / 1024**2
+    self.AddResult("Queue latency, maxsize %d" % maxsize,
+                   sum(latencies) / len(latencies), self.MESSAGE_COUNT,
+                   "%.1f" % throughput)
+
+  def testUploadThroughput(self):
+    """Queue latency and throughput with and without back-pressure."""
+    for maxsize in [self.MAX_POST_SIZE // 4, self.MAX_POST_SIZE * 4,
+                    self.MESSAGE_SIZE * self.MESSAGE_COUNT * 2]:
+      self._RunUpload(maxsize)
+
 
 def main(argv):
   test_lib.main(argv)
@@ -70,6 +70,8 @@ Examples:
 
 
 import base64
+import collections
+import functools
 import logging
 import os
 import pdb
@@ -449,6 +451,7 @@ class Timer(object):
     self.heart_beat_cb = heart_beat_cb
     self.poll_min = config.CONFIG["Client.poll_min"]
     self.sleep_time = self.poll_max = config.CONFIG["Client.poll_max"]
+    self._wake_event = threading.Event()
 
   def FastPoll(self):
     """Switch to fast poll mode."""
@@ -458,13 +461,35 @@ class Timer(object):
     """Switch to slow poll mode."""
     self.sleep_time = self.poll_max
 
-  def Wait(self):
-    """Wait until the next action is needed."""
-    time.sleep(self.sleep_time - int(self.sleep_time))
+  def Wake(self):
+    """Ends the current or next interruptible Wait() early."""
+    self._wake_event.set()
+
+  def ClearWake(self):
+    """Discards Wake() calls made so far."""
+    self._wake_event.clear()
+
+  def _Sleep(self, timeout, interruptible):
+    """Sleeps for timeout seconds, returns True if woken up by Wake()."""
+    if interruptible:
+      return self._wake_event.wait(timeout)
+
+    time.sleep(timeout)
+    return False
+
+  def Wait(self, interruptible=False):
+    """Wait until the next action is needed.
+
+    Args:
+      interruptible: If True, return as soon as Wake() is called.
+    """
+    if self._Sleep(self.sleep_time - int(self.sleep_time), interruptible):
+      return
 
     # Split a long sleep interval into 1 second intervals so we can heartbeat.
     for _ in xrange(int(self.sleep_time)):
-      time.sleep(1)
+      if self._Sleep(1, interruptible):
+        return
 
       if self.heart_beat_cb:
         self.heart_beat_cb()
@@ -572,6 +597,11 @@ class GRRClientWorker(object):
     self.http_manager = HTTPManager(
         heart_beat_cb=self.nanny_controller.Heartbeat)
 
+    # Background uploads use their own HTTP managers.
+    self.upload_manager = UploadManager(
+        config.CONFIG["Client.max_concurrent_uploads"],
+        heart_beat_cb=self.nanny_controller.Heartbeat)
+
   def Sleep(self, timeout):
     """Sleeps the calling thread with heartbeat."""
     self.nanny_controller.Heartbeat()
@@ -705,10 +735,57 @@ class GRRClientWorker(object):
                  session_id=None,
                  progress_callback=None):
     """Uploads a file to the GRR server using a direct HTTP transfer."""
+    return self._UploadFile(
+        self.http_manager,
+        file_fd,
+        upload_token,
+        max_bytes=max_bytes,
+        network_bytes_limit=network_bytes_limit,
+        session_id=session_id,
+        progress_callback=progress_callback)
+
+  def StartFileUpload(self,
+                      file_fd,
+                      upload_token,
+                      max_bytes=None,
+                      network_bytes_limit=None,
+                      session_id=None,
+                      progress_callback=None):
+    """Uploads a file like UploadFile() but in the background.
+
+    Up to Client.max_concurrent_uploads files are uploaded at the same time,
+    each over its own HTTP connection, while the comms thread keeps polling.
+
+    Returns:
+      A PendingUpload, its Result() is the UploadedFile.
+    """
+    return self.upload_manager.Start(
+        functools.partial(
+            self._UploadFile,
+            file_fd=file_fd,
+            upload_token=upload_token,
+            max_bytes=max_bytes,
+            network_bytes_limit=network_bytes_limit,
+            session_id=session_id,
+            progress_callback=progress_callback))
+
+  def _UploadFile(self,
+                  http_manager,
+                  file_fd,
+                  upload_token,
+                  max_bytes=None,
+                  network_bytes_limit=None,
+                  session_id=None,
+                  progress_callback=None,
+                  pending_upload=None):
+    """Uploads a file over the given HTTPManager."""
 
     def FileGenerator(fd):
       """A Generator of file content."""
       while 1:
+        if pending_upload is not None and pending_upload.cancelled:
+          raise actions.UploadCancelledError("Upload cancelled.")
+
         data = fd.Read(self.UPLOAD_BUFFER_SIZE)
         if not data:
           break
@@ -731,7 +808,7 @@ class GRRClientWorker(object):
     server_certificate = rdf_crypto.RDFX509Cert(self.client.server_certificate)
     fd = uploads.EncryptStream(server_certificate.GetPublicKey(),
                                config.CONFIG["Client.private_key"], gzip_fd)
-    response = self.http_manager.OpenServerEndpoint(
+    response = http_manager.OpenServerEndpoint(
         u"/upload",
         data=FileGenerator(fd),
         headers={
@@ -933,25 +1010,136 @@ class GRRClientWorker(object):
         require_fastpoll=False)
 
 
+class PendingUpload(object):
+  """A file upload run in the background by the UploadManager."""
+
+  def __init__(self, upload_fn):
+    self._upload_fn = upload_fn
+    self._done = threading.Event()
+    self._result = None
+    self._exc_info = None
+    self.cancelled = False
+
+  def Run(self, http_manager):
+    try:
+      self._result = self._upload_fn(
+          http_manager=http_manager, pending_upload=self)
+    except Exception:  # pylint: disable=broad-except
+      self._exc_info = sys.exc_info()
+    finally:
+      self._done.set()
+
+  def Cancel(self):
+    """Stops the upload before it sends its next chunk."""
+    self.cancelled = True
+
+  def Done(self):
+    return self._done.is_set()
+
+  def Result(self, progress_callback=None):
+    """Waits for the upload to finish.
+
+    Args:
+      progress_callback: Called about once a second while waiting.
+
+    Returns:
+      The UploadedFile.
+
+    Raises:
+      The exception the upload failed with.
+    """
+    while not self._done.wait(1):
+      if progress_callback:
+        progress_callback()
+
+    if self._exc_info:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+    return self._result
+
+
+class UploadManager(object):
+  """Runs file uploads on a fixed number of threads.
+
+  Every thread has its own HTTPManager so uploads don't wait for each other or
+  for the poll requests of the comms thread. The threads are started with the
+  first upload.
+  """
+
+  def __init__(self, num_threads, heart_beat_cb=None):
+    self.num_threads = num_threads
+    self.heart_beat_cb = heart_beat_cb
+    self.lock = threading.Lock()
+    self._queue = Queue.Queue()
+    self._threads = []
+
+  def _Run(self):
+    http_manager = HTTPManager(heart_beat_cb=self.heart_beat_cb)
+    while True:
+      self._queue.get().Run(http_manager)
+
+  def Start(self, upload_fn):
+    """Queues an upload.
+
+    Args:
+      upload_fn: Called with the http_manager and pending_upload keyword
+        arguments on an upload thread, returns the result of the upload.
+
+    Returns:
+      A PendingUpload.
+    """
+    with self.lock:
+      while len(self._threads) < self.num_threads:
+        thread = threading.Thread(
+            target=self._Run, name="Upload%d" % len(self._threads))
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    pending_upload = PendingUpload(upload_fn)
+    self._queue.put(pending_upload)
+    return pending_upload
+
+
 class SizeQueue(object):
-  """A Queue which limits the total size of its elements.
+  """A thread safe Queue which limits the total size of its elements.
 
   The standard Queue implementations uses the total number of elements to block
   on. In the client we want to limit the total memory footprint, hence we need
   to use the total size as a measure of how full the queue is.
 
-  TODO(user): this class needs some attention to ensure it is thread safe.
+  Items are kept in a FIFO deque per priority so Put() and Get() don't depend on
+  the number of queued items. Writers blocked on a full queue are woken up
+  through a condition variable as soon as Get() makes room.
   """
-  total_size = 0
+
+  # Blocked writers heartbeat the nanny at this interval in seconds.
+  HEARTBEAT_INTERVAL = 1
 
   def __init__(self, maxsize=1024, nanny=None):
     self.lock = threading.RLock()
-    self.queue = []
-    self._reversed = []
+    self._not_full = threading.Condition(self.lock)
+    # Deques of items by priority and the priorities from highest to lowest.
+    self._queues = {}
+    self._priorities = []
     self.total_size = 0
     self.maxsize = maxsize
     self.nanny = nanny
 
+  def _WaitForSpace(self, timeout):
+    """Waits until the queue is below maxsize. The lock must be held."""
+    deadline = timeout and time.time() + timeout
+    while self.total_size >= self.maxsize:
+      wait_time = self.HEARTBEAT_INTERVAL
+      if deadline:
+        wait_time = min(wait_time, deadline - time.time())
+        if wait_time <= 0:
+          raise Queue.Full
+
+      self._not_full.wait(wait_time)
+      if self.nanny:
+        self.nanny.Heartbeat()
+
   def Put(self,
           item,
           priority=rdf_flows.GrrMessage.Priority.MEDIUM_PRIORITY,
@@ -966,7 +1154,7 @@ class SizeQueue(object):
       item: The item to put - must have a __len__() method.
       priority: The priority of this message.
       block: If True we block indefinitely.
-      timeout: Maximum time we spend waiting on the queue (1 sec resolution).
+      timeout: Maximum time in seconds we spend waiting on the queue.
 
     Raises:
       Queue.Full: if the queue is full and block is False, or
@@ -976,45 +1164,55 @@ class SizeQueue(object):
     if isinstance(item, rdfvalue.RDFValue):
       item = item.SerializeToString()
 
-    if priority >= rdf_flows.GrrMessage.Priority.HIGH_PRIORITY:
-      pass  # If high priority is set we dont care about the size of the queue.
+    priority = int(priority)
+    with self.lock:
+      if priority >= rdf_flows.GrrMessage.Priority.HIGH_PRIORITY:
+        pass  # If high priority is set we dont care about the queue size.
 
-    elif not block:
-      if self.total_size >= self.maxsize:
-        raise Queue.Full
+      elif not block:
+        if self.total_size >= self.maxsize:
+          raise Queue.Full
 
-    else:
-      count = 0
-      # Wait until the queue has more space. We do not hold the lock here to
-      # ensure that the posting thread can drain this queue while we block here.
-      while self.total_size >= self.maxsize:
-        time.sleep(1)
-        self.nanny.Heartbeat()
-        count += 1
+      else:
+        # Waiting releases the lock so the posting thread can drain this queue
+        # while we block here.
+        self._WaitForSpace(timeout)
 
-        if timeout and count > timeout:
-          raise Queue.Full
+      try:
+        queue = self._queues[priority]
+      except KeyError:
+        queue = self._queues[priority] = collections.deque()
+        self._priorities = sorted(self._queues, reverse=True)
 
-    with self.lock:
-      self.queue.append((-1 * priority, item))
+      queue.append(item)
       self.total_size += len(item)
 
-  def Get(self):
-    """Retrieves the items from the queue."""
+  def _Pop(self):
+    """Removes the next item from the queue, returns None if it is empty."""
     with self.lock:
-      if self._reversed:
-        # We have leftovers from a partial Get().
-        self._reversed.reverse()
-        self.queue = self._reversed + self.queue
+      for priority in self._priorities:
+        queue = self._queues[priority]
+        if queue:
+          item = queue.popleft()
+          self.total_size -= len(item)
+          if self.total_size < self.maxsize:
+            self._not_full.notify_all()
+          return item
 
-      self.queue.sort(key=lambda msg: msg[0])  # by priority only.
-      self.queue.reverse()
-      self._reversed, self.queue = self.queue, []
+  def Get(self):
+    """Retrieves the items from the queue, highest priority first.
 
-      while self._reversed:
-        item = self._reversed.pop()[1]
-        self.total_size -= len(item)
-        yield item
+    Items are only removed as they are yielded, items left over by a partial
+    iteration stay queued.
+
+    Yields:
+      The queued items.
+    """
+    while True:
+      item = self._Pop()
+      if item is None:
+        return
+      yield item
 
   def Size(self):
     return self.total_size
@@ -1106,6 +1304,10 @@ class GRRThreadedWorker(GRRClientWorker, threading.Thread):
     """Pushes the Serialized Message on the output queue."""
     self._out_queue.Put(message, priority=priority, block=blocking)
 
+    # Wake up the client so the message is sent without waiting for the poll.
+    if self.client is not None and message.require_fastpoll:
+      self.client.timer.Wake()
+
   def QueueMessages(self, messages):
     """Push messages to the input queue."""
     # Push all the messages to our input queue
@@ -1381,6 +1583,9 @@ class GRRHTTPClient(object):
     # the last poll request. Otherwise we just wait until the connection comes
     # back so we don't expire our messages too fast.
     if self.http_manager.consecutive_connection_errors == 0:
+      # Messages queued from now on are sent by the next poll.
+      self.timer.ClearWake()
+
       # Grab some messages to send
       message_list = self.client_worker.Drain(
           max_size=config.CONFIG["Client.max_post_size"])
@@ -1559,7 +1764,11 @@ class GRRHTTPClient(object):
         # And done for now.
         sys.exit(-1)
 
-      self.timer.Wait()
+      # Messages which need a fast poll end the wait early, unless the server
+      # can't be reached in which case we keep backing off.
+      self.timer.Wait(
+          interruptible=(self.server_certificate is not None and
+                         self.http_manager.consecutive_connection_errors == 0))
 
   def InitiateEnrolment(self):
     """Initiate the enrollment process.
@@ -101,10 +101,20 @@ config_lib.DEFINE_integer("Client.max_post_size", 40000000,
 config_lib.DEFINE_integer("Client.max_out_queue", 51200000,
                           "Maximum size of the output queue.")
 
+config_lib.DEFINE_integer(
+    "Client.max_concurrent_uploads", 3,
+    "The number of files client actions upload at the same time, each over "
+    "its own HTTP connection.")
+
 config_lib.DEFINE_integer("Client.foreman_check_frequency", 1800,
                           "The minimum number of seconds before checking with "
                           "the foreman for new work.")
 
+config_lib.DEFINE_integer(
+    "Client.file_finder_scan_threads", 0,
+    "If set, the file finder scans the contents of this many files in "
+    "parallel. Every thread uses a buffer of about 11MB.")
+
 config_lib.DEFINE_float("Client.rss_max", 1000,
                         "Maximum memory footprint in MB (soft limit). "
                         "Exceeding this will result in an orderly shutdown.")
@@ -13,6 +13,22 @@ config_lib.DEFINE_string("Datastore.implementation", "FakeDataStore",
 config_lib.DEFINE_string("Blobstore.implementation", "MemoryStreamBlobstore",
                          "Blob storage subsystem to use.")
 
+config_lib.DEFINE_string(
+    "PackFileBlobstore.root_dir",
+    default="%(Config.prefix)/var/grr-blobs",
+    help="Directory of the pack files of the PackFileBlobstore. All processes "
+    "storing or reading blobs need access to it, e.g. through a shared mount.")
+
+config_lib.DEFINE_integer(
+    "PackFileBlobstore.max_pack_size", 1024 * 1024 * 1024,
+    "Once a pack file grows beyond this size in bytes, new blobs are appended "
+    "to a new pack file.")
+
+config_lib.DEFINE_integer(
+    "PackFileBlobstore.max_open_packs", 100,
+    "The number of pack files each process keeps memory mapped. The least "
+    "recently read packs are unmapped.")
+
 DATASTORE_PATHING = [
     r"%{(?P<path>files/hash/generic/sha256/...).*}",
     r"%{(?P<path>files/hash/generic/sha1/...).*}",
@@ -35,6 +51,30 @@ config_lib.DEFINE_string(
     help=("Location of the data store (usually a "
           "filesystem directory)"))
 
+config_lib.DEFINE_integer(
+    "Datastore.subject_cache_size",
+    default=0,
+    help=("Number of subjects whose ResolvePrefix results are cached in "
+          "memory. 0 disables the subject cache."))
+
+config_lib.DEFINE_integer(
+    "Datastore.subject_cache_ttl",
+    default=10,
+    help=("Number of seconds a cached result stays valid. Writes made by "
+          "other processes become visible after this time at the latest."))
+
+config_lib.DEFINE_list(
+    "Datastore.subject_cache_attribute_ttls", [],
+    ("A list of <attribute prefix>=<seconds> entries overriding "
+     "Datastore.subject_cache_ttl for results containing matching "
+     "attributes. A value of 0 disables caching for these attributes."))
+
+config_lib.DEFINE_integer(
+    "Datastore.read_threadpool_size",
+    default=0,
+    help=("If larger than 1, data stores that support it split large reads "
+          "(MultiResolvePrefix and ScanAttributes) across this many threads."))
+
 # SQLite data store.
 config_lib.DEFINE_integer(
     "SqliteDatastore.vacuum_check",
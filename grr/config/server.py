@@ -100,6 +100,28 @@ config_lib.DEFINE_integer("Frontend.port_max", None,
                           "use ports between Frontend.bind_port and "
                           "Frontend.port_max.")
 
+config_lib.DEFINE_choice(
+    "Frontend.server_mode", "threading", ["threading", "event_loop"],
+    "How the HTTP frontend serves clients. 'threading' uses one thread per "
+    "connection. 'event_loop' handles all connections in a single event loop "
+    "and processes complete requests on a pool of Frontend.worker_threads "
+    "threads.")
+
+config_lib.DEFINE_integer(
+    "Frontend.worker_threads", 50,
+    "The number of threads processing requests in the event_loop server mode.")
+
+config_lib.DEFINE_integer(
+    "Frontend.max_request_size", 64 * 1024 * 1024,
+    "The largest request body the event_loop server mode reads before "
+    "processing a request. Larger requests are answered with status 413. "
+    "Uploads are streamed to the worker threads and are not limited.")
+
+config_lib.DEFINE_integer(
+    "Frontend.idle_timeout", 300,
+    "In the event_loop server mode, connections which did not send or receive "
+    "data for this many seconds while no request was processed are closed.")
+
 config_lib.DEFINE_integer("Frontend.max_queue_size", 500,
                           "Maximum number of messages to queue for the client.")
 
@@ -111,6 +133,26 @@ config_lib.DEFINE_integer("Frontend.message_expiry_time", 600,
                           "Maximum time messages remain valid within the "
                           "system.")
 
+config_lib.DEFINE_integer(
+    "Frontend.heartbeat_flush_interval", 5,
+    "Client ip, clock and ping updates are buffered and written for all "
+    "clients together at this interval in seconds. If 0, they are written "
+    "on every poll.")
+
+config_lib.DEFINE_integer(
+    "Frontend.cipher_decryption_processes", 0,
+    "If set, the RSA decryption of session ciphers not yet in the cipher cache "
+    "is done by a pool of this many processes instead of the request thread. "
+    "The processes are started by the frontend before it starts any threads.")
+
+config_lib.DEFINE_semantic(
+    rdfvalue.Duration,
+    "Frontend.public_key_prewarm_age",
+    default="1d",
+    description="On startup, the frontend loads the public keys of all "
+    "clients seen within this time so that new sessions of these clients don't "
+    "need a data store read. Set to 0 to disable.")
+
 config_lib.DEFINE_string("Frontend.upload_store", "FileUploadFileStore",
                          "The implementation of the upload file store.")
 
@@ -156,8 +156,9 @@ class ApiSearchClientsHandler(api_call_handler_base.ApiCallHandler):
     keywords = shlex.split(args.query)
 
     index = client_index.CreateClientIndex(token=token)
-    result_urns = sorted(
-        index.LookupClients(keywords))[args.offset:args.offset + end]
+    limit = args.offset + args.count if args.count else None
+    result_urns = sorted(index.LookupClients(
+        keywords, limit=limit))[args.offset:args.offset + end]
 
     result_set = aff4.FACTORY.MultiOpen(result_urns, token=token)
 
@@ -11,13 +11,16 @@ from grr.gui.api_plugins.report_plugins import filestore_report_plugins
 from grr.gui.api_plugins.report_plugins import rdf_report_plugins
 from grr.gui.api_plugins.report_plugins import report_plugins
 from grr.gui.api_plugins.report_plugins import report_plugins_test_mocks
+from grr.gui.api_plugins.report_plugins import report_utils
 from grr.gui.api_plugins.report_plugins import server_report_plugins
 
 from grr.lib import flags
 from grr.lib import rdfvalue
+from grr.lib import utils
 from grr.lib.rdfvalues import paths as rdf_paths
 from grr.server import aff4
 from grr.server import client_fixture
+from grr.server import data_store
 from grr.server import events
 from grr.server.aff4_objects import filestore_test_lib
 from grr.server.flows.cron import filestore_stats
@@ -93,6 +96,45 @@ class ReportUtilsTest(test_lib.GRRBaseTest):
     self.assertIn("Fake audit description bar.", audit_events)
     self.assertNotIn("Fake outdated audit log.", audit_events)
 
+  def testGetAuditEventsReadsLogsForTimeBeforeTheIndex(self):
+    # Events which were logged before the index existed are only in the log.
+    with test_lib.FakeTime(rdfvalue.RDFDatetime.FromHumanReadable("2012/12/8")):
+      with data_store.DB.GetMutationPool() as pool:
+        audit.AuditEventCollection.StaticAdd(
+            aff4.CurrentAuditLog(),
+            events.AuditEvent(
+                action=events.AuditEvent.Action.HUNT_CREATED,
+                description="Not indexed."),
+            mutation_pool=pool)
+      aff4.FACTORY.Create(
+          aff4.CurrentAuditLog(), aff4.AFF4Volume, token=self.token).Close()
+
+    with test_lib.FakeTime(
+        rdfvalue.RDFDatetime.FromHumanReadable("2012/12/10")):
+      AddFakeAuditLog(
+          "Indexed.", action=events.AuditEvent.Action.HUNT_CREATED,
+          token=self.token)
+      AddFakeAuditLog(
+          "Other action.", action=events.AuditEvent.Action.HUNT_STOPPED,
+          token=self.token)
+
+    start = rdfvalue.RDFDatetime.FromHumanReadable("2012/12/1")
+    end = rdfvalue.RDFDatetime.FromHumanReadable("2012/12/20")
+    self.assertEqual(
+        sorted(event.description
+               for event in report_utils.GetAuditEvents(
+                   [events.AuditEvent.Action.HUNT_CREATED], start, end,
+                   self.token)), ["Indexed.", "Not indexed."])
+
+    # A range which is fully indexed doesn't need the logs.
+    start = rdfvalue.RDFDatetime.FromHumanReadable("2012/12/10")
+    with utils.Stubber(report_utils, "GetAuditLogEntries", None):
+      self.assertEqual([
+          event.description
+          for event in report_utils.GetAuditEvents(
+              [events.AuditEvent.Action.HUNT_CREATED], start, end, self.token)
+      ], ["Indexed."])
+
 
 class ClientReportPluginsTest(test_lib.GRRBaseTest):
 
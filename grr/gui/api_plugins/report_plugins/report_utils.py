@@ -29,3 +29,77 @@ def GetAuditLogEntries(offset, now, token):
   if not logs_found:
     raise ValueError("Couldn't find any logs in aff4:/audit/logs "
                      "between %s and %s" % (start_time, now))
+
+
+def _SplitAtIndexStart(start_time, end_time, token):
+  """Splits a time range into a part before and a part after the audit index.
+
+  Args:
+    start_time: rdfvalue.RDFDatetime, start of the time range.
+    end_time: rdfvalue.RDFDatetime, end of the time range.
+    token: GRR access token
+  Returns:
+    A tuple of the end of the part only found in the audit logs and the start
+    of the indexed part. The first is None if the whole range is indexed, the
+    second is None if nothing in the range is indexed.
+  """
+  index_start = audit.AuditIndexStart(token=token)
+  if index_start is None or index_start >= end_time:
+    return end_time, None
+  if index_start <= start_time:
+    return None, start_time
+  return index_start, index_start
+
+
+def GetAuditEvents(actions, start_time, end_time, token):
+  """Return the audit events of the given actions between start and end time.
+
+  Args:
+    actions: list of events.AuditEvent.Action values to return
+    start_time: rdfvalue.RDFDatetime, events before this are skipped
+    end_time: rdfvalue.RDFDatetime, events after this are skipped
+    token: GRR access token
+  Raises:
+    ValueError: No logs were found for a time range which is not indexed.
+  Yields:
+    AuditEvents of the given actions created during the time range
+  """
+  logs_end, index_start = _SplitAtIndexStart(start_time, end_time, token)
+
+  if logs_end is not None:
+    for event in GetAuditLogEntries(logs_end - start_time, logs_end, token):
+      if event.action in actions:
+        yield event
+
+  if index_start is not None:
+    for event in audit.IndexedAuditEvents(
+        actions, index_start, end_time, token=token):
+      yield event
+
+
+def GetAuditEventCounts(start_time, end_time, token):
+  """Return the number of audit events per user between start and end time.
+
+  Indexed events are counted per index bucket, so the counts of the buckets at
+  the edges of the time range include the whole bucket.
+
+  Args:
+    start_time: rdfvalue.RDFDatetime for the start of the time range
+    end_time: rdfvalue.RDFDatetime for the end of the time range
+    token: GRR access token
+  Raises:
+    ValueError: No logs were found for a time range which is not indexed.
+  Yields:
+    Tuples of (rdfvalue.RDFDatetime, user, count)
+  """
+  logs_end, index_start = _SplitAtIndexStart(start_time, end_time, token)
+
+  if logs_end is not None:
+    for event in GetAuditLogEntries(logs_end - start_time, logs_end, token):
+      yield event.timestamp, event.user, 1
+
+  if index_start is not None:
+    for bucket_start, counts in audit.IndexedAuditEventCounts(
+        index_start, end_time, token=token):
+      for user, count in counts.iteritems():
+        yield bucket_start, user, count
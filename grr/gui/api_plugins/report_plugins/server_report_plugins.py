@@ -8,10 +8,8 @@ from grr.gui.api_plugins.report_plugins import report_plugin_base
 
 from grr.gui.api_plugins.report_plugins import report_utils
 from grr.lib import rdfvalue
-from grr.server import aff4
 from grr.server import events
 from grr.server.aff4_objects import users as aff4_users
-from grr.server.flows.general import audit
 
 TYPE = rdf_report_plugins.ApiReportDescriptor.ReportType.SERVER
 
@@ -45,10 +43,10 @@ class ClientApprovalsReportPlugin(report_plugin_base.ReportPluginBase):
 
       rows = []
       try:
-        for event in report_utils.GetAuditLogEntries(timerange_offset,
-                                                     timerange_end, token):
-          if event.action in self.__class__.TYPES:
-            rows.append(event)
+        for event in report_utils.GetAuditEvents(
+            self.__class__.TYPES, get_report_args.start_time, timerange_end,
+            token):
+          rows.append(event)
 
       except ValueError:  # Couldn't find any logs..
         pass
@@ -90,10 +88,10 @@ class CronApprovalsReportPlugin(report_plugin_base.ReportPluginBase):
 
       rows = []
       try:
-        for event in report_utils.GetAuditLogEntries(timerange_offset,
-                                                     timerange_end, token):
-          if event.action in self.__class__.TYPES:
-            rows.append(event)
+        for event in report_utils.GetAuditEvents(
+            self.__class__.TYPES, get_report_args.start_time, timerange_end,
+            token):
+          rows.append(event)
 
       except ValueError:  # Couldn't find any logs..
         pass
@@ -140,10 +138,10 @@ class HuntActionsReportPlugin(report_plugin_base.ReportPluginBase):
 
       rows = []
       try:
-        for event in report_utils.GetAuditLogEntries(timerange_offset,
-                                                     timerange_end, token):
-          if event.action in self.__class__.TYPES:
-            rows.append(event)
+        for event in report_utils.GetAuditEvents(
+            self.__class__.TYPES, get_report_args.start_time, timerange_end,
+            token):
+          rows.append(event)
 
       except ValueError:  # Couldn't find any logs..
         pass
@@ -185,10 +183,10 @@ class HuntApprovalsReportPlugin(report_plugin_base.ReportPluginBase):
 
       rows = []
       try:
-        for event in report_utils.GetAuditLogEntries(timerange_offset,
-                                                     timerange_end, token):
-          if event.action in self.__class__.TYPES:
-            rows.append(event)
+        for event in report_utils.GetAuditEvents(
+            self.__class__.TYPES, get_report_args.start_time, timerange_end,
+            token):
+          rows.append(event)
 
       except ValueError:  # Couldn't find any logs..
         pass
@@ -222,10 +220,10 @@ class MostActiveUsersReportPlugin(report_plugin_base.ReportPluginBase):
 
       counts = {}
       try:
-        for event in report_utils.GetAuditLogEntries(timerange_offset,
-                                                     timerange_end, token):
-          counts.setdefault(event.user, 0)
-          counts[event.user] += 1
+        for _, user, count in report_utils.GetAuditEventCounts(
+            get_report_args.start_time, timerange_end, token):
+          counts.setdefault(user, 0)
+          counts[user] += count
       except ValueError:  # Couldn't find any logs..
         pass
 
@@ -268,10 +266,10 @@ class SystemFlowsReportPlugin(report_plugin_base.ReportPluginBase):
       # Store run count total and per-user
       counts = {}
       try:
-        for event in report_utils.GetAuditLogEntries(timerange_offset,
-                                                     timerange_end, token):
-          if (event.action == events.AuditEvent.Action.RUN_FLOW and
-              self.UserFilter(event.user)):
+        for event in report_utils.GetAuditEvents(
+            [events.AuditEvent.Action.RUN_FLOW], get_report_args.start_time,
+            timerange_end, token):
+          if self.UserFilter(event.user):
             counts.setdefault(event.flow_name, {"total": 0, event.user: 0})
             counts[event.flow_name]["total"] += 1
             counts[event.flow_name].setdefault(event.user, 0)
@@ -324,17 +322,15 @@ class UserActivityReportPlugin(report_plugin_base.ReportPluginBase):
       week_duration = rdfvalue.Duration("7d")
       offset = rdfvalue.Duration("%dw" % self.WEEKS)
       now = rdfvalue.RDFDatetime.Now()
-      start_time = now - offset - aff4.AUDIT_ROLLOVER_TIME
       try:
-        for fd in audit.AuditLogsForTimespan(start_time, now, token):
-          for event in fd.GenerateItems():
-            for week in xrange(self.__class__.WEEKS):
-              start = now - week * week_duration
-              if start < event.timestamp < (start + week_duration):
-                weekly_activity = user_activity.setdefault(
-                    event.user, [[x, 0]
-                                 for x in xrange(-self.__class__.WEEKS, 0, 1)])
-                weekly_activity[-week][1] += 1
+        for timestamp, user, count in report_utils.GetAuditEventCounts(
+            now - offset, now, token):
+          for week in xrange(self.__class__.WEEKS):
+            start = now - week * week_duration
+            if start <= timestamp < (start + week_duration):
+              weekly_activity = user_activity.setdefault(
+                  user, [[x, 0] for x in xrange(-self.__class__.WEEKS, 0, 1)])
+              weekly_activity[-week][1] += count
       except ValueError:  # Couldn't find any logs..
         pass
 
@@ -380,10 +376,10 @@ class UserFlowsReportPlugin(report_plugin_base.ReportPluginBase):
       # Store run count total and per-user
       counts = {}
       try:
-        for event in report_utils.GetAuditLogEntries(timerange_offset,
-                                                     timerange_end, token):
-          if (event.action == events.AuditEvent.Action.RUN_FLOW and
-              self.UserFilter(event.user)):
+        for event in report_utils.GetAuditEvents(
+            [events.AuditEvent.Action.RUN_FLOW], get_report_args.start_time,
+            timerange_end, token):
+          if self.UserFilter(event.user):
             counts.setdefault(event.flow_name, {"total": 0, event.user: 0})
             counts[event.flow_name]["total"] += 1
             counts[event.flow_name].setdefault(event.user, 0)
@@ -2,6 +2,7 @@
 """Abstracts encryption and authentication."""
 
 
+import contextlib
 import struct
 import time
 import zlib
@@ -32,6 +33,23 @@ class CommunicatorInit(registry.InitHook):
     stats.STATS.RegisterCounterMetric(
         "grr_encrypted_cipher_cache", fields=[("type", str)])
 
+    # Time spent in the stages of message decoding: "cipher" (the RSA
+    # decryption of new session ciphers), "decrypt", "verify" (HMAC and
+    # signature checks), "decompress" and "parse".
+    stats.STATS.RegisterEventMetric(
+        "grr_decoding_stage_time", fields=[("stage", str)])
+
+
+@contextlib.contextmanager
+def DecodingStage(stage):
+  """Records the time spent in a stage of message decoding."""
+  start_time = time.time()
+  try:
+    yield
+  finally:
+    stats.STATS.RecordEvent(
+        "grr_decoding_stage_time", time.time() - start_time, fields=[stage])
+
 
 class Error(stats.CountingExceptionMixin, Exception):
   """Base class for all exceptions in this module."""
@@ -119,7 +137,18 @@ class ReceivedCipher(Cipher):
   """A cipher which we received from our peer."""
 
   # pylint: disable=super-init-not-called
-  def __init__(self, response_comms, private_key):
+  def __init__(self, response_comms, private_key, serialized_cipher=None):
+    """Constructor.
+
+    Args:
+      response_comms: The ClientCommunication the cipher was received with.
+      private_key: Our private key.
+      serialized_cipher: The already decrypted encrypted_cipher of
+        response_comms. If not given, it is decrypted using private_key.
+
+    Raises:
+      DecryptionError: The cipher could not be decrypted or is invalid.
+    """
     self.private_key = private_key
     self.response_comms = response_comms
 
@@ -134,8 +163,9 @@ class ReceivedCipher(Cipher):
 
     try:
       # The encrypted_cipher contains the session key, iv and hmac_key.
-      self.serialized_cipher = private_key.Decrypt(
-          response_comms.encrypted_cipher)
+      if serialized_cipher is None:
+        serialized_cipher = private_key.Decrypt(response_comms.encrypted_cipher)
+      self.serialized_cipher = serialized_cipher
 
       # If we get here we have the session keys.
       self.cipher = rdf_flows.CipherProperties.FromSerializedString(
@@ -429,30 +459,36 @@ class Communicator(object):
     elif (compression ==
           rdf_flows.PackedMessageList.CompressionType.ZCOMPRESSION):
       try:
-        data = zlib.decompress(packed_message_list.message_list)
+        with DecodingStage("decompress"):
+          data = zlib.decompress(packed_message_list.message_list)
       except zlib.error as e:
         raise DecodingError("Failed to decompress: %s" % e)
     else:
       raise DecodingError("Compression scheme not supported")
 
     try:
-      result = rdf_flows.MessageList.FromSerializedString(data)
+      with DecodingStage("parse"):
+        result = rdf_flows.MessageList.FromSerializedString(data)
     except rdfvalue.DecodeError:
       raise DecodingError("RDFValue parsing failed.")
 
     return result
 
-  def DecodeMessages(self, response_comms):
-    """Extract and verify server message.
+  def _CreateReceivedCipher(self, response_comms):
+    """Decrypts the cipher of response_comms which is not in the cache."""
+    return ReceivedCipher(response_comms, self.private_key)
+
+  def _GetCipher(self, response_comms):
+    """Returns the verified cipher for response_comms.
 
     Args:
         response_comms: A ClientCommunication rdfvalue
 
     Returns:
-       list of messages and the CN where they came from.
+       A tuple (cipher, cipher_verified, remote_public_key).
 
     Raises:
-       DecryptionError: If the message failed to decrypt properly.
+       DecryptionError: If the cipher failed to decrypt properly.
     """
     # Have we seen this cipher before?
     cipher_verified = False
@@ -463,7 +499,8 @@ class Communicator(object):
 
       # Even though we have seen this encrypted cipher already, we should still
       # make sure that all the other fields are sane and verify the HMAC.
-      cipher.VerifyReceivedHMAC(response_comms)
+      with DecodingStage("verify"):
+        cipher.VerifyReceivedHMAC(response_comms)
       cipher_verified = True
 
       # If we have the cipher in the cache, we know the source and
@@ -473,12 +510,15 @@ class Communicator(object):
     except KeyError:
       stats.STATS.IncrementCounter(
           "grr_encrypted_cipher_cache", fields=["misses"])
-      cipher = ReceivedCipher(response_comms, self.private_key)
+      with DecodingStage("cipher"):
+        cipher = self._CreateReceivedCipher(response_comms)
 
       source = cipher.GetSource()
       try:
         remote_public_key = self._GetRemotePublicKey(source)
-        if cipher.VerifyCipherSignature(remote_public_key):
+        with DecodingStage("verify"):
+          signature_verified = cipher.VerifyCipherSignature(remote_public_key)
+        if signature_verified:
           # At this point we know this cipher is legit, we can cache it.
           self.encrypted_cipher_cache.Put(response_comms.encrypted_cipher,
                                           cipher)
@@ -488,13 +528,31 @@ class Communicator(object):
         # We don't know who we are talking to.
         remote_public_key = None
 
+    return cipher, cipher_verified, remote_public_key
+
+  def DecodeMessages(self, response_comms):
+    """Extract and verify server message.
+
+    Args:
+        response_comms: A ClientCommunication rdfvalue
+
+    Returns:
+       list of messages and the CN where they came from.
+
+    Raises:
+       DecryptionError: If the message failed to decrypt properly.
+    """
+    cipher, cipher_verified, remote_public_key = self._GetCipher(
+        response_comms)
+
     # Decrypt the message with the per packet IV.
-    plain = cipher.Decrypt(response_comms.encrypted, response_comms.packet_iv)
-    try:
-      packed_message_list = rdf_flows.PackedMessageList.FromSerializedString(
-          plain)
-    except rdfvalue.DecodeError as e:
-      raise DecryptionError(str(e))
+    with DecodingStage("decrypt"):
+      plain = cipher.Decrypt(response_comms.encrypted, response_comms.packet_iv)
+      try:
+        packed_message_list = rdf_flows.PackedMessageList.FromSerializedString(
+            plain)
+      except rdfvalue.DecodeError as e:
+        raise DecryptionError(str(e))
 
     message_list = self.DecompressMessageList(packed_message_list)
 
@@ -544,7 +602,11 @@ class Communicator(object):
     _ = api_version
     result = rdf_flows.GrrMessage.AuthorizationState.UNAUTHENTICATED
 
-    if cipher_verified or cipher.VerifyCipherSignature(remote_public_key):
+    if not cipher_verified:
+      with DecodingStage("verify"):
+        cipher_verified = cipher.VerifyCipherSignature(remote_public_key)
+
+    if cipher_verified:
       stats.STATS.IncrementCounter("grr_authenticated_messages")
       result = rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED
 
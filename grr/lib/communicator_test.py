@@ -79,6 +79,7 @@ class ClientCommsTest(test_lib.GRRBaseTest):
     self.last_urlmock_error = None
 
   def tearDown(self):
+    front_end.StopClientHeartbeatBuffer()
     super(ClientCommsTest, self).tearDown()
     self.config_stubber.Stop()
 
@@ -183,6 +184,141 @@ class ClientCommsTest(test_lib.GRRBaseTest):
           stats.STATS.GetMetricValue(
               "client_pings_by_label", fields=["testlabel"]), 1)
 
+  def testClientHeartbeatBuffer(self):
+    new_client = self.MakeClientAFF4Record()
+    self.server_communicator = front_end.ServerCommunicator(
+        certificate=self.server_certificate,
+        private_key=self.server_private_key,
+        token=self.token,
+        heartbeat_flush_interval=3600)
+    written = stats.STATS.GetMetricValue(
+        "grr_frontendserver_heartbeats_written")
+
+    now = rdfvalue.RDFDatetime.Now()
+    for i in range(3):
+      with test_lib.FakeTime(now + 60 * i):
+        self.ClientServerCommunicate(timestamp=now + 60 * i)
+
+    # Nothing is written before the buffer is flushed.
+    client_obj = aff4.FACTORY.Open(new_client.urn, token=self.token)
+    self.assertIsNone(client_obj.Get(client_obj.Schema.CLOCK))
+
+    self.server_communicator.heartbeat_buffer.Flush()
+
+    client_obj = aff4.FACTORY.Open(new_client.urn, token=self.token)
+    self.assertEqual(
+        client_obj.Get(client_obj.Schema.PING).AsSecondsFromEpoch(),
+        (now + 120).AsSecondsFromEpoch())
+    self.assertEqual(
+        client_obj.Get(client_obj.Schema.CLOCK).AsSecondsFromEpoch(),
+        (now + 120).AsSecondsFromEpoch())
+    self.assertEqual(
+        stats.STATS.GetMetricValue("grr_frontendserver_heartbeats_written"),
+        written + 1)
+
+  def testClientHeartbeatBufferIsShared(self):
+    communicators = [
+        front_end.ServerCommunicator(
+            certificate=self.server_certificate,
+            private_key=self.server_private_key,
+            token=self.token,
+            heartbeat_flush_interval=3600) for _ in range(2)
+    ]
+    heartbeat_buffer = communicators[0].heartbeat_buffer
+    self.assertIs(communicators[1].heartbeat_buffer, heartbeat_buffer)
+    self.assertTrue(heartbeat_buffer.flush_thread.is_alive())
+
+    flush_thread = heartbeat_buffer.flush_thread
+    front_end.StopClientHeartbeatBuffer()
+    self.assertFalse(flush_thread.is_alive())
+    self.assertIsNone(front_end.HEARTBEAT_BUFFER)
+
+  def testDecodingStageTimes(self):
+    self.MakeClientAFF4Record()
+
+    stages = ["cipher", "decrypt", "verify", "decompress", "parse"]
+    counts = [
+        stats.STATS.GetMetricValue(
+            "grr_decoding_stage_time", fields=[stage]).count
+        for stage in stages
+    ]
+
+    self.ClientServerCommunicate()
+
+    for stage, count in zip(stages, counts):
+      self.assertEqual(
+          stats.STATS.GetMetricValue(
+              "grr_decoding_stage_time", fields=[stage]).count, count + 1)
+
+  def testVerifyStageOnlyTimesVerification(self):
+    self.MakeClientAFF4Record()
+    verify_time = stats.STATS.GetMetricValue(
+        "grr_decoding_stage_time", fields=["verify"]).sum
+
+    original_update_client = front_end.ServerCommunicator._UpdateClient.im_func
+
+    def SlowUpdateClient(*args):
+      time.sleep(0.5)
+      return original_update_client(*args)
+
+    with utils.Stubber(front_end.ServerCommunicator, "_UpdateClient",
+                       SlowUpdateClient):
+      self.ClientServerCommunicate()
+
+    self.assertLess(
+        stats.STATS.GetMetricValue(
+            "grr_decoding_stage_time", fields=["verify"]).sum - verify_time,
+        0.5)
+
+  def testCipherDecryptionProcesses(self):
+    self.MakeClientAFF4Record()
+    decryption_pool = front_end.CreateCipherDecryptionPool(
+        1, self.server_private_key)
+    self.server_communicator = front_end.ServerCommunicator(
+        certificate=self.server_certificate,
+        private_key=self.server_private_key,
+        token=self.token,
+        decryption_pool=decryption_pool)
+    try:
+      decoded_messages = self.ClientServerCommunicate()
+      self.assertEqual(decoded_messages[0].auth_state,
+                       rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED)
+      self.assertEqual(len(self.server_communicator.encrypted_cipher_cache), 1)
+
+      # A corrupted cipher is rejected.
+      result = rdf_flows.ClientCommunication.FromSerializedString(
+          self.cipher_text)
+      result.encrypted_cipher = "x" * len(result.encrypted_cipher)
+      self.assertRaises(communicator.DecryptionError,
+                        self.server_communicator.DecodeMessages, result)
+    finally:
+      decryption_pool.terminate()
+
+  def testPrewarmPublicKeyCache(self):
+    new_client = self.MakeClientAFF4Record()
+    with aff4.FACTORY.Open(
+        new_client.urn, mode="rw", token=self.token) as client_object:
+      client_object.Set(client_object.Schema.PING,
+                        rdfvalue.RDFDatetime().FromSecondsFromEpoch(1000))
+
+    self.assertEqual(
+        self.server_communicator.PrewarmPublicKeyCache(
+            [new_client.urn, "aff4:/C.0000000000000001"],
+            rdfvalue.RDFDatetime().FromSecondsFromEpoch(1001)), 0)
+    self.assertEqual(len(self.server_communicator.pub_key_cache), 0)
+
+    self.assertEqual(
+        self.server_communicator.PrewarmPublicKeyCache(
+            [new_client.urn, "aff4:/C.0000000000000001"],
+            rdfvalue.RDFDatetime().FromSecondsFromEpoch(1000)), 1)
+    self.assertIn(str(new_client.urn), self.server_communicator.pub_key_cache)
+
+    # The cached key is used to authenticate the client.
+    with utils.Stubber(aff4.FACTORY, "Create", None):
+      pub_key = self.server_communicator._GetRemotePublicKey(new_client.urn)
+    self.assertEqual(pub_key.SerializeToString(),
+                     self.client_private_key.GetPublicKey().SerializeToString())
+
   def testServerReplayAttack(self):
     """Test that replaying encrypted messages to the server invalidates them."""
     self.MakeClientAFF4Record()
@@ -393,6 +529,7 @@ class HTTPClientTests(test_lib.GRRBaseTest):
     self.server_communicator.client_cache.Put(self.client_cn, self.client)
 
   def tearDown(self):
+    front_end.StopClientHeartbeatBuffer()
     self.requests_stubber.Stop()
     self.out_queue_overrider.Stop()
     self.config_stubber.Stop()
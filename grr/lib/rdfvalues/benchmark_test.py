@@ -5,7 +5,10 @@
 
 from grr.lib import flags
 from grr.lib import type_info
+from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
+from grr.lib.rdfvalues import flows as rdf_flows
+from grr.lib.rdfvalues import paths as rdf_paths
 from grr.lib.rdfvalues import structs as rdf_structs
 from grr.proto import jobs_pb2
 from grr.proto import knowledge_base_pb2
@@ -340,6 +343,68 @@ class RDFValueBenchmark(benchmark_test_lib.AverageMicroBenchmarks):
     self.TimeIt(RDFStructDecodeEncode)
     self.TimeIt(ProtoDecodeEncode)
 
+  def testAcceleratedStructs(self):
+    """Compare the C accelerator to the pure python struct implementation."""
+    pathspec = rdf_paths.PathSpec(
+        path="/usr/lib/libfoo.so.1", pathtype=rdf_paths.PathSpec.PathType.OS)
+    stat_entry = rdf_client.StatEntry(
+        pathspec=pathspec,
+        st_mode=33188,
+        st_ino=1063090,
+        st_dev=64512,
+        st_nlink=1,
+        st_uid=0,
+        st_gid=0,
+        st_size=12345,
+        st_atime=1336469177,
+        st_mtime=1336129892,
+        st_ctime=1336129892)
+    samples = [
+        rdf_flows.GrrMessage(
+            session_id="aff4:/C.0000000000000001/flows/W:ABCDEF",
+            name="StatFile",
+            request_id=1,
+            response_id=2,
+            task_id=12345,
+            payload=stat_entry),
+        stat_entry,
+        rdf_client.BufferReference(
+            offset=1024, length=4096, data="x" * 4096, pathspec=pathspec),
+    ]
+
+    # Swaps in the pure python implementations while active.
+    python_stubber = utils.MultiStubber(
+        *[(rdf_structs, name, implementation)
+          for name, implementation in
+          rdf_structs.PYTHON_IMPLEMENTATIONS.iteritems()])
+
+    implementations = [("Python", python_stubber)]
+    if rdf_structs._semantic:
+      implementations.insert(0, ("Accelerated", None))
+
+    for sample in samples:
+      cls = sample.__class__
+      data = sample.SerializeToString()
+
+      def Parse():
+        cls.FromSerializedString(data)
+
+      def ParseAndSerialize():
+        cls.FromSerializedString(data).SerializeToString()
+
+      for implementation, stubber in implementations:
+        if stubber is not None:
+          stubber.Start()
+
+        try:
+          self.TimeIt(Parse, "%s %s Parse" % (implementation, cls.__name__))
+          self.TimeIt(ParseAndSerialize, "%s %s Parse and Serialize" %
+                      (implementation, cls.__name__))
+        finally:
+          if stubber is not None:
+            stubber.Stop()
+
+
 
 def main(argv):
   # Run the full test suite
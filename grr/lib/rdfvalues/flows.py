@@ -34,6 +34,9 @@ class GrrMessage(rdf_structs.RDFProtoStruct):
   # for this so there can't be more than 8 different levels of priority.
   max_priority = 7
 
+  # Messages are mostly routed or stored again without being modified.
+  retain_serialized = True
+
   def __init__(self,
                initializer=None,
                age=None,
@@ -9,7 +9,7 @@ import struct
 
 # pylint: disable=g-import-not-at-top
 try:
-  from grr.accelerated import _semantic
+  from grr import _semantic
 except ImportError:
   _semantic = None
 
@@ -72,7 +72,7 @@ def ReadTag(buf, pos):
     pos += 1
     return (buf[start:pos], pos)
   except IndexError:
-    raise ValueError("Invalid tag")
+    raise rdfvalue.DecodeError("Invalid tag")
 
 
 # This function is HOT.
@@ -117,16 +117,19 @@ def VarintReader(buf, pos=0):
   """A 64 bit decoder from google.protobuf.internal.decoder."""
   result = 0
   shift = 0
-  while 1:
-    b = buf[pos]
+  try:
+    while 1:
+      b = buf[pos]
 
-    result |= (ORD_MAP_AND_0X7F[b] << shift)
-    pos += 1
-    if not ORD_MAP_AND_0X80[b]:
-      return (result, pos)
-    shift += 7
-    if shift >= 64:
-      raise rdfvalue.DecodeError("Too many bytes when decoding varint.")
+      result |= (ORD_MAP_AND_0X7F[b] << shift)
+      pos += 1
+      if not ORD_MAP_AND_0X80[b]:
+        return (result, pos)
+      shift += 7
+      if shift >= 64:
+        raise rdfvalue.DecodeError("Too many bytes when decoding varint.")
+  except IndexError:
+    raise rdfvalue.DecodeError("Invalid varint.")
 
 
 def SignedVarintReader(buf, pos=0):
@@ -252,11 +255,37 @@ def ReadIntoObject(buff, index, value_obj, length=0):
   value_obj.SetRawData(raw_data)
 
 
+def AcceleratedReadIntoObject(buff, index, value_obj, length=0):
+  """Reads all tags into the value_obj using the C accelerator."""
+  raw_data = value_obj.GetRawData()
+
+  # The accelerator stores all plain and unknown fields in the raw data dict
+  # directly. Only the repeated fields need to be appended here.
+  repeated = _semantic.read_into_dict(buff, index, length,
+                                      value_obj.type_infos_by_encoded_tag,
+                                      raw_data, ProtoList)
+  for type_info_obj, wire_format in repeated:
+    value_obj.Get(type_info_obj.name).wrapped_list.append((None, wire_format))
+
+  value_obj.SetRawData(raw_data)
+
+
+# The pure python implementations of the hot functions. These are replaced by
+# the C accelerator below if it is available.
+PYTHON_IMPLEMENTATIONS = dict(
+    VarintEncode=VarintEncode,
+    VarintReader=VarintReader,
+    SplitBuffer=SplitBuffer,
+    SerializeEntries=SerializeEntries,
+    ReadIntoObject=ReadIntoObject)
+
 # pylint: disable=invalid-name
 if _semantic:
   VarintEncode = _semantic.varint_encode
   VarintReader = _semantic.varint_decode
   SplitBuffer = _semantic.split_buffer
+  SerializeEntries = _semantic.serialize_entries
+  ReadIntoObject = AcceleratedReadIntoObject
 # pylint: enable=invalid-name
 
 
@@ -852,13 +881,18 @@ class ProtoEmbedded(ProtoType):
   def ConvertFromWireFormat(self, value, container=None):
     """The wire format is simply a string."""
     result = self.type()
-    ReadIntoObject(value[2], 0, result)
+    if result.retain_serialized:
+      result.ParseFromString(value[2])
+    else:
+      ReadIntoObject(value[2], 0, result)
 
     return result
 
   def ConvertToWireFormat(self, value):
     """Encode the nested protobuf into wire format."""
-    output = SerializeEntries(value.GetRawData().itervalues())
+    output = value.GetRetainedSerialization()
+    if output is None:
+      output = SerializeEntries(value.GetRawData().itervalues())
     return (self.encoded_tag, VarintEncode(len(output)), output)
 
   def LateBind(self, target=None):
@@ -1545,6 +1579,14 @@ class RDFStruct(rdfvalue.RDFValue):
   # Stores the raw data here.
   _data = None
 
+  # If set, parsed objects keep the buffer they were parsed from and serialize
+  # back to it as long as they are unchanged. This makes routing and storing
+  # messages cheap but keeps the buffer alive as long as the object.
+  retain_serialized = False
+
+  # The retained buffer, if any.
+  _serialized = None
+
   # A list of fields which will be removed from this class's type descriptor
   # set.
   suppressions = []
@@ -1592,6 +1634,7 @@ class RDFStruct(rdfvalue.RDFValue):
 
     """
     self._data = {}
+    self._serialized = None
     for name, (obj, serialized, t_info) in other.GetRawData().iteritems():
       if serialized is None:
         serialized = t_info.ConvertToWireFormat(obj)
@@ -1601,6 +1644,7 @@ class RDFStruct(rdfvalue.RDFValue):
   def Clear(self):
     """Clear all the fields."""
     self._data = {}
+    self._serialized = None
 
   def HasField(self, field_name):
     """Checks if the field exists."""
@@ -1637,6 +1681,7 @@ class RDFStruct(rdfvalue.RDFValue):
     """Make an efficient copy of this protobuf."""
     result = self.__class__()
     result.SetRawData(self._CopyRawData())
+    result._serialized = self.GetRetainedSerialization()  # pylint: disable=protected-access
 
     # The copy should have the same age as us.
     result.age = self.age
@@ -1671,15 +1716,52 @@ class RDFStruct(rdfvalue.RDFValue):
 
   def SetRawData(self, data):
     self._data = data
+    self._serialized = None
     self.dirty = True
 
+  def GetRetainedSerialization(self):
+    """Returns the buffer this object was parsed from if it is still valid.
+
+    Fields are only decoded on access, so the buffer is still valid unless a
+    field was set or one of the decoded fields was modified in place.
+
+    Returns:
+      The serialized string or None.
+    """
+    if self._serialized is None:
+      return None
+
+    for python_format, _, type_descriptor in self._data.itervalues():
+      if python_format is None:
+        continue
+
+      try:
+        if type_descriptor.IsDirty(python_format):
+          self._serialized = None
+          return None
+      except AttributeError:
+        self._serialized = None
+        return None
+
+    return self._serialized
+
   def SerializeToString(self):
+    serialized = self.GetRetainedSerialization()
+    if serialized is not None:
+      return serialized
+
     return SerializeEntries(self._data.itervalues())
 
   def ParseFromString(self, string):
+    # Merging into existing fields can not be represented by the buffer.
+    retain = self.retain_serialized and not self._data
+
     ReadIntoObject(string, 0, self)
     self.dirty = True
 
+    if retain:
+      self._serialized = string
+
   def __eq__(self, other):
     if not isinstance(other, self.__class__):
       return False
@@ -1730,7 +1812,9 @@ class RDFStruct(rdfvalue.RDFValue):
     attr = type_descriptor.name
     # A value of None means we clear the field.
     if value is None:
-      self._data.pop(attr, None)
+      if self._data.pop(attr, None) is not None:
+        self._serialized = None
+        self.dirty = True
       return
 
     # Validate the value and obtain the python format representation.
@@ -1740,6 +1824,7 @@ class RDFStruct(rdfvalue.RDFValue):
     self._data[attr] = (value, None, type_descriptor)
 
     # Make sure to invalidate our parent's cache if needed.
+    self._serialized = None
     self.dirty = True
 
     return value
@@ -1834,6 +1919,7 @@ class RDFStruct(rdfvalue.RDFValue):
     self._data[attr] = (None, value, type_info_obj)
 
     # Make sure to invalidate our parent's cache if needed.
+    self._serialized = None
     self.dirty = True
 
   def ClearFieldsWithLabel(self, label, exceptions=None):
@@ -3,6 +3,8 @@
 """Test RDFStruct implementations."""
 
 
+import random
+import unittest
 
 from google.protobuf import descriptor_pool
 from google.protobuf import message_factory
@@ -10,6 +12,7 @@ from google.protobuf import message_factory
 from grr.lib import flags
 from grr.lib import rdfvalue
 from grr.lib import type_info
+from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.lib.rdfvalues import paths as rdf_paths
@@ -363,6 +366,130 @@ class RDFStructsTest(test_base.RDFValueTestMixin, test_lib.GRRBaseTest):
     # Check that nested fields are also preserved.
     self.assertEqual(decoded_tested.nested.foobar, "goodbye")
 
+  def _DecodeWithImplementations(self, data, implementations):
+    """Splits and parses data, returns the results or DecodeError."""
+    with utils.MultiStubber(*[(structs, name, implementation)
+                              for name, implementation in
+                              implementations.iteritems()]):
+      try:
+        split = list(structs.SplitBuffer(data))
+      except rdfvalue.DecodeError:
+        split = rdfvalue.DecodeError
+      try:
+        # Fields are not converted on serialization so this returns what the
+        # buffer was parsed into.
+        parsed = TestStruct.FromSerializedString(data).SerializeToString()
+      except rdfvalue.DecodeError:
+        parsed = rdfvalue.DecodeError
+    return split, parsed
+
+  @unittest.skipUnless(structs._semantic, "Accelerator is not built.")
+  def testAcceleratorHandlesCorruptedBuffersLikePython(self):
+    tested = TestStruct(foobar="hello", int=5, repeated=["a", "b"])
+    tested.nested.foobar = "goodbye"
+    data = tested.SerializeToString()
+
+    # Every truncation of the buffer.
+    corrupted = [data[:i] for i in range(len(data))]
+    # A varint which is too long, an unsupported wire type and a truncated
+    # varint field.
+    corrupted.extend(["\xff" * 11, data + "\x0b", data + "\x08\xff"])
+    # Random single byte changes.
+    rand = random.Random(0)
+    for _ in range(200):
+      position = rand.randrange(len(data))
+      corrupted.append(data[:position] + chr(rand.randrange(256)) +
+                       data[position + 1:])
+
+    accelerated = dict(
+        SplitBuffer=structs._semantic.split_buffer,
+        ReadIntoObject=structs.AcceleratedReadIntoObject)
+    errors = 0
+    for buff in corrupted:
+      expected = self._DecodeWithImplementations(
+          buff, structs.PYTHON_IMPLEMENTATIONS)
+      self.assertEqual(
+          self._DecodeWithImplementations(buff, accelerated), expected,
+          repr(buff))
+      if expected[0] is rdfvalue.DecodeError:
+        errors += 1
+
+    # Both errors and truncated fields were tested.
+    self.assertTrue(0 < errors < len(corrupted))
+
+  @unittest.skipUnless(structs._semantic, "Accelerator is not built.")
+  def testAcceleratorMatchesPythonImplementation(self):
+    tested = TestStruct(foobar="hello", int=5, repeated=["a", "b"])
+    tested.nested.foobar = "goodbye"
+    tested.repeat_nested = [TestStruct(foobar="Nest%s" % i) for i in range(3)]
+
+    # PartialTest1 has unknown fields which must be preserved.
+    data = PartialTest1.FromSerializedString(
+        tested.SerializeToString()).SerializeToString()
+
+    accelerated = TestStruct.FromSerializedString(data)
+    with utils.MultiStubber(*[(structs, name, implementation)
+                              for name, implementation in
+                              structs.PYTHON_IMPLEMENTATIONS.iteritems()]):
+      pure_python = TestStruct.FromSerializedString(data)
+      pure_python_data = pure_python.SerializeToString()
+
+    self.assertEqual(accelerated.SerializeToString(), pure_python_data)
+    self.assertEqual(accelerated, pure_python)
+    self.assertEqual(accelerated.repeated, ["a", "b"])
+    self.assertEqual(accelerated.repeat_nested[2].foobar, "Nest2")
+    self.assertEqual(
+        sorted(accelerated.GetRawData()), sorted(pure_python.GetRawData()))
+
+    # Modified fields must be serialized again.
+    accelerated.nested.foobar = "changed"
+    accelerated.repeated.Append("c")
+    decoded = TestStruct.FromSerializedString(accelerated.SerializeToString())
+    self.assertEqual(decoded.nested.foobar, "changed")
+    self.assertEqual(decoded.repeated, ["a", "b", "c"])
+
+    self.assertRaises(ValueError, TestStruct.FromSerializedString, data[:-1])
+
+  def testRetainedSerialization(self):
+    message_list = rdf_flows.MessageList(job=[
+        rdf_flows.GrrMessage(
+            session_id="aff4:/F:123456", request_id=i, response_id=i + 1)
+        for i in range(3)
+    ])
+    data = message_list.SerializeToString()
+
+    parsed = rdf_flows.MessageList.FromSerializedString(data)
+    message = parsed.job[1]
+    self.assertEqual(message.request_id, 1)
+    self.assertEqual(message.session_id, "aff4:/F:123456")
+
+    # Reading fields does not invalidate the retained buffer.
+    serialized = message.SerializeToString()
+    self.assertIs(serialized, message.SerializeToString())
+    self.assertIs(serialized, message.Copy().SerializeToString())
+    self.assertEqual(parsed.SerializeToString(), data)
+
+    # Modified messages are serialized again, also when nested.
+    message.response_id = 10
+    self.assertIsNot(serialized, message.SerializeToString())
+    self.assertEqual(
+        rdf_flows.MessageList.FromSerializedString(parsed.SerializeToString())
+        .job[1].response_id, 10)
+
+    parsed.job[2].payload = rdf_client.User(username="user")
+    reparsed = rdf_flows.MessageList.FromSerializedString(
+        parsed.SerializeToString())
+    self.assertEqual(reparsed.job[2].payload.username, "user")
+    self.assertEqual(reparsed.job[0].request_id, 0)
+
+    # Clearing a field also invalidates the buffer.
+    message = rdf_flows.GrrMessage.FromSerializedString(
+        message_list.job[0].SerializeToString())
+    message.session_id = None
+    self.assertFalse(
+        rdf_flows.GrrMessage.FromSerializedString(
+            message.SerializeToString()).HasField("session_id"))
+
   def testRDFStruct(self):
     tested = TestStruct()
 
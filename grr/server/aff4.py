@@ -583,7 +583,8 @@ class Factory(object):
            new_urn,
            age=NEWEST_TIME,
            limit=None,
-           update_timestamps=False):
+           update_timestamps=False,
+           mutation_pool=None):
     """Make a copy of one AFF4 object to a different URN."""
     new_urn = rdfvalue.RDFURN(new_urn)
 
@@ -603,10 +604,61 @@ class Factory(object):
         values.setdefault(predicate, []).append((value, ts))
 
     if values:
+      if mutation_pool is not None:
+        mutation_pool.MultiSet(new_urn, values, replace=False)
+        self._UpdateChildIndex(new_urn, mutation_pool)
+        return
+
       with data_store.DB.GetMutationPool() as pool:
         pool.MultiSet(new_urn, values, replace=False)
         self._UpdateChildIndex(new_urn, pool)
 
+  def MultiCopy(self, copies, update_timestamps=False, mutation_pool=None):
+    """Makes copies of the latest versions of several AFF4 objects.
+
+    All the source objects are read in a single data store request and all
+    copies are written to the same mutation pool.
+
+    Args:
+      copies: A list of (old_urn, new_urn, attributes) tuples. attributes is
+          a dict of Attribute objects to values that are written to the copy
+          instead of the copied values, or None.
+      update_timestamps: If True, the copied values get the current time as
+          their timestamp.
+      mutation_pool: An optional MutationPool object to write to. If not given,
+          a new pool is used and flushed.
+    """
+    if mutation_pool is None:
+      with data_store.DB.GetMutationPool() as pool:
+        self.MultiCopy(
+            copies, update_timestamps=update_timestamps, mutation_pool=pool)
+      return
+
+    old_urns = set(rdfvalue.RDFURN(old_urn) for old_urn, _, _ in copies)
+    sources = {}
+    for subject, values in data_store.DB.MultiResolvePrefix(
+        old_urns, AFF4_PREFIXES, timestamp=self.ParseAgeSpecification(
+            NEWEST_TIME)):
+      sources[rdfvalue.RDFURN(subject)] = values
+
+    for old_urn, new_urn, attributes in copies:
+      source_values = sources.get(rdfvalue.RDFURN(old_urn))
+      if not source_values:
+        continue
+
+      values = {}
+      for predicate, value, ts in source_values:
+        if update_timestamps:
+          ts = None
+        values.setdefault(predicate, []).append((value, ts))
+
+      for attribute, value in (attributes or {}).iteritems():
+        values[attribute.predicate] = [(value.SerializeToDataStore(), None)]
+
+      new_urn = rdfvalue.RDFURN(new_urn)
+      mutation_pool.MultiSet(new_urn, values, replace=False)
+      self._UpdateChildIndex(new_urn, mutation_pool)
+
   def Open(self,
            urn,
            aff4_type=None,
@@ -2717,8 +2769,12 @@ class AFF4ImageBase(AFF4Stream):
   # Subclasses should set the name of the type of stream to use for chunks.
   STREAM_TYPE = None
 
-  # How many chunks should be cached.
+  # How many chunks are read ahead. While reads are sequential, the read-ahead
+  # doubles up to MAX_LOOK_AHEAD chunks. Two windows of read-ahead have to fit
+  # into the chunk cache.
   LOOK_AHEAD = 10
+  MAX_LOOK_AHEAD = 40
+  CHUNK_CACHE_SIZE = 100
 
   class SchemaCls(AFF4Stream.SchemaCls):
     """The schema for AFF4ImageBase."""
@@ -2797,7 +2853,8 @@ class AFF4ImageBase(AFF4Stream):
     super(AFF4ImageBase, self).Initialize()
     self.offset = 0
     # A cache for segments.
-    self.chunk_cache = ChunkCache(self._WriteChunk, 100)
+    self.chunk_cache = ChunkCache(self._WriteChunk, self.CHUNK_CACHE_SIZE)
+    self._InitializeReadAhead()
 
     if "r" in self.mode:
       self.size = int(self.Get(self.Schema.SIZE))
@@ -2842,10 +2899,112 @@ class AFF4ImageBase(AFF4Stream):
     self.offset = offset
     self.chunk_cache.Flush()
 
+  def _InitializeReadAhead(self):
+    self._look_ahead = self.LOOK_AHEAD
+    # The first chunk after the ones read or being read ahead.
+    self._look_ahead_end = None
+    # The first chunk and the thread of a background read-ahead.
+    self._background_read = None
+
   def _ReadChunk(self, chunk):
     self._ReadChunks([chunk])
     return self.chunk_cache.Get(chunk)
 
+  def _GetChunkCount(self):
+    return (self.size + self.chunksize - 1) // self.chunksize
+
+  def _GetCachedChunk(self, chunk):
+    """Returns the cached chunk number chunk, raises KeyError if not cached."""
+    return self.chunk_cache.Get(chunk)
+
+  def _GetChunkReadArgs(self, chunks):
+    """Returns the arguments for _ReadChunks to read the given chunk numbers.
+
+    This is called on the reading thread, _ReadChunks might not be.
+
+    Args:
+      chunks: A list of chunk numbers.
+
+    Returns:
+      The list of chunks argument to _ReadChunks.
+    """
+    return [chunk for chunk in chunks if chunk not in self.chunk_cache]
+
+  def _ReadChunksInBackground(self, chunks_arg):
+    try:
+      self._ReadChunks(chunks_arg)
+    except Exception as e:  # pylint: disable=broad-except
+      # The chunks will be read again when they are needed.
+      logging.debug("Background read-ahead of %s failed: %s", self.urn, e)
+
+  def _StartBackgroundRead(self):
+    """Reads the next window of chunks in a background thread."""
+    self._look_ahead = min(self._look_ahead * 2, self.MAX_LOOK_AHEAD)
+    start = self._look_ahead_end
+    self._look_ahead_end = min(start + self._look_ahead, self._GetChunkCount())
+    if start >= self._look_ahead_end:
+      return
+
+    chunks_arg = self._GetChunkReadArgs(range(start, self._look_ahead_end))
+    thread = threading.Thread(
+        target=self._ReadChunksInBackground,
+        args=(chunks_arg,),
+        name="AFF4ImageReadAhead")
+    thread.daemon = True
+    thread.start()
+    self._background_read = (start, thread)
+
+  def _GetChunkForReading(self, chunk):
+    """Returns the relevant chunk from the datastore and reads ahead.
+
+    The most common read access pattern is contiguous reading, so when we have
+    to go to the data store we read ahead to reduce round trips. While the
+    reads stay sequential, the read-ahead grows and, for objects opened for
+    reading only, the next window is read in the background while the current
+    one is consumed.
+
+    Args:
+      chunk: The number of the chunk to return.
+
+    Returns:
+      The chunk.
+
+    Raises:
+      ChunkNotFoundError: The chunk does not exist.
+    """
+    if self._background_read and chunk >= self._background_read[0]:
+      self._background_read[1].join()
+      self._background_read = None
+
+    try:
+      fd = self._GetCachedChunk(chunk)
+    except KeyError:
+      if chunk == self._look_ahead_end:
+        self._look_ahead = min(self._look_ahead * 2, self.MAX_LOOK_AHEAD)
+      else:
+        self._look_ahead = self.LOOK_AHEAD
+
+      self._look_ahead_end = min(chunk + self._look_ahead,
+                                 max(self._GetChunkCount(), chunk + 1))
+      self._ReadChunks(
+          self._GetChunkReadArgs(range(chunk, self._look_ahead_end)))
+
+      # This should work now - otherwise we just give up.
+      try:
+        return self._GetCachedChunk(chunk)
+      except KeyError:
+        raise ChunkNotFoundError("Cannot open chunk %s" % chunk)
+
+    # Keep one window read ahead of a sequential reader which has entered the
+    # last window read.
+    if (self.mode == "r" and not self._background_read and
+        self._look_ahead > self.LOOK_AHEAD and
+        self._look_ahead_end is not None and
+        chunk >= self._look_ahead_end - self._look_ahead):
+      self._StartBackgroundRead()
+
+    return fd
+
   def _ReadChunks(self, chunks):
     chunk_names = {
         self.urn.Add(self.CHUNK_ID_TEMPLATE % chunk): chunk
@@ -2888,29 +3047,6 @@ class AFF4ImageBase(AFF4Stream):
     self.chunk_cache.Put(chunk, fd)
     return fd
 
-  def _GetChunkForReading(self, chunk):
-    """Returns the relevant chunk from the datastore and reads ahead."""
-    try:
-      return self.chunk_cache.Get(chunk)
-    except KeyError:
-      pass
-
-    # We don't have this chunk already cached. The most common read
-    # access pattern is contiguous reading so since we have to go to
-    # the data store already, we read ahead to reduce round trips.
-
-    missing_chunks = []
-    for chunk_number in range(chunk, chunk + self.LOOK_AHEAD):
-      if chunk_number not in self.chunk_cache:
-        missing_chunks.append(chunk_number)
-
-    self._ReadChunks(missing_chunks)
-    # This should work now - otherwise we just give up.
-    try:
-      return self.chunk_cache.Get(chunk)
-    except KeyError:
-      raise ChunkNotFoundError("Cannot open chunk %s" % chunk)
-
   def _ReadPartial(self, length):
     """Read as much as possible, but not more than length."""
     chunk = self.offset / self.chunksize
@@ -2942,7 +3078,7 @@ class AFF4ImageBase(AFF4Stream):
 
   def Read(self, length):
     """Read a block of data from the file."""
-    result = ""
+    result = []
 
     # The total available size in the file
     length = int(length)
@@ -2954,8 +3090,8 @@ class AFF4ImageBase(AFF4Stream):
         break
 
       length -= len(data)
-      result += data
-    return result
+      result.append(data)
+    return "".join(result)
 
   def _WritePartial(self, data):
     """Writes at most one chunk of data."""
@@ -3011,12 +3147,14 @@ class AFF4ImageBase(AFF4Stream):
       self.chunk_cache.Flush()
       res = self.__dict__.copy()
       del res["chunk_cache"]
+      res.pop("_background_read", None)
       return res
     return self.__dict__
 
   def __setstate__(self, state):
     self.__dict__ = state
-    self.chunk_cache = ChunkCache(self._WriteChunk, 100)
+    self.chunk_cache = ChunkCache(self._WriteChunk, self.CHUNK_CACHE_SIZE)
+    self._InitializeReadAhead()
 
 
 class AFF4Image(AFF4ImageBase):
@@ -433,6 +433,11 @@ class VFSMemoryFile(aff4.AFF4MemoryStream):
 class GRRForeman(aff4.AFF4Object):
   """The foreman starts flows for clients depending on rules."""
 
+  # The last rules compiled in this process as (serialized rules, compiled
+  # rules). Foreman objects are reopened regularly, the rules only need to be
+  # compiled again when they have changed.
+  _compiled_rules_cache = (None, None)
+
   class SchemaCls(aff4.AFF4Object.SchemaCls):
     """Attributes specific to VFSDirectory."""
     RULES = aff4.Attribute(
@@ -473,24 +478,40 @@ class GRRForeman(aff4.AFF4Object):
       self.Set(self.Schema.RULES, new_rules)
       self.Flush()
 
-  def _CheckIfHuntTaskWasAssigned(self, client_id, hunt_id):
-    """Will return True if hunt's task was assigned to this client before."""
-    for _ in aff4.FACTORY.Stat(
-        [client_id.Add("flows/%s:hunt" % rdfvalue.RDFURN(hunt_id).Basename())]):
-      return True
+  def _HuntTaskURN(self, client_id, hunt_id):
+    return client_id.Add("flows/%s:hunt" % rdfvalue.RDFURN(hunt_id).Basename())
+
+  def _GetAssignedHunts(self, rules, client_id):
+    """Returns the ids of the hunts of the rules started on the client before.
+
+    Args:
+      rules: The rules whose hunts to check.
+      client_id: The client id.
 
-    return False
+    Returns:
+      A set of hunt id strings.
+    """
+    hunt_ids = {}
+    for rule in rules:
+      for action in rule.actions:
+        if action.HasField("hunt_id"):
+          urn = self._HuntTaskURN(client_id, action.hunt_id)
+          hunt_ids[urn] = str(action.hunt_id)
 
-  def _EvaluateRules(self, objects, rule, client_id):
-    """Evaluates the rules."""
-    return rule.client_rule_set.Evaluate(objects, client_id)
+    assigned = set()
+    if hunt_ids:
+      for metadata in aff4.FACTORY.Stat(list(hunt_ids)):
+        assigned.add(hunt_ids[metadata["urn"]])
+    return assigned
 
-  def _RunActions(self, rule, client_id):
+  def _RunActions(self, rule, client_id, assigned_hunts):
     """Run all the actions specified in the rule.
 
     Args:
       rule: Rule which actions are to be executed.
       client_id: Id of a client where rule's actions are to be executed.
+      assigned_hunts: A set of ids of hunts already started on the client.
+          Hunts started here are added.
 
     Returns:
       Number of actions started.
@@ -504,7 +525,7 @@ class GRRForeman(aff4.AFF4Object):
         token.username = "Foreman"
 
         if action.HasField("hunt_id"):
-          if self._CheckIfHuntTaskWasAssigned(client_id, action.hunt_id):
+          if str(action.hunt_id) in assigned_hunts:
             logging.info("Foreman: ignoring hunt %s on client %s: was started "
                          "here before", client_id, action.hunt_id)
           else:
@@ -513,6 +534,7 @@ class GRRForeman(aff4.AFF4Object):
 
             flow_cls = flow.GRRFlow.classes[action.hunt_name]
             flow_cls.StartClients(action.hunt_id, [client_id])
+            assigned_hunts.add(str(action.hunt_id))
             actions_count += 1
         else:
           flow.GRRFlow.StartFlow(
@@ -529,6 +551,38 @@ class GRRForeman(aff4.AFF4Object):
 
     return actions_count
 
+  def _GetCompiledRules(self):
+    """Returns a list of (rule, predicate, paths to check) for all rules."""
+    rules = self.Get(self.Schema.RULES)
+    if not rules:
+      return []
+
+    cached_rules, compiled = getattr(self, "_compiled_rules", (None, None))
+    if cached_rules is rules:
+      return compiled
+
+    serialized = rules.SerializeToString()
+    cached_serialized, compiled = GRRForeman._compiled_rules_cache
+    if cached_serialized != serialized:
+      compiled = [(rule, rule.client_rule_set.Compile(),
+                   rule.client_rule_set.GetPathsToCheck()) for rule in rules]
+      GRRForeman._compiled_rules_cache = (serialized, compiled)
+
+    self._compiled_rules = (rules, compiled)
+    return compiled
+
+  def _GetLastForemanTime(self, client_id):
+    """Reads only the time of the last rule checked from the client."""
+    attribute = VFSGRRClient.SchemaCls.LAST_FOREMAN_TIME
+    value, _ = data_store.DB.Resolve(client_id, attribute.predicate)
+    if value is None:
+      return 0
+
+    try:
+      return int(attribute.attribute_type.FromDatastoreValue(value))
+    except (ValueError, TypeError, rdfvalue.DecodeError):
+      return 0
+
   def AssignTasksToClient(self, client_id):
     """Examines our rules and starts up flows based on the client.
 
@@ -540,24 +594,25 @@ class GRRForeman(aff4.AFF4Object):
     """
     client_id = rdf_client.ClientURN(client_id)
 
-    rules = self.Get(self.Schema.RULES)
-    if not rules:
+    compiled_rules = self._GetCompiledRules()
+    if not compiled_rules:
       return 0
 
-    client = aff4.FACTORY.Open(client_id, mode="rw", token=self.token)
-    try:
-      last_foreman_run = client.Get(client.Schema.LAST_FOREMAN_TIME) or 0
-    except AttributeError:
-      last_foreman_run = 0
+    last_foreman_run = self._GetLastForemanTime(client_id)
+    latest_rule = max(rule.created for rule, _, _ in compiled_rules)
 
-    latest_rule = max(rule.created for rule in rules)
-
-    if latest_rule <= int(last_foreman_run):
+    if latest_rule <= last_foreman_run:
       return 0
 
-    # Update the latest checked rule on the client.
-    client.Set(client.Schema.LAST_FOREMAN_TIME(latest_rule))
-    client.Close()
+    # Update the latest checked rule on the client without reading it.
+    with aff4.FACTORY.Create(
+        client_id,
+        VFSGRRClient,
+        mode="w",
+        force_new_version=False,
+        object_exists=True,
+        token=self.token) as client:
+      client.Set(client.Schema.LAST_FOREMAN_TIME(latest_rule))
 
     # For efficiency we collect all the objects we want to open first and then
     # open them all in one round trip.
@@ -567,16 +622,16 @@ class GRRForeman(aff4.AFF4Object):
 
     now = time.time() * 1e6
 
-    for rule in rules:
+    for rule, predicate, paths in compiled_rules:
       if rule.expires < now:
         expired_rules = True
         continue
-      if rule.created <= int(last_foreman_run):
+      if rule.created <= last_foreman_run:
         continue
 
-      relevant_rules.append(rule)
+      relevant_rules.append((rule, predicate))
 
-      for path in rule.client_rule_set.GetPathsToCheck():
+      for path in paths:
         aff4_object = client_id.Add(path)
         object_urns[str(aff4_object)] = aff4_object
 
@@ -585,10 +640,16 @@ class GRRForeman(aff4.AFF4Object):
     for fd in aff4.FACTORY.MultiOpen(object_urns, token=self.token):
       objects[fd.urn] = fd
 
+    matching_rules = [
+        rule for rule, predicate in relevant_rules
+        if predicate(objects, client_id)
+    ]
+
     actions_count = 0
-    for rule in relevant_rules:
-      if self._EvaluateRules(objects, rule, client_id):
-        actions_count += self._RunActions(rule, client_id)
+    if matching_rules:
+      assigned_hunts = self._GetAssignedHunts(matching_rules, client_id)
+      for rule in matching_rules:
+        actions_count += self._RunActions(rule, client_id, assigned_hunts)
 
     if expired_rules:
       self.ExpireRules()
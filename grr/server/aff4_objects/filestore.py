@@ -13,10 +13,13 @@ from grr.lib import fingerprint
 from grr.lib import rdfvalue
 from grr.lib import registry
 from grr.lib.rdfvalues import nsrl as rdf_nsrl
+from grr.lib.rdfvalues import stats as rdf_stats
 from grr.server import access_control
 from grr.server import aff4
 from grr.server import data_store
+from grr.server import sequential_collection
 from grr.server.aff4_objects import aff4_grr
+from grr.server.aff4_objects import standard
 
 
 class FileStore(aff4.AFF4Volume):
@@ -42,8 +45,14 @@ class FileStore(aff4.AFF4Volume):
         yield child
 
   def AddURNToIndex(self, sha256hash, file_urn):
-    for child in self.GetChildrenByPriority():
-      child.AddURN(sha256hash, file_urn)
+    self.AddURNsToIndex([(sha256hash, file_urn)])
+
+  def AddURNsToIndex(self, hashes_and_urns):
+    """Adds a list of (sha256hash, file_urn) tuples to the children's indexes."""
+    children = list(self.GetChildrenByPriority())
+    for sha256hash, file_urn in hashes_and_urns:
+      for child in children:
+        child.AddURN(sha256hash, file_urn)
 
   def AddURN(self, sha256hash, file_urn):
     pass
@@ -176,10 +185,18 @@ class FileStoreHash(rdfvalue.RDFURN):
     self.fingerprint_type, self.hash_type, self.hash_value = relative_path
 
 
+class FileStoreAdditionsCollection(sequential_collection.SequentialCollection):
+  """Class name (label) and size (x_value) of files new to the file store."""
+  RDF_TYPE = rdf_stats.Sample
+
+
 class HashFileStore(FileStore):
   """FileStore that stores files referenced by hash."""
 
   PATH = rdfvalue.RDFURN("aff4:/files/hash")
+  # Every new canonical file is recorded here so that the filestore statistics
+  # can be updated without listing the whole store.
+  ADDITIONS_URN = PATH.Add("additions")
   PRIORITY = 2
   EXTERNAL = False
   HASH_TYPES = {
@@ -198,7 +215,11 @@ class HashFileStore(FileStore):
     # index_urn = self.PATH.Add("generic/sha256").Add(sha256hash)
     # self._AddToIndex(index_urn, file_urn)
 
-  def _AddToIndex(self, index_urn, file_urn):
+  def _AddToIndex(self, index_urn, file_urn, mutation_pool=None):
+    if mutation_pool is not None:
+      mutation_pool.FileHashIndexAddItem(index_urn, file_urn)
+      return
+
     with data_store.DB.GetMutationPool() as mutation_pool:
       mutation_pool.FileHashIndexAddItem(index_urn, file_urn)
 
@@ -273,22 +294,50 @@ class HashFileStore(FileStore):
         if hasattr(hashlib, hash_type)
     ]
 
+  def _GetStoredHashes(self, fd):
+    """Returns the hashes of a stored file with the same contents as fd.
+
+    The hashes reported by the client are not trusted, the sha256 is only used
+    to find the canonical file it claims to match. Blobs are named by the
+    sha256 of their contents, so if the canonical file consists of exactly the
+    same blobs it has the same contents and the hashes computed when it was
+    added apply to fd as well.
+
+    Args:
+      fd: The file to add to the store.
+
+    Returns:
+      A Hash object or None if there is no such file in the store.
+    """
+    client_hashes = fd.Get(fd.Schema.HASH)
+    if (not isinstance(fd, standard.BlobImage) or not client_hashes or
+        not client_hashes.sha256):
+      return None
+
+    canonical_urn = self.PATH.Add("generic/sha256").Add(
+        str(client_hashes.sha256))
+    try:
+      canonical_fd = aff4.FACTORY.Open(
+          canonical_urn, aff4_type=standard.BlobImage, token=self.token)
+    except IOError:
+      return None
+
+    if (canonical_fd.size != fd.size or
+        canonical_fd.chunksize != fd.chunksize or
+        canonical_fd.Get(canonical_fd.Schema.HASHES) != fd.Get(
+            fd.Schema.HASHES)):
+      return None
+
+    hashes = canonical_fd.Get(canonical_fd.Schema.HASH)
+    if not hashes or hashes.sha256 != client_hashes.sha256:
+      return None
+    return hashes.Copy()
+
   def _HashFile(self, fd):
     """Look for the required hashes in the file."""
-    hashes = fd.Get(fd.Schema.HASH)
+    hashes = self._GetStoredHashes(fd)
     if hashes:
-      found_all = True
-      for fingerprint_type, hash_types in self.HASH_TYPES.iteritems():
-        for hash_type in hash_types:
-          if fingerprint_type == "pecoff":
-            hash_type = "pecoff_%s" % hash_type
-          if not hashes.HasField(hash_type):
-            found_all = False
-            break
-        if not found_all:
-          break
-      if found_all:
-        return hashes
+      return hashes
 
     fingerprinter = fingerprint.Fingerprinter(fd)
     if "generic" in self.HASH_TYPES:
@@ -299,9 +348,8 @@ class HashFileStore(FileStore):
       if hashers:
         fingerprinter.EvalPecoff(hashers=hashers)
 
-    if not hashes:
-      hashes = fd.Schema.HASH()
-
+    # Hashes reported by the client are replaced, they were not verified.
+    hashes = fd.Schema.HASH()
     for result in fingerprinter.HashIt():
       fingerprint_type = result["name"]
       for hash_type in self.HASH_TYPES[fingerprint_type]:
@@ -379,15 +427,29 @@ class HashFileStore(FileStore):
 
     # sha256 is the canonical location.
     canonical_urn = self.PATH.Add("generic/sha256").Add(str(hashes.sha256))
-    if not list(aff4.FACTORY.Stat(canonical_urn)):
-      aff4.FACTORY.Copy(fd.urn, canonical_urn)
-      # Remove the STAT entry, it makes no sense to copy it between clients.
-      with aff4.FACTORY.Open(
-          canonical_urn, mode="rw", token=self.token) as new_fd:
-        new_fd.Set(new_fd.Schema.STAT(None))
+    with data_store.DB.GetMutationPool() as mutation_pool:
+      if not list(aff4.FACTORY.Stat(canonical_urn)):
+        aff4.FACTORY.Copy(fd.urn, canonical_urn, mutation_pool=mutation_pool)
+        # Remove the STAT entry, it makes no sense to copy it between clients.
+        mutation_pool.Set(
+            canonical_urn, fd.Schema.STAT, fd.Schema.STAT(), replace=False)
+
+        FileStoreAdditionsCollection.StaticAdd(
+            self.ADDITIONS_URN,
+            rdf_stats.Sample(
+                label=fd.__class__.__name__, x_value=fd.Get(fd.Schema.SIZE)),
+            mutation_pool=mutation_pool)
+
+      self._AddToIndex(canonical_urn, fd.urn, mutation_pool=mutation_pool)
+      # The symlinks are written for every hit, their index entries record when
+      # a hash was last seen.
+      self._AddSymlinks(hashes, canonical_urn, mutation_pool)
 
-    self._AddToIndex(canonical_urn, fd.urn)
+    # We do not want to be externally written here.
+    return None
 
+  def _AddSymlinks(self, hashes, canonical_urn, mutation_pool):
+    """Links all hashes other than the sha256 to the canonical file."""
     for hash_type, hash_digest in hashes.ListSetFields():
       # Determine fingerprint type.
       hash_type = hash_type.name
@@ -406,12 +468,12 @@ class HashFileStore(FileStore):
           hash_digest)
 
       with aff4.FACTORY.Create(
-          file_store_urn, aff4.AFF4Symlink, token=self.token) as symlink:
+          file_store_urn,
+          aff4.AFF4Symlink,
+          mutation_pool=mutation_pool,
+          token=self.token) as symlink:
         symlink.Set(symlink.Schema.SYMLINK_TARGET, canonical_urn)
 
-    # We do not want to be externally written here.
-    return None
-
   @staticmethod
   def ListHashes(age=aff4.NEWEST_TIME):
     """Yields all the hashes in the file store.
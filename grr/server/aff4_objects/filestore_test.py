@@ -9,9 +9,11 @@ import time
 from grr.lib import flags
 from grr.lib import rdfvalue
 from grr.lib import utils
+from grr.lib.rdfvalues import crypto as rdf_crypto
 from grr.lib.rdfvalues import file_finder as rdf_file_finder
 from grr.lib.rdfvalues import paths as rdf_paths
 from grr.server import aff4
+from grr.server import data_store
 from grr.server.aff4_objects import aff4_grr
 from grr.server.aff4_objects import filestore
 from grr.server.aff4_objects import filestore_test_lib
@@ -384,6 +386,85 @@ class HashFileStoreTest(aff4_test_lib.AFF4ObjectTest):
     self.assertEqual(
         fd1.Get(fd1.Schema.CONTENT_LAST), fd2.Get(fd2.Schema.CONTENT_LAST))
 
+  def _CreateBlobImage(self, path, data, client_hash=None):
+    urn = self.client_id.Add("fs/os").Add(path)
+    with aff4.FACTORY.Create(
+        urn, aff4_grr.VFSBlobImage, token=self.token) as fd:
+      fd.SetChunksize(10)
+      for i in range(0, len(data), 10):
+        chunk = data[i:i + 10]
+        digest = data_store.DB.StoreBlob(chunk, token=self.token)
+        fd.AddBlob(digest.decode("hex"), len(chunk))
+      if client_hash:
+        fd.Set(fd.Schema.HASH, client_hash)
+    return aff4.FACTORY.Open(urn, mode="rw", token=self.token)
+
+  def _AddToHashFileStore(self, fd):
+    hash_fs = aff4.FACTORY.Open(
+        filestore.HashFileStore.PATH,
+        filestore.HashFileStore,
+        token=self.token)
+    hash_fs.AddFile(fd)
+
+  def testHashesOfStoredFileWithSameBlobsAreReused(self):
+    data = "0123456789" * 5 + "abc"
+    fd = self._CreateBlobImage("first", data)
+    self._AddToHashFileStore(fd)
+    hashes = fd.Get(fd.Schema.HASH)
+    self.assertEqual(hashes.sha256, hashlib.sha256(data).digest())
+
+    client_hash = rdf_crypto.Hash(sha256=hashes.sha256)
+    fd = self._CreateBlobImage("second", data, client_hash=client_hash)
+    with utils.Stubber(filestore.fingerprint.Fingerprinter, "HashIt",
+                       lambda _: self.fail("File was hashed again.")):
+      self._AddToHashFileStore(fd)
+
+    self.assertEqual(fd.Get(fd.Schema.HASH), hashes)
+
+  def testClientHashIsNotTrustedForDifferentContents(self):
+    data = "0123456789" * 5 + "abc"
+    fd = self._CreateBlobImage("first", data)
+    self._AddToHashFileStore(fd)
+    hashes = fd.Get(fd.Schema.HASH)
+
+    # The client claims that this file has the hash of the stored one.
+    other_data = "9876543210" * 5 + "abc"
+    fd = self._CreateBlobImage(
+        "second", other_data, client_hash=rdf_crypto.Hash(sha256=hashes.sha256))
+    self._AddToHashFileStore(fd)
+
+    self.assertEqual(
+        fd.Get(fd.Schema.HASH).sha256, hashlib.sha256(other_data).digest())
+    canonical_fd = aff4.FACTORY.Open(
+        filestore.HashFileStore.PATH.Add("generic/sha256").Add(
+            str(hashes.sha256)),
+        token=self.token)
+    self.assertEqual(canonical_fd.Read(100), data)
+
+  def testForgedClientHashesAreReplaced(self):
+    data = "0123456789" * 5 + "abc"
+    forged_sha1 = hashlib.sha1("forged").digest()
+    client_hash = rdf_crypto.Hash(
+        sha256=hashlib.sha256("forged").digest(), pecoff_sha1=forged_sha1)
+    client_hash.signed_data.Append(
+        revision=1, cert_type=2, certificate="forged certificate")
+
+    # The file is not a PE file so it doesn't have any pecoff hashes.
+    fd = self._CreateBlobImage("forged", data, client_hash=client_hash)
+    self._AddToHashFileStore(fd)
+
+    hashes = fd.Get(fd.Schema.HASH)
+    self.assertEqual(hashes.sha256, hashlib.sha256(data).digest())
+    self.assertFalse(hashes.HasField("pecoff_sha1"))
+    self.assertFalse(hashes.signed_data)
+
+    self.assertRaises(
+        IOError,
+        aff4.FACTORY.Open,
+        filestore.HashFileStore.PATH.Add("pecoff/sha1").Add(str(forged_sha1)),
+        aff4_type=aff4.AFF4Symlink,
+        token=self.token)
+
   def testEmptyFileHasNoBackreferences(self):
 
     # First make sure we store backrefs for a non empty file.
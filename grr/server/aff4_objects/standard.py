@@ -105,7 +105,7 @@ class BlobImage(aff4.AFF4ImageBase):
   _HASH_SIZE = 32
 
   # How many chunks we read ahead
-  _READAHEAD = 5
+  LOOK_AHEAD = 5
 
   @classmethod
   def _GenerateChunkIds(cls, fds):
@@ -186,34 +186,31 @@ class BlobImage(aff4.AFF4ImageBase):
     """Chunks must be added using the AddBlob() method."""
     raise NotImplementedError("Direct writing of BlobImage not allowed.")
 
-  def _GetChunkForReading(self, chunk):
-    """Retrieve the relevant blob from the AFF4 data store or cache."""
-    offset = chunk * self._HASH_SIZE
-    self.index.seek(offset)
-
-    chunk_name = self.index.read(self._HASH_SIZE).encode("hex")
-
-    try:
-      return self.chunk_cache.Get(chunk_name)
-    except KeyError:
-      pass
-
-    # We don't have this chunk already cached. The most common read
-    # access pattern is contiguous reading so since we have to go to
-    # the data store already, we read ahead to reduce round trips.
-    self.index.seek(offset)
-    readahead = []
-
-    for _ in range(self._READAHEAD):
-      name = self.index.read(self._HASH_SIZE).encode("hex")
-      if name and name not in self.chunk_cache:
-        readahead.append(name)
-
-    self._ReadChunks(readahead)
-    try:
-      return self.chunk_cache.Get(chunk_name)
-    except KeyError:
-      raise aff4.ChunkNotFoundError("Cannot open chunk %s" % chunk)
+  def _GetChunkCount(self):
+    return len(self.index.getvalue()) // self._HASH_SIZE
+
+  def _GetChunkNames(self, chunks):
+    """Returns the blob hashes of the given chunk numbers."""
+    index = self.index.getvalue()
+    names = []
+    for chunk in chunks:
+      name = index[chunk * self._HASH_SIZE:(chunk + 1) * self._HASH_SIZE]
+      if name:
+        names.append(name.encode("hex"))
+    return names
+
+  def _GetCachedChunk(self, chunk):
+    """Retrieve the relevant blob from the cache."""
+    chunk_names = self._GetChunkNames([chunk])
+    if not chunk_names:
+      raise KeyError(chunk)
+    return self.chunk_cache.Get(chunk_names[0])
+
+  def _GetChunkReadArgs(self, chunks):
+    return [
+        name for name in self._GetChunkNames(chunks)
+        if name not in self.chunk_cache
+    ]
 
   def _ReadChunks(self, chunks):
     res = data_store.DB.ReadBlobs(chunks, token=self.token)
@@ -313,8 +310,6 @@ class AFF4SparseImage(aff4.AFF4ImageBase):
 
   _HASH_SIZE = 32
 
-  _READAHEAD = 10
-
   chunksize = 512 * 1024
 
   class SchemaCls(aff4.AFF4ImageBase.SchemaCls):
@@ -369,28 +364,8 @@ class AFF4SparseImage(aff4.AFF4ImageBase):
           res[chunk_names[obj.urn]] = hsh.encode("hex")
     return res
 
-  def _GetChunkForReading(self, chunk):
-    """Returns the relevant chunk from the datastore and reads ahead."""
-    try:
-      return self.chunk_cache.Get(chunk)
-    except KeyError:
-      pass
-
-    # We don't have this chunk already cached. The most common read
-    # access pattern is contiguous reading so since we have to go to
-    # the data store already, we read ahead to reduce round trips.
-
-    missing_chunks = []
-    for chunk_number in range(chunk, chunk + 10):
-      if chunk_number not in self.chunk_cache:
-        missing_chunks.append(chunk_number)
-
-    self._ReadChunks(missing_chunks)
-    # This should work now - otherwise we just give up.
-    try:
-      return self.chunk_cache.Get(chunk)
-    except KeyError:
-      raise aff4.ChunkNotFoundError("Cannot open chunk %s" % chunk)
+  def _GetChunkCount(self):
+    return self.last_chunk + 1
 
   def _GetChunkForWriting(self, chunk):
     """Returns the relevant chunk from the datastore."""
@@ -3,6 +3,7 @@
 
 
 from grr.lib.rdfvalues import client as rdf_client
+from grr.lib.rdfvalues import protodict as rdf_protodict
 from grr.lib.rdfvalues import stats
 from grr.server import aff4
 from grr.server.aff4_objects import standard
@@ -58,3 +59,9 @@ class FilestoreStats(aff4.AFF4Object):
     FILESTORE_FILESIZE_HISTOGRAM = aff4.Attribute(
         "aff4:stats/filestore/filesize", stats.Graph,
         "Filesize histogram of files in the filestore")
+
+    AGGREGATION_STATE = aff4.Attribute(
+        "aff4:stats/filestore/aggregation_state",
+        rdf_protodict.AttributedDict,
+        "Partial aggregates and scan cursors the statistics are updated from",
+        versioned=False)
@@ -1134,6 +1134,42 @@ class AFF4Test(aff4_test_lib.AFF4ObjectTest):
   def testAFF4UnversionedImage(self):
     self.ExerciseAFF4ImageBase(aff4.AFF4UnversionedImage)
 
+  def testAFF4ImageReadAheadGrowsForSequentialReads(self):
+    path = "/C.12345/aff4imagereadahead"
+
+    with aff4.FACTORY.Create(path, aff4.AFF4Image, token=self.token) as fd:
+      fd.SetChunksize(10)
+      data = "".join("Test%05X\n" % i for i in range(500))
+      fd.Write(data)
+
+    read_chunks = []
+    original_read_chunks = aff4.AFF4Image._ReadChunks
+
+    def ReadChunks(fd, chunks):
+      read_chunks.append(sorted(chunks))
+      return original_read_chunks(fd, chunks)
+
+    with utils.Stubber(aff4.AFF4Image, "_ReadChunks", ReadChunks):
+      fd = aff4.FACTORY.Open(path, mode="r", token=self.token)
+      result = []
+      while True:
+        chunk = fd.Read(10)
+        if not chunk:
+          break
+        result.append(chunk)
+
+      self.assertEqual("".join(result), data)
+      # Every chunk is read once, in windows growing to MAX_LOOK_AHEAD.
+      self.assertEqual(sum(read_chunks, []), range(500))
+      self.assertEqual([len(chunks) for chunks in read_chunks[:4]],
+                       [10, 20, 40, 40])
+
+      # A seek starts over with the smallest window.
+      del read_chunks[:]
+      fd.Seek(0)
+      self.assertEqual(fd.Read(10), "Test00000\n")
+      self.assertEqual(read_chunks, [range(10)])
+
   def testAFF4ImageSize(self):
     path = "/C.12345/aff4imagesize"
 
@@ -2145,6 +2181,61 @@ class ForemanTests(aff4_test_lib.AFF4ObjectTest):
       self.assertEqual(len(notifications), 1)
       self.assertEqual(notifications[0].session_id, hunt_id)
 
+  def testRulesAreCompiledOnlyWhenChanged(self):
+    fd = aff4.FACTORY.Create(
+        "C.0000000000000031", aff4_grr.VFSGRRClient, token=self.token)
+    fd.Set(fd.Schema.SYSTEM, rdfvalue.RDFString("Windows 7"))
+    fd.Close()
+
+    def SetRules(os_windows):
+      foreman = aff4.FACTORY.Open("aff4:/foreman", mode="rw", token=self.token)
+      rule = rdf_foreman.ForemanRule(
+          created=int(time.time() * 1e6),
+          expires=int((time.time() + 3600) * 1e6),
+          description="Test rule")
+      rule.client_rule_set = rdf_foreman.ForemanClientRuleSet(rules=[
+          rdf_foreman.ForemanClientRule(
+              rule_type=rdf_foreman.ForemanClientRule.Type.OS,
+              os=rdf_foreman.ForemanOsClientRule(
+                  os_windows=os_windows, os_linux=not os_windows))
+      ])
+      rule.actions.Append(
+          flow_name="Test Flow", argv=rdf_protodict.Dict(foo="bar"))
+      rule_set = foreman.Schema.RULES()
+      rule_set.Append(rule)
+      foreman.Set(foreman.Schema.RULES, rule_set)
+      foreman.Close()
+
+    compile_calls = []
+    original_compile = rdf_foreman.ForemanClientRuleSet.Compile
+
+    def Compile(rule_set):
+      compile_calls.append(rule_set)
+      return original_compile(rule_set)
+
+    with utils.MultiStubber(
+        (flow.GRRFlow, "StartFlow", self.StartFlow),
+        (rdf_foreman.ForemanClientRuleSet, "Compile", Compile)):
+      SetRules(os_windows=True)
+      self.clients_launched = []
+      for _ in range(3):
+        foreman = aff4.FACTORY.Open("aff4:/foreman", token=self.token)
+        foreman.AssignTasksToClient("C.0000000000000031")
+
+      self.assertEqual(len(compile_calls), 1)
+      self.assertEqual(self.clients_launched,
+                       [(rdf_client.ClientURN("C.0000000000000031"),
+                         "Test Flow")])
+
+      # Changed rules are compiled again and evaluated against the client.
+      SetRules(os_windows=False)
+      self.clients_launched = []
+      foreman = aff4.FACTORY.Open("aff4:/foreman", token=self.token)
+      foreman.AssignTasksToClient("C.0000000000000031")
+
+      self.assertEqual(len(compile_calls), 2)
+      self.assertEqual(self.clients_launched, [])
+
 
 def main(argv):
   # Run the full test suite
@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+"""A blob store keeping blobs in pack files on the local filesystem."""
+
+import binascii
+import errno
+import hashlib
+import logging
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+
+from grr import config
+from grr.lib import utils
+from grr.server import blob_store
+
+
+class _PackIndex(object):
+  """Maps raw sha256 digests to (pack number, offset, length) locations.
+
+  Most locations are kept in a string of fixed size records sorted by digest,
+  which is searched by bisection. New locations are kept in a dict until there
+  are enough of them to be merged into the sorted records.
+
+  Every location carries the time its index record was written. Records can
+  arrive in any order and only the latest one of a blob is kept. Deleted blobs
+  are kept as tombstones so that older records read later do not bring them
+  back.
+  """
+
+  RECORD = struct.Struct("<32sIQIQ")
+
+  # The length of the tombstones of deleted blobs.
+  DELETED = 2**32 - 1
+
+  # The dict of new locations is merged once it has this many entries or an
+  # eighth of the number of sorted records, whichever is larger.
+  MIN_MERGE_SIZE = 65536
+
+  def __init__(self):
+    self._sorted = ""
+    self._recent = {}
+
+  def _Search(self, digest):
+    size = self.RECORD.size
+    count = len(self._sorted) // size
+    low, high = 0, count
+    while low < high:
+      middle = (low + high) // 2
+      if self._sorted[middle * size:middle * size + 32] < digest:
+        low = middle + 1
+      else:
+        high = middle
+
+    if low < count and self._sorted[low * size:low * size + 32] == digest:
+      return self.RECORD.unpack_from(self._sorted, low * size)[1:]
+    return None
+
+  def _GetEntry(self, digest):
+    """Returns (pack number, offset, length, timestamp) or None."""
+    try:
+      return self._recent[digest]
+    except KeyError:
+      return self._Search(digest)
+
+  def Get(self, digest):
+    """Returns the location of the blob or None if it is not stored."""
+    entry = self._GetEntry(digest)
+    if entry is None or entry[2] == self.DELETED:
+      return None
+    return entry[:3]
+
+  def Add(self, digest, location, timestamp):
+    """Records the location of a blob unless a later record is known."""
+    entry = self._GetEntry(digest)
+    if entry is not None and entry[3] > timestamp:
+      return
+
+    self._recent[digest] = tuple(location) + (timestamp,)
+    if len(self._recent) >= max(self.MIN_MERGE_SIZE,
+                                len(self._sorted) // self.RECORD.size // 8):
+      self._Merge()
+
+  def Remove(self, digest, timestamp):
+    self.Add(digest, (0, 0, self.DELETED), timestamp)
+
+  def _Merge(self):
+    size = self.RECORD.size
+    records = [
+        self._sorted[i:i + size] for i in xrange(0, len(self._sorted), size)
+        if self._sorted[i:i + 32] not in self._recent
+    ]
+    for digest, entry in self._recent.iteritems():
+      records.append(self.RECORD.pack(digest, *entry))
+    records.sort()
+
+    self._sorted = "".join(records)
+    self._recent = {}
+
+
+class _MapCache(utils.FastStore):
+  """An LRU of pack memory maps which unmaps the maps it expires."""
+
+  def KillObject(self, obj):
+    obj.close()
+
+
+class _ActivePack(object):
+  """The pack file and index file blobs are appended to."""
+
+  def __init__(self, path, number):
+    self.number = number
+    self.data_fd = open(path + PackFileBlobstore.PACK_SUFFIX, "ab")
+    self.data_fd.seek(0, os.SEEK_END)
+    self.size = self.data_fd.tell()
+    self.index_fd = open(path + PackFileBlobstore.INDEX_SUFFIX, "ab")
+
+  def Close(self):
+    self.data_fd.close()
+    self.index_fd.close()
+
+
+class PackFileBlobstore(blob_store.Blobstore):
+  """A blob store appending blobs to pack files on the local filesystem.
+
+  Every process appends to its own pack file and starts a new one once the
+  pack grows beyond PackFileBlobstore.max_pack_size, so pack files are never
+  modified by more than one writer and never rewritten. Next to each pack, an
+  index file lists the sha256, offset and length of its blobs.
+
+  A batch of blobs is synced to the pack file before it is added to the index
+  file, so the index never points at data which was not written. Index files
+  of other processes are reread when a blob is not found. Packs are read
+  through mmap, at most PackFileBlobstore.max_open_packs of them are mapped at
+  the same time.
+  """
+
+  PACK_SUFFIX = ".pack"
+  INDEX_SUFFIX = ".idx"
+
+  # Digest, offset, length and the time the record was written in
+  # microseconds.
+  INDEX_RECORD = struct.Struct("<32sQIQ")
+
+  # The length of index records marking a blob as deleted.
+  DELETED = _PackIndex.DELETED
+
+  # BlobsExist misses reread the index files at most once in this many
+  # seconds. A missed blob is only uploaded and stored again.
+  refresh_interval = 1
+
+  def __init__(self, root_dir=None, max_pack_size=None, max_open_packs=None):
+    super(PackFileBlobstore, self).__init__()
+    self.root_dir = root_dir or config.CONFIG["PackFileBlobstore.root_dir"]
+    self.max_pack_size = (max_pack_size or
+                          config.CONFIG["PackFileBlobstore.max_pack_size"])
+    self.max_open_packs = (max_open_packs or
+                           config.CONFIG["PackFileBlobstore.max_open_packs"])
+
+    self.lock = threading.RLock()
+    self.index = _PackIndex()
+    # Pack names by pack number and the other way round.
+    self.pack_names = []
+    self.pack_numbers = {}
+    # The number of bytes read from each index file.
+    self.index_offsets = {}
+    # Memory maps of the recently read packs by pack number.
+    self.maps = _MapCache(max_size=self.max_open_packs)
+    self.active_pack = None
+    self.last_refresh = 0
+    self.last_timestamp = 0
+
+    try:
+      os.makedirs(self.root_dir)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+
+    self._Refresh()
+
+  def _PackNumber(self, name):
+    try:
+      return self.pack_numbers[name]
+    except KeyError:
+      self.pack_names.append(name)
+      self.pack_numbers[name] = len(self.pack_names) - 1
+      return self.pack_numbers[name]
+
+  def _Refresh(self):
+    """Reads index records added since the last refresh.
+
+    The index keeps the latest record of every blob, so index files can be
+    read in any order.
+    """
+    with self.lock:
+      self.last_refresh = time.time()
+      record_size = self.INDEX_RECORD.size
+
+      for filename in os.listdir(self.root_dir):
+        if not filename.endswith(self.INDEX_SUFFIX):
+          continue
+
+        name = filename[:-len(self.INDEX_SUFFIX)]
+        offset = self.index_offsets.get(name, 0)
+        path = os.path.join(self.root_dir, filename)
+        if os.path.getsize(path) - offset < record_size:
+          continue
+
+        with open(path, "rb") as fd:
+          fd.seek(offset)
+          data = fd.read()
+
+        # The last record might still be being written.
+        usable = len(data) - len(data) % record_size
+        number = self._PackNumber(name)
+        for position in xrange(0, usable, record_size):
+          digest, blob_offset, length, timestamp = (
+              self.INDEX_RECORD.unpack_from(data, position))
+          if length == self.DELETED:
+            self.index.Remove(digest, timestamp)
+          else:
+            self.index.Add(digest, (number, blob_offset, length), timestamp)
+
+        self.index_offsets[name] = offset + usable
+
+  def _GetActivePack(self):
+    """Returns the pack to append to, starting a new one if necessary."""
+    if self.active_pack and self.active_pack.size < self.max_pack_size:
+      return self.active_pack
+
+    if self.active_pack:
+      self.active_pack.Close()
+      self.active_pack = None
+
+    name = "%010d_%s_%d_%s" % (time.time(), socket.gethostname(), os.getpid(),
+                               binascii.hexlify(os.urandom(4)))
+    self.active_pack = _ActivePack(
+        os.path.join(self.root_dir, name), self._PackNumber(name))
+    self.index_offsets[name] = 0
+    return self.active_pack
+
+  def _Timestamp(self):
+    """Returns the current time in microseconds, increasing on every call."""
+    self.last_timestamp = max(self.last_timestamp + 1, int(time.time() * 1e6))
+    return self.last_timestamp
+
+  def _AppendIndexRecords(self, pack, records):
+    pack.index_fd.write("".join(
+        self.INDEX_RECORD.pack(*record) for record in records))
+    pack.index_fd.flush()
+    os.fsync(pack.index_fd.fileno())
+
+    name = self.pack_names[pack.number]
+    self.index_offsets[name] += len(records) * self.INDEX_RECORD.size
+
+  def _Append(self, blobs):
+    """Appends (raw digest, content) pairs to the active pack."""
+    pack = self._GetActivePack()
+    timestamp = self._Timestamp()
+    try:
+      records = []
+      for digest, content in blobs:
+        pack.data_fd.write(content)
+        records.append((digest, pack.size, len(content), timestamp))
+        pack.size += len(content)
+      pack.data_fd.flush()
+      os.fsync(pack.data_fd.fileno())
+
+      self._AppendIndexRecords(pack, records)
+    except (IOError, OSError):
+      # The pack size is not known anymore, later blobs go to a new pack.
+      pack.Close()
+      self.active_pack = None
+      raise
+
+    for digest, offset, length, timestamp in records:
+      self.index.Add(digest, (pack.number, offset, length), timestamp)
+
+  def _Locate(self, identifier):
+    try:
+      return self.index.Get(binascii.unhexlify(identifier))
+    except TypeError:
+      return None
+
+  def _LocateAll(self, identifiers, refresh):
+    """Returns a dict of the locations of the blobs which are stored."""
+    with self.lock:
+      locations = {}
+      for identifier in identifiers:
+        location = self._Locate(identifier)
+        if location is not None:
+          locations[identifier] = location
+
+      missing = [i for i in identifiers if i not in locations]
+      if missing and refresh:
+        self._Refresh()
+        for identifier in missing:
+          location = self._Locate(identifier)
+          if location is not None:
+            locations[identifier] = location
+
+      return locations
+
+  def _GetMap(self, number, end):
+    """Returns a memory map of the pack which covers at least end bytes.
+
+    Maps are closed when they are expired from the cache, so they must only be
+    used while holding the lock.
+    """
+    try:
+      pack_map = self.maps.Get(number)
+      if len(pack_map) >= end:
+        return pack_map
+      self.maps.ExpireObject(number)
+    except KeyError:
+      pass
+
+    path = os.path.join(self.root_dir,
+                        self.pack_names[number] + self.PACK_SUFFIX)
+    with open(path, "rb") as fd:
+      pack_map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    self.maps.Put(number, pack_map)
+    return pack_map
+
+  def StoreBlobs(self, contents, token=None):
+    """Creates blobs, the whole batch is synced to disk at once."""
+    identifiers = [hashlib.sha256(content).hexdigest() for content in contents]
+
+    with self.lock:
+      new_blobs = {}
+      for identifier, content in zip(identifiers, contents):
+        digest = binascii.unhexlify(identifier)
+        if digest in new_blobs or self.index.Get(digest) is not None:
+          logging.debug("Blob %s already stored.", identifier)
+          continue
+        new_blobs[digest] = content
+
+      if new_blobs:
+        self._Append(new_blobs.items())
+
+    return identifiers
+
+  def ReadBlobs(self, identifiers, token=None):
+    res = {identifier: None for identifier in identifiers}
+
+    with self.lock:
+      locations = self._LocateAll(identifiers, refresh=True)
+      # Reading the blobs in pack order maps every pack only once.
+      for identifier, location in sorted(
+          locations.iteritems(), key=lambda item: item[1]):
+        number, offset, length = location
+        pack_map = self._GetMap(number, offset + length)
+        if len(pack_map) < offset + length:
+          logging.error("Blob %s is beyond the end of pack %s.", identifier,
+                        self.pack_names[number])
+          continue
+        res[identifier] = pack_map[offset:offset + length]
+
+    return res
+
+  def BlobsExist(self, identifiers, token=None):
+    """Check if blobs for the given identifiers already exist."""
+    refresh = time.time() - self.last_refresh >= self.refresh_interval
+    locations = self._LocateAll(identifiers, refresh=refresh)
+    return {identifier: identifier in locations for identifier in identifiers}
+
+  def DeleteBlobs(self, identifiers, token=None):
+    """Marks blobs as deleted, the space in the packs is not reclaimed."""
+    with self.lock:
+      digests = []
+      for identifier in identifiers:
+        location = self._Locate(identifier)
+        if location is not None:
+          digests.append(binascii.unhexlify(identifier))
+
+      if not digests:
+        return
+
+      pack = self._GetActivePack()
+      timestamp = self._Timestamp()
+      self._AppendIndexRecords(
+          pack, [(digest, 0, self.DELETED, timestamp) for digest in digests])
+      for digest in digests:
+        self.index.Remove(digest, timestamp)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""Tests for the pack file blob store."""
+
+import hashlib
+import os
+
+from grr.lib import flags
+from grr.server.blob_stores import pack_file_bs
+from grr.test_lib import test_lib
+
+
+class PackFileBlobstoreTest(test_lib.GRRBaseTest):
+
+  def setUp(self):
+    super(PackFileBlobstoreTest, self).setUp()
+    self.root_dir = os.path.join(self.temp_dir, "blobs")
+
+  def CreateBlobstore(self, max_pack_size=1024, max_open_packs=None):
+    return pack_file_bs.PackFileBlobstore(
+        root_dir=self.root_dir,
+        max_pack_size=max_pack_size,
+        max_open_packs=max_open_packs)
+
+  def RenamePack(self, blobstore, new_name):
+    name = blobstore.pack_names[blobstore.active_pack.number]
+    for suffix in (pack_file_bs.PackFileBlobstore.PACK_SUFFIX,
+                   pack_file_bs.PackFileBlobstore.INDEX_SUFFIX):
+      os.rename(
+          os.path.join(self.root_dir, name + suffix),
+          os.path.join(self.root_dir, new_name + suffix))
+
+  def testStoresAndReadsBlobs(self):
+    blobstore = self.CreateBlobstore()
+    contents = ["foo", "bar", "foo"]
+
+    identifiers = blobstore.StoreBlobs(contents, token=self.token)
+
+    self.assertEqual(
+        identifiers,
+        [hashlib.sha256(content).hexdigest() for content in contents])
+    missing = hashlib.sha256("missing").hexdigest()
+    self.assertEqual(
+        blobstore.ReadBlobs(identifiers + [missing], token=self.token), {
+            identifiers[0]: "foo",
+            identifiers[1]: "bar",
+            missing: None
+        })
+    self.assertEqual(
+        blobstore.BlobsExist([identifiers[0], missing], token=self.token), {
+            identifiers[0]: True,
+            missing: False
+        })
+
+    # Duplicates are only written once.
+    pack_sizes = [
+        os.path.getsize(os.path.join(self.root_dir, name))
+        for name in os.listdir(self.root_dir)
+        if name.endswith(pack_file_bs.PackFileBlobstore.PACK_SUFFIX)
+    ]
+    self.assertEqual(pack_sizes, [6])
+
+  def testStartsNewPackWhenFull(self):
+    blobstore = self.CreateBlobstore(max_pack_size=10)
+    identifiers = []
+    for i in range(5):
+      identifiers.extend(blobstore.StoreBlobs(["blob%d" % i], token=self.token))
+
+    packs = [
+        name for name in os.listdir(self.root_dir)
+        if name.endswith(pack_file_bs.PackFileBlobstore.PACK_SUFFIX)
+    ]
+    self.assertEqual(len(packs), 3)
+    self.assertEqual(
+        blobstore.ReadBlobs(identifiers, token=self.token),
+        {identifiers[i]: "blob%d" % i for i in range(5)})
+
+  def testReadsBlobsStoredByOtherInstances(self):
+    writer = self.CreateBlobstore()
+    reader = self.CreateBlobstore()
+
+    identifier = writer.StoreBlob("foo", token=self.token)
+    self.assertEqual(reader.ReadBlob(identifier, token=self.token), "foo")
+
+    # Blobs appended to a pack after it was mapped are found as well.
+    identifier = writer.StoreBlob("bar", token=self.token)
+    self.assertEqual(reader.ReadBlob(identifier, token=self.token), "bar")
+
+    # A new instance loads all the index files.
+    self.assertEqual(
+        self.CreateBlobstore().ReadBlob(identifier, token=self.token), "bar")
+
+  def testIgnoresIncompleteIndexRecords(self):
+    blobstore = self.CreateBlobstore()
+    identifier = blobstore.StoreBlob("foo", token=self.token)
+
+    index_name = [
+        name for name in os.listdir(self.root_dir)
+        if name.endswith(pack_file_bs.PackFileBlobstore.INDEX_SUFFIX)
+    ][0]
+    with open(os.path.join(self.root_dir, index_name), "ab") as fd:
+      fd.write("\x00" * 10)
+
+    self.assertEqual(
+        self.CreateBlobstore().ReadBlob(identifier, token=self.token), "foo")
+
+  def testDeletesBlobs(self):
+    blobstore = self.CreateBlobstore()
+    foo, bar = blobstore.StoreBlobs(["foo", "bar"], token=self.token)
+
+    blobstore.DeleteBlobs([foo], token=self.token)
+
+    self.assertFalse(blobstore.BlobExists(foo, token=self.token))
+    self.assertEqual(
+        self.CreateBlobstore().BlobsExist([foo, bar], token=self.token),
+        {foo: False, bar: True})
+
+    # Deleted blobs can be stored again.
+    blobstore.StoreBlob("foo", token=self.token)
+    self.assertEqual(
+        self.CreateBlobstore().ReadBlob(foo, token=self.token), "foo")
+
+  def testAppliesLatestIndexRecords(self):
+    first = self.CreateBlobstore()
+    first.StoreBlob("bar", token=self.token)
+    second = self.CreateBlobstore()
+    foo = second.StoreBlob("foo", token=self.token)
+    self.assertEqual(first.ReadBlob(foo, token=self.token), "foo")
+
+    # The deletion is written to the pack whose name sorts first.
+    first.DeleteBlobs([foo], token=self.token)
+    self.RenamePack(first, "0000000000_first")
+    self.RenamePack(second, "9999999999_second")
+
+    self.assertFalse(self.CreateBlobstore().BlobExists(foo, token=self.token))
+
+  def testIndexKeepsLatestRecord(self):
+    index = pack_file_bs._PackIndex()
+    index.MIN_MERGE_SIZE = 2
+    foo, bar = hashlib.sha256("foo").digest(), hashlib.sha256("bar").digest()
+
+    index.Add(foo, (1, 0, 3), 20)
+    index.Remove(foo, 10)
+    self.assertEqual(index.Get(foo), (1, 0, 3))
+    index.Remove(foo, 30)
+    self.assertEqual(index.Get(foo), None)
+
+    # Merging keeps the tombstone.
+    index.Add(bar, (1, 3, 3), 20)
+    index.Add(foo, (2, 0, 3), 25)
+    self.assertEqual(index.Get(foo), None)
+    self.assertEqual(index.Get(bar), (1, 3, 3))
+    index.Add(foo, (2, 0, 3), 40)
+    self.assertEqual(index.Get(foo), (2, 0, 3))
+
+  def testUnmapsLeastRecentlyReadPacks(self):
+    blobstore = self.CreateBlobstore(max_pack_size=1, max_open_packs=2)
+    contents = ["blob%d" % i for i in range(4)]
+    identifiers = [
+        blobstore.StoreBlob(content, token=self.token) for content in contents
+    ]
+
+    blobstore.ReadBlob(identifiers[0], token=self.token)
+    first_map = blobstore.maps.Get(0)
+    self.assertEqual(
+        blobstore.ReadBlobs(identifiers, token=self.token),
+        dict(zip(identifiers, contents)))
+
+    self.assertEqual(len(list(blobstore.maps)), 2)
+    # Expired maps are closed.
+    self.assertRaises(ValueError, len, first_map)
+    self.assertEqual(blobstore.ReadBlob(identifiers[0], token=self.token),
+                     "blob0")
+
+  def testMergesIndexRecords(self):
+    blobstore = self.CreateBlobstore(max_pack_size=1024 * 1024)
+    blobstore.index.MIN_MERGE_SIZE = 16
+    contents = ["blob%d" % i for i in range(100)]
+
+    identifiers = blobstore.StoreBlobs(contents, token=self.token)
+    blobstore.DeleteBlobs(identifiers[:1], token=self.token)
+
+    results = blobstore.ReadBlobs(identifiers, token=self.token)
+    self.assertEqual(results[identifiers[0]], None)
+    for identifier, content in zip(identifiers[1:], contents[1:]):
+      self.assertEqual(results[identifier], content)
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
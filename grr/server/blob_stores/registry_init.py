@@ -5,3 +5,6 @@
 
 # The memory stream object based blob store.
 from grr.server.blob_stores import memory_stream_bs
+
+# A blob store keeping blobs in pack files on the local filesystem.
+from grr.server.blob_stores import pack_file_bs
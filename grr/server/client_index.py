@@ -5,6 +5,8 @@ An index of client machines, associating likely identifiers to client IDs.
 """
 
 
+import array
+
 from grr.lib import rdfvalue
 from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
@@ -37,9 +39,22 @@ class ClientIndex(keyword_index.AFF4KeywordIndex):
   # We accept and return client URNs, but store client ids,
   # e.g. "C.00aaeccbb45f33a3".
 
+  # In posting lists, client ids are stored as the 64 bit integer they encode.
+  if array.array("L").itemsize >= 8:
+    POSTING_LIST_TYPECODE = "L"
+
   def _ClientIdFromURN(self, urn):
     return urn.Basename()
 
+  def _NameToPostingKey(self, name):
+    key = int(name[2:], 16)
+    if self._PostingKeyToName(key) != name:
+      raise ValueError("Not a client id: %s" % name)
+    return key
+
+  def _PostingKeyToName(self, key):
+    return "C.%016x" % key
+
   def _NormalizeKeyword(self, keyword):
     return keyword.lower()
 
@@ -74,11 +89,13 @@ class ClientIndex(keyword_index.AFF4KeywordIndex):
 
     return start_time, end_time, filtered_keywords, unversioned_keywords
 
-  def LookupClients(self, keywords):
+  def LookupClients(self, keywords, limit=None):
     """Returns a list of client URNs associated with keywords.
 
     Args:
       keywords: The list of keywords to search by.
+      limit: If set, only the first limit client URNs in sorted order are
+          returned.
 
     Returns:
       A list of client URNs.
@@ -104,7 +121,9 @@ class ClientIndex(keyword_index.AFF4KeywordIndex):
         map(self._NormalizeKeyword, filtered_keywords),
         start_time=start_time.AsMicroSecondsFromEpoch(),
         end_time=end_time.AsMicroSecondsFromEpoch(),
-        last_seen_map=last_seen_map)
+        last_seen_map=last_seen_map,
+        # Outdated results are only filtered out below.
+        limit=None if unversioned_keywords else limit)
     if not raw_results:
       return []
 
@@ -127,7 +146,10 @@ class ClientIndex(keyword_index.AFF4KeywordIndex):
             old_results.add(result)
       raw_results -= old_results
 
-    return [rdf_client.ClientURN(result) for result in raw_results]
+    results = [rdf_client.ClientURN(result) for result in raw_results]
+    if limit:
+      results = sorted(results)[:limit]
+    return results
 
   def ReadClientPostingLists(self, keywords):
     """Looks up all clients associated with any of the given keywords.
@@ -43,8 +43,11 @@ import os
 import random
 import socket
 import sys
+import threading
 import time
 
+from multiprocessing.pool import ThreadPool
+
 import psutil
 
 from grr import config
@@ -136,6 +139,9 @@ class MutationPool(object):
     self.delete_attributes_requests = []
 
     self.new_notifications = []
+    self.flush_callbacks = []
+    # (count, oldest timestamp) of the records added to each collection.
+    self.collection_counts = {}
 
   def DeleteSubjects(self, subjects):
     self.delete_subject_requests.extend(subjects)
@@ -160,27 +166,23 @@ class MutationPool(object):
 
   def Flush(self):
     """Flushing actually applies all the operations in the pool."""
-    DB.DeleteSubjects(self.delete_subject_requests, sync=False)
-
-    for req in self.delete_attributes_requests:
-      subject, attributes, start, end = req
-      DB.DeleteAttributes(subject, attributes, start=start, end=end, sync=False)
-
-    for req in self.set_requests:
-      subject, values, timestamp, replace, to_delete = req
-      DB.MultiSet(
-          subject,
-          values,
-          timestamp=timestamp,
-          replace=replace,
-          to_delete=to_delete,
-          sync=False)
+    for collection_id, (count, timestamp) in self.collection_counts.iteritems():
+      self.Set(
+          collection_id,
+          DataStore.COLLECTION_COUNT_ATTRIBUTE_PREFIX +
+          "%016x" % random.getrandbits(64),
+          "%x" % count,
+          timestamp=timestamp)
+    self.collection_counts = {}
 
     if (self.delete_subject_requests or self.delete_attributes_requests or
         self.set_requests):
-      DB.Flush()
+      DB.MultiApplyMutations(self)
 
+    notifications_by_queue = collections.OrderedDict()
     for queue, notifications in self.new_notifications:
+      notifications_by_queue.setdefault(queue, []).extend(notifications)
+    for queue, notifications in notifications_by_queue.iteritems():
       DB.CreateNotifications(queue, notifications)
     self.new_notifications = []
 
@@ -188,6 +190,14 @@ class MutationPool(object):
     self.set_requests = []
     self.delete_attributes_requests = []
 
+    callbacks, self.flush_callbacks = self.flush_callbacks, []
+    for callback in callbacks:
+      callback()
+
+  def OnFlush(self, callback):
+    """Calls callback once the next Flush() applied the mutations."""
+    self.flush_callbacks.append(callback)
+
   def __enter__(self):
     return self
 
@@ -227,6 +237,28 @@ class MutationPool(object):
         timestamp=timestamp,
         replace=True)
 
+  def CollectionAddCount(self, collection_id, count, timestamp):
+    """Counts records added to a collection, written when the pool is flushed.
+
+    Args:
+      collection_id: ID of the collection.
+      count: The number of records added.
+      timestamp: The timestamp of the oldest of the records.
+    """
+    previous = self.collection_counts.get(collection_id)
+    if previous is not None:
+      count += previous[0]
+      timestamp = min(timestamp, previous[1])
+    self.collection_counts[collection_id] = (count, timestamp)
+
+  def CollectionMergeCounts(self, collection_id, base_count, merged):
+    """Replaces the counts in merged by the base count of the collection."""
+    self.MultiSet(
+        collection_id,
+        {DataStore.COLLECTION_BASE_COUNT_ATTRIBUTE: ["%x" % base_count]},
+        timestamp=0,
+        to_delete=merged)
+
   def CollectionAddStoredTypeIndex(self, collection_id, stored_type):
     self.Set(
         collection_id,
@@ -240,6 +272,23 @@ class MutationPool(object):
       self.DeleteSubject(subject)
       if self.Size() > 50000:
         self.Flush()
+    self.collection_counts.pop(collection_id, None)
+    self.DeleteAttributes(collection_id, [
+        attribute for attribute, _, _ in DB.ResolvePrefix(
+            collection_id, DataStore.COLLECTION_COUNT_ATTRIBUTE_PREFIX)
+    ])
+
+  def CollectionDeleteUpTo(self, collection_id, timestamp, suffix):
+    """Deletes the items stored at or before (timestamp, suffix)."""
+    last_subject = utils.SmartStr(
+        DataStore.CollectionMakeURN(collection_id, timestamp, suffix)[0])
+    for subject, _, _ in DB.ScanAttribute(
+        collection_id.Add("Results"), DataStore.COLLECTION_ATTRIBUTE):
+      if utils.SmartStr(subject) > last_subject:
+        break
+      self.DeleteSubject(subject)
+      if self.Size() > 50000:
+        self.Flush()
 
   def QueueAddItem(self, queue_id, item, timestamp):
     result_subject, timestamp, _ = DataStore.CollectionMakeURN(
@@ -543,6 +592,11 @@ class DataStore(object):
   enable_flusher_thread = True
   monitor_thread = None
 
+  # The thread pool used to run independent reads in parallel.
+  read_pool = None
+  read_pool_size = 0
+  read_pool_lock = threading.Lock()
+
   def __init__(self):
     if self.enable_flusher_thread:
       # Start the flusher thread.
@@ -570,6 +624,44 @@ class DataStore(object):
         sleep_time=60)
     self.monitor_thread.start()
 
+  def _GetReadPool(self):
+    """Returns the read thread pool or None if parallel reads are disabled."""
+    size = config.CONFIG["Datastore.read_threadpool_size"]
+    if size < 2:
+      return None
+
+    with self.read_pool_lock:
+      if self.read_pool is None or self.read_pool_size != size:
+        if self.read_pool is not None:
+          self.read_pool.close()
+        self.read_pool = ThreadPool(size)
+        self.read_pool_size = size
+      return self.read_pool
+
+  def _ParallelMap(self, function, items):
+    """Calls function for all items using the read thread pool if enabled.
+
+    Data stores use this to split reads which touch independent shards (e.g.
+    database files or connections) across threads.
+
+    Args:
+      function: A callable taking a single item. Must not use the read thread
+        pool itself.
+      items: An iterable of items.
+
+    Returns:
+      A list of the results, in the same order as items.
+    """
+    items = list(items)
+    read_pool = None
+    if len(items) > 1:
+      read_pool = self._GetReadPool()
+
+    if read_pool is None:
+      return [function(item) for item in items]
+
+    return read_pool.map(function, items)
+
   @classmethod
   def SetupTestDB(cls):
     cls.enable_flusher_thread = False
@@ -720,6 +812,86 @@ class DataStore(object):
       self.DeleteAttributes(
           subject, attributes, start=start, end=end, sync=sync)
 
+  def MultiApplyMutations(self, mutation_pool):
+    """Applies all mutations collected in a mutation pool.
+
+    Subject deletions are applied first, then attribute deletions and finally
+    all MultiSet() requests in the order they were added to the pool. This
+    implementation issues one call per subject, data stores that can write
+    in bulk should override it.
+
+    Args:
+      mutation_pool: A MutationPool instance.
+    """
+    self.DeleteSubjects(mutation_pool.delete_subject_requests, sync=False)
+
+    for req in mutation_pool.delete_attributes_requests:
+      subject, attributes, start, end = req
+      self.DeleteAttributes(
+          subject, attributes, start=start, end=end, sync=False)
+
+    for req in mutation_pool.set_requests:
+      subject, values, timestamp, replace, to_delete = req
+      self.MultiSet(
+          subject,
+          values,
+          timestamp=timestamp,
+          replace=replace,
+          to_delete=to_delete,
+          sync=False)
+
+    self.Flush()
+
+  def _FlattenSetRequests(self, set_requests):
+    """Reduces a sequence of MultiSet() requests to deletions and insertions.
+
+    Applying the returned deletions and then the returned insertions has the
+    same effect as applying the MultiSet() requests one after another. Values
+    that a later request replaces are dropped instead of being written.
+
+    Args:
+      set_requests: A list of (subject, values, timestamp, replace, to_delete)
+        tuples as stored in MutationPool.set_requests.
+
+    Returns:
+      A tuple (to_delete, to_insert). to_delete is a list of unique (subject,
+      attribute) pairs whose values have to be removed, to_insert is a list of
+      (subject, attribute, value, timestamp) tuples. Subjects and attributes
+      are unicode, timestamps are integers in microseconds.
+    """
+    to_delete = collections.OrderedDict()
+    to_insert = collections.OrderedDict()
+
+    for subject, values, timestamp, replace, attributes_to_delete in (
+        set_requests):
+      subject = utils.SmartUnicode(subject)
+      if timestamp is None or timestamp == self.NEWEST_TIMESTAMP:
+        timestamp = time.time() * 1e6
+
+      cleared = set(attributes_to_delete or [])
+      if replace:
+        cleared.update(values)
+
+      for attribute in cleared:
+        key = (subject, utils.SmartUnicode(attribute))
+        to_delete[key] = True
+        to_insert.pop(key, None)
+
+      for attribute, sequence in values.iteritems():
+        key = (subject, utils.SmartUnicode(attribute))
+        rows = to_insert.setdefault(key, [])
+        for value in sequence:
+          element_timestamp = timestamp
+          if isinstance(value, (list, tuple)):
+            value, element_timestamp = value
+            if element_timestamp is None:
+              element_timestamp = timestamp
+          rows.append((key[0], key[1], value, long(element_timestamp)))
+
+    rows = [row for element_rows in to_insert.itervalues()
+            for row in element_rows]
+    return to_delete.keys(), rows
+
   @abc.abstractmethod
   def DeleteAttributes(self,
                        subject,
@@ -957,9 +1129,9 @@ class DataStore(object):
   def CreateNotifications(self, queue_shard, notifications):
     values = {}
     for notification in notifications:
-      values[self.NOTIFY_PREDICATE_TEMPLATE % notification.session_id] = [
-          (notification.SerializeToString(), notification.timestamp)
-      ]
+      values.setdefault(
+          self.NOTIFY_PREDICATE_TEMPLATE % notification.session_id, []).append(
+              (notification.SerializeToString(), notification.timestamp))
     self.MultiSet(queue_shard, values, replace=False, sync=True)
 
   def DeleteNotifications(self, queue_shards, session_ids, start, end):
@@ -1329,6 +1501,13 @@ class DataStore(object):
   # suffix is stored as the value.
   COLLECTION_INDEX_ATTRIBUTE_PREFIX = "index:sc_"
 
+  # An attribute name of the form "index:sc-count:<id>" at timestamp <t> holds
+  # the number of records written to a collection by one mutation pool, the
+  # oldest of them at timestamp t. Writers never read or modify counts, they
+  # are added up by readers and merged into the base count from time to time.
+  COLLECTION_COUNT_ATTRIBUTE_PREFIX = "index:sc-count:"
+  COLLECTION_BASE_COUNT_ATTRIBUTE = COLLECTION_COUNT_ATTRIBUTE_PREFIX + "base"
+
   # The attribute prefix to use when storing the index of stored types
   # for multi type collections.
   COLLECTION_VALUE_TYPE_PREFIX = "aff4:value_type_"
@@ -1362,6 +1541,21 @@ class DataStore(object):
                           after_timestamp=None,
                           after_suffix=None,
                           limit=None):
+    for serialized_rdf_value, timestamp, suffix in self.CollectionScanRawItems(
+        collection_id,
+        after_timestamp=after_timestamp,
+        after_suffix=after_suffix,
+        limit=limit):
+      item = rdf_type.FromSerializedString(serialized_rdf_value)
+      item.age = timestamp
+      yield (item, timestamp, suffix)
+
+  def CollectionScanRawItems(self,
+                             collection_id,
+                             after_timestamp=None,
+                             after_suffix=None,
+                             limit=None):
+    """Like CollectionScanItems but yields the serialized values."""
     after_urn = None
     if after_timestamp:
       after_urn = utils.SmartStr(
@@ -1375,11 +1569,9 @@ class DataStore(object):
         self.COLLECTION_ATTRIBUTE,
         after_urn=after_urn,
         max_records=limit):
-      item = rdf_type.FromSerializedString(serialized_rdf_value)
-      item.age = timestamp
       # The urn is timestamp.suffix where suffix is 6 hex digits.
       suffix = int(str(subject)[-6:], 16)
-      yield (item, timestamp, suffix)
+      yield (serialized_rdf_value, timestamp, suffix)
 
   def CollectionReadIndex(self, collection_id):
     """Reads all index entries for the given collection.
@@ -1396,6 +1588,26 @@ class DataStore(object):
       i = int(attr[len(self.COLLECTION_INDEX_ATTRIBUTE_PREFIX):], 16)
       yield (i, ts, int(value, 16))
 
+  def CollectionReadCounts(self, collection_id):
+    """Reads the record counts of the given collection.
+
+    Args:
+      collection_id: ID of the collection.
+
+    Returns:
+      A tuple of the base count, which is None if no counts were merged yet,
+      and a list of (attribute, count, ts) of the counts written since.
+    """
+    base_count = None
+    counts = []
+    for (attr, value, ts) in self.ResolvePrefix(
+        collection_id, self.COLLECTION_COUNT_ATTRIBUTE_PREFIX):
+      if attr == self.COLLECTION_BASE_COUNT_ATTRIBUTE:
+        base_count = int(value, 16)
+      else:
+        counts.append((attr, int(value, 16), ts))
+    return base_count, counts
+
   def CollectionReadStoredTypes(self, collection_id):
     for attribute, _, _ in self.ResolveRow(collection_id):
       if attribute.startswith(self.COLLECTION_VALUE_TYPE_PREFIX):
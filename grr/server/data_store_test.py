@@ -467,6 +467,32 @@ class DataStoreTestMixin(object):
 
     self.assertListEqual(sorted(timestamps), sorted(expected_timestamps))
 
+  def testParallelReads(self):
+    """Tests that parallel reads return the same results as serial ones."""
+    subjects = ["aff4:/C.%016X/parallel" % i for i in range(40)]
+    for i, subject in enumerate(subjects):
+      data_store.DB.MultiSet(subject, {
+          "aff4:foo": [str(i)],
+          "aff4:bar": [str(i * 2)],
+          "metadata:baz": [str(i * 3)]
+      })
+
+    def _Read():
+      return (list(data_store.DB.MultiResolvePrefix(subjects, ["aff4:"])),
+              list(
+                  data_store.DB.ScanAttributes("aff4:/",
+                                               ["aff4:foo", "aff4:bar"])))
+
+    serial_results = _Read()
+    with test_lib.ConfigOverrider({"Datastore.read_threadpool_size": 4}):
+      parallel_results = _Read()
+
+    resolved, scanned = parallel_results
+    self.assertItemsEqual([subject for subject, _ in resolved], subjects)
+    self.assertEqual(dict(resolved), dict(serial_results[0]))
+    self.assertEqual(len(scanned), len(subjects))
+    self.assertEqual(scanned, serial_results[1])
+
   def testMultiResolvePrefixTypePreservation(self):
     """Check result subjects have same format as original calls."""
     rows = [
@@ -1354,6 +1380,7 @@ class DataStoreTestMixin(object):
         "IndexReadPostingLists",
         "IndexRemoveKeywordsForName",
         "MultiDeleteAttributes",
+        "MultiApplyMutations",
         "MultiDestroyFlowStates",
         "MultiResolvePrefix",
         "MultiSet",
@@ -1489,6 +1516,68 @@ class DataStoreTestMixin(object):
     stored, _ = data_store.DB.Resolve(self.test_row, predicate)
     self.assertIsNone(stored)
 
+  def testPoolMultiSetReplaceOrdering(self):
+    predicate = "metadata:predicate"
+
+    with data_store.DB.GetMutationPool() as pool:
+      pool.Set(self.test_row, predicate, "old", timestamp=1000, replace=False)
+      pool.Set(self.test_row, predicate, "new", timestamp=2000, replace=True)
+      pool.Set(self.test_row, predicate, "newer", timestamp=3000, replace=False)
+
+    result = data_store.DB.ResolvePrefix(
+        self.test_row, predicate, timestamp=data_store.DB.ALL_TIMESTAMPS)
+    self.assertEqual([(value, ts) for _, value, ts in result],
+                     [("newer", 3000), ("new", 2000)])
+
+  @DeletionTest
+  def testPoolFlushAppliesDeletionsBeforeSets(self):
+    predicate = "metadata:predicate"
+    other_row = "aff4:/row:bar"
+    data_store.DB.Set(self.test_row, predicate, "old", timestamp=1000)
+    data_store.DB.Set(other_row, predicate, "old", timestamp=1000)
+    data_store.DB.Set(other_row, "metadata:other", "keep", timestamp=1000)
+
+    with data_store.DB.GetMutationPool() as pool:
+      pool.Set(self.test_row, predicate, "new", timestamp=2000, replace=False)
+      pool.DeleteSubject(self.test_row)
+      pool.Set(other_row, predicate, "new", timestamp=2000, replace=False)
+      pool.DeleteAttributes(other_row, [predicate], start=0, end=1500)
+
+    stored, ts = data_store.DB.Resolve(self.test_row, predicate)
+    self.assertEqual((stored, ts), ("new", 2000))
+
+    result = data_store.DB.ResolvePrefix(
+        other_row, "metadata:", timestamp=data_store.DB.ALL_TIMESTAMPS)
+    self.assertEqual([(attribute, value) for attribute, value, _ in result],
+                     [("metadata:other", "keep"), (predicate, "new")])
+
+  def testPoolMultiSetManySubjects(self):
+    subjects = ["aff4:/pool_row%d/subject" % i for i in range(20)]
+    with data_store.DB.GetMutationPool() as pool:
+      for i, subject in enumerate(subjects):
+        pool.MultiSet(subject, {
+            "aff4:size": [i],
+            "metadata:predicate": [("value%d" % i, 1000 + i)]
+        })
+
+    for i, subject in enumerate(subjects):
+      stored, _ = data_store.DB.Resolve(subject, "aff4:size")
+      self.assertEqual(stored, i)
+      stored, ts = data_store.DB.Resolve(subject, "metadata:predicate")
+      self.assertEqual((stored, ts), ("value%d" % i, 1000 + i))
+
+  def testPoolNotificationsForSameQueue(self):
+    queue = rdfvalue.RDFURN("aff4:/pool_queue")
+    session_id = rdfvalue.SessionID(flow_name="test")
+    with data_store.DB.GetMutationPool() as pool:
+      for ts in [1000, 2000]:
+        pool.CreateNotifications(queue, [
+            rdf_flows.GrrNotification(session_id=session_id, timestamp=ts)
+        ])
+
+    notifications = list(data_store.DB.GetNotifications(queue, 3000))
+    self.assertEqual(sorted(n.timestamp for n in notifications), [1000, 2000])
+
   def testQueueManager(self):
     session_id = rdfvalue.SessionID(flow_name="test")
     client_id = rdf_client.ClientURN("C.1000000000000000")
@@ -2196,6 +2285,48 @@ class DataStoreBenchmarks(benchmark_test_lib.MicroBenchmarks):
     elapsed_time = time.time() - start_time
     self.AddResult("Seq. Coll. full sequential read", elapsed_time, 1)
 
+  # Number of mutations in a pool for testMutationPoolFlush.
+  POOL_MUTATIONS = 10000
+
+  @test_lib.SetLabel("benchmark")
+  def testMutationPoolFlush(self):
+    """Measures the time it takes to flush large mutation pools."""
+    value = os.urandom(100)
+    subjects = ["aff4:/pool_row%d" % i for i in xrange(self.POOL_MUTATIONS)]
+
+    pool = data_store.DB.GetMutationPool()
+    for subject in subjects:
+      pool.Set(subject, "task:flow", value)
+    start_time = time.time()
+    pool.Flush()
+    self.AddResult("Flush %d sets" % self.POOL_MUTATIONS,
+                   time.time() - start_time, 1)
+
+    pool = data_store.DB.GetMutationPool()
+    for i, subject in enumerate(subjects):
+      pool.Set(subject, "task:flow", value, timestamp=i + 1, replace=False)
+    start_time = time.time()
+    pool.Flush()
+    self.AddResult("Flush %d versioned sets" % self.POOL_MUTATIONS,
+                   time.time() - start_time, 1)
+
+    pool = data_store.DB.GetMutationPool()
+    for subject in subjects:
+      pool.DeleteAttributes(subject, ["task:flow"])
+    start_time = time.time()
+    pool.Flush()
+    self.AddResult("Flush %d attribute deletions" % self.POOL_MUTATIONS,
+                   time.time() - start_time, 1)
+
+    pool = data_store.DB.GetMutationPool()
+    for subject in subjects[:self.POOL_MUTATIONS / 2]:
+      pool.Set(subject, "task:flow", value)
+    pool.DeleteSubjects(subjects[self.POOL_MUTATIONS / 2:])
+    start_time = time.time()
+    pool.Flush()
+    self.AddResult("Flush %d mixed mutations" % self.POOL_MUTATIONS,
+                   time.time() - start_time, 1)
+
   @test_lib.SetLabel("benchmark")
   def testSimulateFlows(self):
     self.flow_ids = []
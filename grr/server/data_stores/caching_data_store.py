@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+"""A read-through subject cache in front of another data store.
+
+The cache keeps the results of ResolvePrefix() and MultiResolvePrefix() calls
+for recently used subjects in memory. All writes that go through the caching
+data store invalidate the affected subjects, writes made by other processes are
+only picked up once the cached entries expire. For this reason, every cached
+result has a time to live which can be configured per attribute prefix.
+"""
+
+import threading
+import time
+
+from grr import config
+from grr.lib import registry
+from grr.lib import stats
+from grr.lib import utils
+from grr.server import data_store
+
+
+class SubjectCache(utils.FastStore):
+  """A LRU cache mapping subjects to their cached query results.
+
+  Each cached object is a dict mapping a query key to a (expiration time,
+  values) tuple.
+  """
+
+  def KillObject(self, obj):
+    stats.STATS.IncrementCounter("datastore_cache_evictions")
+
+
+class CachingDataStore(data_store.DataStore):
+  """A data store that caches reads of another data store.
+
+  Only reads of the latest values or of all versions are cached. Reads of
+  specific time ranges and reads with a limit are passed through to the
+  underlying data store.
+  """
+
+  # This class wraps another data store so it can't be used as the
+  # Datastore.implementation.
+  __abstract = True  # pylint: disable=g-bad-name
+
+  # The wrapped data store runs its own flusher thread.
+  enable_flusher_thread = False
+
+  # Number of generation counters used to detect writes that happen while a
+  # result is read from the underlying data store.
+  GENERATION_SLOTS = 1024
+
+  def __init__(self, delegate, cache_size=None, ttl=None, attribute_ttls=None):
+    """Constructor.
+
+    Args:
+      delegate: The data store to cache.
+      cache_size: The maximum number of subjects to keep in the cache.
+      ttl: The number of seconds a cached result stays valid if no more
+        specific setting exists in attribute_ttls.
+      attribute_ttls: A list of "<attribute prefix>=<seconds>" strings. A ttl of
+        0 disables caching for this prefix.
+    """
+    self.delegate = delegate
+    super(CachingDataStore, self).__init__()
+
+    if cache_size is None:
+      cache_size = config.CONFIG["Datastore.subject_cache_size"]
+    if ttl is None:
+      ttl = config.CONFIG["Datastore.subject_cache_ttl"]
+    if attribute_ttls is None:
+      attribute_ttls = config.CONFIG["Datastore.subject_cache_attribute_ttls"]
+
+    self.cache_size = cache_size
+    self.cache = SubjectCache(max_size=cache_size)
+    self.ttl = ttl
+    self.attribute_ttls = self._ParseAttributeTTLs(attribute_ttls)
+    self.ttl_cache = {}
+
+    self.generations = [0] * self.GENERATION_SLOTS
+    self.generations_lock = threading.Lock()
+
+  def __getattr__(self, name):
+    # Everything that is specific to the wrapped data store is passed through.
+    if name == "delegate":
+      raise AttributeError(name)
+    return getattr(self.delegate, name)
+
+  def _ParseAttributeTTLs(self, attribute_ttls):
+    result = []
+    for entry in attribute_ttls:
+      try:
+        prefix, ttl = entry.rsplit("=", 1)
+        result.append((prefix, float(ttl)))
+      except ValueError:
+        raise ValueError("Invalid attribute ttl specification: %s" % entry)
+    return result
+
+  def _GetTTL(self, attribute_prefix):
+    """Returns the time to live for results of a query for attribute_prefix."""
+    if isinstance(attribute_prefix, basestring):
+      attribute_prefix = [attribute_prefix]
+    attribute_prefix = tuple(attribute_prefix)
+
+    try:
+      return self.ttl_cache[attribute_prefix]
+    except KeyError:
+      pass
+
+    # A query for a prefix also returns attributes covered by more specific
+    # settings so the shortest applicable ttl wins.
+    result = None
+    for query_prefix in attribute_prefix:
+      ttls = [
+          ttl for prefix, ttl in self.attribute_ttls
+          if prefix.startswith(query_prefix) or query_prefix.startswith(prefix)
+      ] or [self.ttl]
+      result = min(ttls + ([result] if result is not None else []))
+
+    self.ttl_cache[attribute_prefix] = result
+    return result
+
+  def _MakeQueryKey(self, method, attribute_prefix, timestamp):
+    if not isinstance(attribute_prefix, basestring):
+      attribute_prefix = tuple(attribute_prefix)
+    return (method, attribute_prefix, timestamp)
+
+  def _IsCacheable(self, attribute_prefix, timestamp, limit):
+    if limit:
+      return False
+    if timestamp not in (None, self.NEWEST_TIMESTAMP, self.ALL_TIMESTAMPS):
+      return False
+    return self.cache_size > 0 and self._GetTTL(attribute_prefix) > 0
+
+  def _GetGeneration(self, subject):
+    return self.generations[hash(subject) % self.GENERATION_SLOTS]
+
+  def _Invalidate(self, subjects):
+    with self.generations_lock:
+      for subject in subjects:
+        subject = utils.SmartUnicode(subject)
+        self.generations[hash(subject) % self.GENERATION_SLOTS] += 1
+        self.cache.Pop(subject)
+
+  def _Lookup(self, subject, key, now):
+    """Returns cached values or None if they are not in the cache."""
+    with self.cache.lock:
+      try:
+        entries = self.cache.Get(subject)
+      except KeyError:
+        return None
+
+      try:
+        expires, values = entries[key]
+      except KeyError:
+        return None
+
+      if expires < now:
+        del entries[key]
+        return None
+
+      return list(values)
+
+  def _Store(self, subject, key, values, generation, ttl):
+    with self.generations_lock:
+      # Don't cache anything that might have been changed during the read.
+      if self._GetGeneration(subject) != generation:
+        return
+
+      with self.cache.lock:
+        try:
+          entries = self.cache.Get(subject)
+        except KeyError:
+          entries = {}
+          self.cache.Put(subject, entries)
+        entries[key] = (time.time() + ttl, list(values))
+
+  def Initialize(self):
+    self.delegate.Initialize()
+
+  def MultiResolvePrefix(self,
+                         subjects,
+                         attribute_prefix,
+                         timestamp=None,
+                         limit=None):
+    if not self._IsCacheable(attribute_prefix, timestamp, limit):
+      return self.delegate.MultiResolvePrefix(
+          subjects, attribute_prefix, timestamp=timestamp, limit=limit)
+
+    key = self._MakeQueryKey("MultiResolvePrefix", attribute_prefix, timestamp)
+    now = time.time()
+
+    result = {}
+    to_read = {}
+    hits = 0
+    for subject in subjects:
+      unicode_subject = utils.SmartUnicode(subject)
+      values = self._Lookup(unicode_subject, key, now)
+      if values is None:
+        to_read[unicode_subject] = subject
+        continue
+
+      hits += 1
+      if values:
+        result[subject] = values
+
+    if hits:
+      stats.STATS.IncrementCounter("datastore_cache_hits", delta=hits)
+
+    if to_read:
+      stats.STATS.IncrementCounter("datastore_cache_misses", delta=len(to_read))
+
+      generations = {s: self._GetGeneration(s) for s in to_read}
+      read = {}
+      for subject, values in self.delegate.MultiResolvePrefix(
+          to_read.values(), attribute_prefix, timestamp=timestamp):
+        read[utils.SmartUnicode(subject)] = values
+
+      ttl = self._GetTTL(attribute_prefix)
+      for unicode_subject, subject in to_read.iteritems():
+        values = read.get(unicode_subject, [])
+        self._Store(unicode_subject, key, values,
+                    generations[unicode_subject], ttl)
+        if values:
+          result[subject] = values
+
+    return result.iteritems()
+
+  def ResolvePrefix(self, subject, attribute_prefix, timestamp=None,
+                    limit=None):
+    if not self._IsCacheable(attribute_prefix, timestamp, limit):
+      return self.delegate.ResolvePrefix(
+          subject, attribute_prefix, timestamp=timestamp, limit=limit)
+
+    key = self._MakeQueryKey("ResolvePrefix", attribute_prefix, timestamp)
+    unicode_subject = utils.SmartUnicode(subject)
+
+    values = self._Lookup(unicode_subject, key, time.time())
+    if values is not None:
+      stats.STATS.IncrementCounter("datastore_cache_hits")
+      return values
+
+    stats.STATS.IncrementCounter("datastore_cache_misses")
+    generation = self._GetGeneration(unicode_subject)
+    values = list(
+        self.delegate.ResolvePrefix(
+            subject, attribute_prefix, timestamp=timestamp))
+    self._Store(unicode_subject, key, values, generation,
+                self._GetTTL(attribute_prefix))
+    return values
+
+  def Resolve(self, subject, attribute):
+    return self.delegate.Resolve(subject, attribute)
+
+  def ResolveMulti(self, subject, attributes, timestamp=None, limit=None):
+    return self.delegate.ResolveMulti(
+        subject, attributes, timestamp=timestamp, limit=limit)
+
+  def ScanAttributes(self,
+                     subject_prefix,
+                     attributes,
+                     after_urn=None,
+                     max_records=None,
+                     relaxed_order=False):
+    return self.delegate.ScanAttributes(
+        subject_prefix,
+        attributes,
+        after_urn=after_urn,
+        max_records=max_records,
+        relaxed_order=relaxed_order)
+
+  # Writes invalidate the cache both before and after they are passed on so
+  # that reads running concurrently can't store stale results.
+
+  def DeleteSubject(self, subject, sync=False):
+    self._Invalidate([subject])
+    try:
+      self.delegate.DeleteSubject(subject, sync=sync)
+    finally:
+      self._Invalidate([subject])
+
+  def DeleteSubjects(self, subjects, sync=False):
+    subjects = list(subjects)
+    self._Invalidate(subjects)
+    try:
+      self.delegate.DeleteSubjects(subjects, sync=sync)
+    finally:
+      self._Invalidate(subjects)
+
+  def Set(self,
+          subject,
+          attribute,
+          value,
+          timestamp=None,
+          replace=True,
+          sync=True):
+    self._Invalidate([subject])
+    try:
+      self.delegate.Set(
+          subject,
+          attribute,
+          value,
+          timestamp=timestamp,
+          replace=replace,
+          sync=sync)
+    finally:
+      self._Invalidate([subject])
+
+  def MultiSet(self,
+               subject,
+               values,
+               timestamp=None,
+               replace=True,
+               sync=True,
+               to_delete=None):
+    self._Invalidate([subject])
+    try:
+      self.delegate.MultiSet(
+          subject,
+          values,
+          timestamp=timestamp,
+          replace=replace,
+          sync=sync,
+          to_delete=to_delete)
+    finally:
+      self._Invalidate([subject])
+
+  def DeleteAttributes(self,
+                       subject,
+                       attributes,
+                       start=None,
+                       end=None,
+                       sync=True):
+    self._Invalidate([subject])
+    try:
+      self.delegate.DeleteAttributes(
+          subject, attributes, start=start, end=end, sync=sync)
+    finally:
+      self._Invalidate([subject])
+
+  def MultiDeleteAttributes(self,
+                            subjects,
+                            attributes,
+                            start=None,
+                            end=None,
+                            sync=True):
+    subjects = list(subjects)
+    self._Invalidate(subjects)
+    try:
+      self.delegate.MultiDeleteAttributes(
+          subjects, attributes, start=start, end=end, sync=sync)
+    finally:
+      self._Invalidate(subjects)
+
+  def MultiApplyMutations(self, mutation_pool):
+    subjects = set(mutation_pool.delete_subject_requests)
+    subjects.update(r[0] for r in mutation_pool.delete_attributes_requests)
+    subjects.update(r[0] for r in mutation_pool.set_requests)
+    self._Invalidate(subjects)
+    try:
+      self.delegate.MultiApplyMutations(mutation_pool)
+    finally:
+      self._Invalidate(subjects)
+
+  def DBSubjectLock(self, subject, lease_time=None):
+    return self.delegate.DBSubjectLock(subject, lease_time=lease_time)
+
+  def Flush(self):
+    self.delegate.Flush()
+
+  def Size(self):
+    return self.delegate.Size()
+
+  def ClearTestDB(self):
+    self.cache.Flush()
+    self.delegate.ClearTestDB()
+
+  def DestroyTestDB(self):
+    self.cache.Flush()
+    self.delegate.DestroyTestDB()
+
+
+class CachingDataStoreInit(registry.InitHook):
+  """Puts the subject cache in front of the data store if configured."""
+
+  pre = [data_store.DataStoreInit]
+
+  def RunOnce(self):
+    stats.STATS.RegisterCounterMetric("datastore_cache_hits")
+    stats.STATS.RegisterCounterMetric("datastore_cache_misses")
+    stats.STATS.RegisterCounterMetric("datastore_cache_evictions")
+
+  def Run(self):
+    if (config.CONFIG["Datastore.subject_cache_size"] and
+        not isinstance(data_store.DB, CachingDataStore)):
+      data_store.DB = CachingDataStore(data_store.DB)
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""Tests the caching data store."""
+
+
+import mock
+
+from grr.lib import flags
+from grr.lib import stats
+from grr.lib import utils
+from grr.server import data_store
+from grr.server import data_store_test
+from grr.server.data_stores import caching_data_store
+from grr.server.data_stores import fake_data_store
+from grr.test_lib import test_lib
+
+# pylint: mode=test
+
+
+class CachingTestMixin(object):
+
+  @classmethod
+  def setUpClass(cls):
+    super(CachingTestMixin, cls).setUpClass()
+    data_store.DB = caching_data_store.CachingDataStore(
+        fake_data_store.FakeDataStore(),
+        cache_size=1000,
+        ttl=600,
+        attribute_ttls=[])
+    data_store.DB.Initialize()
+
+  def testCorrectDataStore(self):
+    self.assertTrue(
+        isinstance(data_store.DB, caching_data_store.CachingDataStore))
+
+
+class CachingDataStoreTest(data_store_test.DataStoreTestMixin,
+                           CachingTestMixin, test_lib.GRRBaseTest):
+  """Runs the data store tests through the cache."""
+
+  def testApi(self):
+    """The fake datastore doesn't strictly conform to the api but this is ok."""
+
+
+class SubjectCacheTest(test_lib.GRRBaseTest):
+  """Tests the caching behavior."""
+
+  subject = "aff4:/C.0000000000000001"
+
+  def setUp(self):
+    super(SubjectCacheTest, self).setUp()
+    self.delegate = fake_data_store.FakeDataStore()
+    self.db = caching_data_store.CachingDataStore(
+        self.delegate,
+        cache_size=2,
+        ttl=600,
+        attribute_ttls=["metadata:ping=0", "aff4:=60"])
+    self.db_stubber = utils.Stubber(data_store, "DB", self.db)
+    self.db_stubber.Start()
+
+  def tearDown(self):
+    super(SubjectCacheTest, self).tearDown()
+    self.db_stubber.Stop()
+
+  def _GetCounter(self, name):
+    return stats.STATS.GetMetricValue(name)
+
+  def testReadsAreCached(self):
+    self.db.Set(self.subject, "aff4:type", "VFSGRRClient")
+
+    hits = self._GetCounter("datastore_cache_hits")
+    misses = self._GetCounter("datastore_cache_misses")
+
+    with mock.patch.object(
+        self.delegate, "ResolvePrefix",
+        wraps=self.delegate.ResolvePrefix) as resolve_prefix:
+      for _ in range(3):
+        result = self.db.ResolvePrefix(self.subject, "aff4:")
+        self.assertEqual([(a, v) for a, v, _ in result],
+                         [("aff4:type", "VFSGRRClient")])
+
+      self.assertEqual(resolve_prefix.call_count, 1)
+
+    self.assertEqual(self._GetCounter("datastore_cache_hits"), hits + 2)
+    self.assertEqual(self._GetCounter("datastore_cache_misses"), misses + 1)
+
+  def testMultiResolvePrefixOnlyReadsMissingSubjects(self):
+    other_subject = "aff4:/C.0000000000000002"
+    self.db.Set(self.subject, "aff4:type", "VFSGRRClient")
+    self.db.Set(other_subject, "aff4:type", "VFSGRRClient")
+
+    result = dict(self.db.MultiResolvePrefix([self.subject], "aff4:"))
+    self.assertEqual(result.keys(), [self.subject])
+
+    with mock.patch.object(
+        self.delegate,
+        "MultiResolvePrefix",
+        wraps=self.delegate.MultiResolvePrefix) as multi_resolve_prefix:
+      result = dict(
+          self.db.MultiResolvePrefix([self.subject, other_subject], "aff4:"))
+      self.assertEqual(sorted(result), [self.subject, other_subject])
+
+      self.assertEqual(multi_resolve_prefix.call_count, 1)
+      self.assertEqual(
+          list(multi_resolve_prefix.call_args[0][0]), [other_subject])
+
+  def testCallersCantModifyCachedResults(self):
+    self.db.Set(self.subject, "aff4:type", "VFSGRRClient")
+
+    for _, values in self.db.MultiResolvePrefix([self.subject], "aff4:"):
+      values.append(("aff4:garbage", "x", 0))
+
+    result = dict(self.db.MultiResolvePrefix([self.subject], "aff4:"))
+    self.assertEqual(len(result[self.subject]), 1)
+
+  def testWritesInvalidate(self):
+    self.db.Set(self.subject, "aff4:type", "VFSGRRClient")
+    self.assertEqual(self.db.ResolvePrefix(self.subject, "aff4:")[0][1],
+                     "VFSGRRClient")
+
+    self.db.Set(self.subject, "aff4:type", "VFSFile")
+    self.assertEqual(self.db.ResolvePrefix(self.subject, "aff4:")[0][1],
+                     "VFSFile")
+
+    with self.db.GetMutationPool() as pool:
+      pool.Set(self.subject, "aff4:type", "VFSDirectory")
+    self.assertEqual(self.db.ResolvePrefix(self.subject, "aff4:")[0][1],
+                     "VFSDirectory")
+
+    self.db.DeleteAttributes(self.subject, ["aff4:type"])
+    self.assertEqual(self.db.ResolvePrefix(self.subject, "aff4:"), [])
+
+    self.db.Set(self.subject, "aff4:type", "VFSFile")
+    self.assertTrue(self.db.ResolvePrefix(self.subject, "aff4:"))
+    self.db.DeleteSubject(self.subject)
+    self.assertEqual(self.db.ResolvePrefix(self.subject, "aff4:"), [])
+
+  def testWritesFromOtherProcessesVisibleAfterTTL(self):
+    with test_lib.FakeTime(1000):
+      self.db.Set(self.subject, "aff4:type", "VFSGRRClient")
+      self.db.ResolvePrefix(self.subject, "aff4:")
+
+      # This bypasses the cache, just like a write made by another process.
+      self.delegate.Set(self.subject, "aff4:type", "VFSFile")
+      self.assertEqual(self.db.ResolvePrefix(self.subject, "aff4:")[0][1],
+                       "VFSGRRClient")
+
+    with test_lib.FakeTime(1061):
+      self.assertEqual(self.db.ResolvePrefix(self.subject, "aff4:")[0][1],
+                       "VFSFile")
+
+  def testAttributeTTLs(self):
+    self.assertEqual(self.db._GetTTL("aff4:"), 60)
+    self.assertEqual(self.db._GetTTL("aff4:type"), 60)
+    self.assertEqual(self.db._GetTTL("flow:"), 600)
+    # Queries that can return uncacheable attributes are not cached.
+    self.assertEqual(self.db._GetTTL(["aff4:", "metadata:"]), 0)
+    self.assertEqual(self.db._GetTTL(""), 0)
+
+  def testRangeAndLimitedQueriesAreNotCached(self):
+    self.db.Set(self.subject, "flow:request:01", "x", timestamp=1000)
+
+    with mock.patch.object(
+        self.delegate, "ResolvePrefix",
+        wraps=self.delegate.ResolvePrefix) as resolve_prefix:
+      for _ in range(2):
+        self.db.ResolvePrefix(self.subject, "flow:", timestamp=(0, 2000))
+        self.db.ResolvePrefix(self.subject, "flow:", limit=1)
+
+      self.assertEqual(resolve_prefix.call_count, 4)
+
+  def testEviction(self):
+    evictions = self._GetCounter("datastore_cache_evictions")
+    for i in range(3):
+      self.db.ResolvePrefix("aff4:/C.000000000000000%d" % i, "aff4:")
+
+    self.assertEqual(len(self.db.cache), 2)
+    self.assertEqual(
+        self._GetCounter("datastore_cache_evictions"), evictions + 1)
+
+
+def main(args):
+  test_lib.main(args)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -2,6 +2,7 @@
 # -*- mode: python; encoding: utf-8 -*-
 """An implementation of a data store based on mysql."""
 
+import collections
 import logging
 import os
 import Queue
@@ -256,6 +257,43 @@ class MySQLAdvancedDataStore(data_store.DataStore):
     queries = self._BuildDelete(subject)
     self._ExecuteQueries(queries)
 
+  def MultiApplyMutations(self, mutation_pool):
+    """Applies all mutations in a mutation pool in a single transaction."""
+    transaction = []
+
+    subjects = [
+        utils.SmartUnicode(subject)
+        for subject in mutation_pool.delete_subject_requests
+    ]
+    if subjects:
+      transaction.extend(self._BuildMultiDeleteSubjects(subjects))
+
+    # Attribute deletions are grouped by the time range they apply to.
+    to_delete = {}
+    for subject, attributes, start, end in (
+        mutation_pool.delete_attributes_requests):
+      if isinstance(attributes, basestring):
+        raise ValueError(
+            "String passed to DeleteAttributes (non string iterable expected).")
+      subject = utils.SmartUnicode(subject)
+      to_delete.setdefault(self._MakeTimestamp(start, end), []).extend(
+          (subject, utils.SmartUnicode(attribute)) for attribute in attributes)
+
+    for timestamp, pairs in to_delete.iteritems():
+      transaction.extend(
+          self._BuildMultiDelete(pairs, timestamp, cleanup_attributes=True))
+
+    to_replace, to_insert = self._FlattenSetRequests(mutation_pool.set_requests)
+    if to_replace:
+      transaction.extend(self._BuildMultiDelete(to_replace))
+    if to_insert:
+      transaction.extend(
+          self._BuildInserts([[subject, attribute, self._Encode(value), ts]
+                              for subject, attribute, value, ts in to_insert]))
+
+    if transaction:
+      self._ExecuteTransaction(transaction)
+
   def ResolveMulti(self, subject, attributes, timestamp=None, limit=None):
     """Resolves multiple attributes at once for one subject."""
     for attribute in attributes:
@@ -279,6 +317,10 @@ class MySQLAdvancedDataStore(data_store.DataStore):
                          timestamp=None,
                          limit=None):
     """Result multiple subjects using one or more attribute regexps."""
+    if not limit and self._GetReadPool() is not None:
+      return self._ParallelMultiResolvePrefix(subjects, attribute_prefix,
+                                              timestamp)
+
     result = {}
 
     for subject in subjects:
@@ -295,6 +337,26 @@ class MySQLAdvancedDataStore(data_store.DataStore):
 
     return result.iteritems()
 
+  def _ParallelMultiResolvePrefix(self, subjects, attribute_prefix, timestamp):
+    """Resolves chunks of subjects in parallel using the connection pool."""
+    subjects = list(collections.OrderedDict.fromkeys(subjects))
+    # One chunk per thread, each chunk uses its own pooled connection.
+    chunk_size = max(1, (len(subjects) + self.read_pool_size - 1) //
+                     self.read_pool_size)
+
+    def _ResolveSubjects(chunk):
+      return [(subject,
+               self.ResolvePrefix(
+                   subject, attribute_prefix, timestamp=timestamp))
+              for subject in chunk]
+
+    result = []
+    for chunk_results in self._ParallelMap(
+        _ResolveSubjects, utils.Grouper(subjects, chunk_size)):
+      result.extend((s, values) for s, values in chunk_results if values)
+
+    return iter(result)
+
   def ResolvePrefix(self, subject, attribute_prefix, timestamp=None,
                     limit=None):
     """ResolvePrefix."""
@@ -365,10 +427,13 @@ class MySQLAdvancedDataStore(data_store.DataStore):
 
     results = {}
 
-    for attribute in attributes:
-      attribute_results = self._ScanAttribute(
+    def _Scan(attribute):
+      return self._ScanAttribute(
           subject_prefix, attribute, after_urn=after_urn, limit=max_records)
 
+    attributes = list(attributes)
+    scans = self._ParallelMap(_Scan, attributes)
+    for attribute, attribute_results in zip(attributes, scans):
       for row in attribute_results:
         subject = row["subject"]
         timestamp = row["timestamp"]
@@ -527,8 +592,8 @@ class MySQLAdvancedDataStore(data_store.DataStore):
     attributes_q["args"] = []
 
     seen = {}
-    seen["subjects"] = []
-    seen["attributes"] = []
+    seen["subjects"] = set()
+    seen["attributes"] = set()
 
     result_queries = []
     current_args = []
@@ -537,10 +602,10 @@ class MySQLAdvancedDataStore(data_store.DataStore):
     for (subject, attribute, value, timestamp) in values:
       if subject not in seen["subjects"]:
         subjects_q["args"].extend([subject, subject])
-        seen["subjects"].append(subject)
+        seen["subjects"].add(subject)
       if attribute not in seen["attributes"]:
         attributes_q["args"].extend([attribute, attribute])
-        seen["attributes"].append(attribute)
+        seen["attributes"].add(attribute)
 
       current_args.extend([subject, attribute, timestamp, timestamp, value])
       total_value_len += len(value)
@@ -756,6 +821,63 @@ class MySQLAdvancedDataStore(data_store.DataStore):
 
     return [aff4_q, locks_q, subjects_q]
 
+  def _BuildMultiDeleteSubjects(self, subjects):
+    """Build DELETE queries removing a list of subjects."""
+    queries = []
+    for chunk in utils.Grouper(subjects, self.max_values_per_query):
+      hashes = ", ".join(["unhex(md5(%s))"] * len(chunk))
+      for table, column in [("aff4", "subject_hash"), ("locks", "subject_hash"),
+                            ("subjects", "hash")]:
+        queries.append({
+            "query": "DELETE %s FROM %s WHERE %s IN (%s)" % (table, table,
+                                                             column, hashes),
+            "args": list(chunk)
+        })
+    return queries
+
+  def _BuildMultiDelete(self, pairs, timestamp=None, cleanup_attributes=False):
+    """Build DELETE queries for a list of (subject, attribute) pairs.
+
+    Args:
+      pairs: A list of (subject, attribute) tuples.
+      timestamp: A (start, end) tuple as returned by _MakeTimestamp() or None
+        to delete all versions.
+      cleanup_attributes: If True, attributes that are no longer referenced are
+        also removed from the attributes table.
+
+    Returns:
+      A list of query dicts.
+    """
+    queries = []
+    for chunk in utils.Grouper(pairs, self.max_values_per_query):
+      query = ("DELETE aff4 FROM aff4 WHERE (" + " OR ".join(
+          ["(subject_hash=unhex(md5(%s)) AND attribute_hash=unhex(md5(%s)))"] *
+          len(chunk)) + ")")
+      args = []
+      for subject, attribute in chunk:
+        args.extend([subject, attribute])
+
+      if isinstance(timestamp, (tuple, list)):
+        query += " AND aff4.timestamp >= %s AND aff4.timestamp <= %s"
+        args.append(int(timestamp[0]))
+        args.append(int(timestamp[1]))
+
+      queries.append({"query": query, "args": args})
+
+    if cleanup_attributes:
+      attributes = list(set(attribute for _, attribute in pairs))
+      for chunk in utils.Grouper(attributes, self.max_values_per_query):
+        queries.append({
+            "query": "DELETE attributes FROM attributes LEFT JOIN aff4 ON "
+                     "aff4.attribute_hash=attributes.hash "
+                     "WHERE attributes.hash IN (%s) "
+                     "AND aff4.attribute_hash IS NULL" % ", ".join(
+                         ["unhex(md5(%s))"] * len(chunk)),
+            "args": list(chunk)
+        })
+
+    return queries
+
   def _MakeTimestamp(self, start=None, end=None):
     """Create a timestamp using a start and end time.
 
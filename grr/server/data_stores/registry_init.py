@@ -4,6 +4,7 @@
 
 # pylint: disable=g-import-not-at-top,unused-import,g-line-too-long
 
+from grr.server.data_stores import caching_data_store
 from grr.server.data_stores import fake_data_store
 
 try:
@@ -6,6 +6,7 @@ SQLite database files are created by taking the root of each AFF4 object.
 
 
 
+import collections
 import itertools
 import logging
 import os
@@ -275,6 +276,14 @@ class SqliteConnection(object):
                         args)
       raise
 
+  def ExecuteMany(self, query, seq_of_args):
+    try:
+      return self.cursor.executemany(query, seq_of_args)
+    except sqlite3.DatabaseError:
+      logging.exception("DB error in file: %s for query: %s", self.filename,
+                        query)
+      raise
+
   @utils.Synchronized
   def GetLock(self, subject):
     """Gets the expiration time for a given subject."""
@@ -505,6 +514,45 @@ class SqliteConnection(object):
     self.dirty = True
     self.deleted += self.cursor.rowcount
 
+  @utils.Synchronized
+  def DeleteSubjects(self, subjects):
+    """Deletes information about multiple subjects."""
+    query = "DELETE FROM tbl WHERE subject = ?"
+    self.ExecuteMany(query, [(utils.SmartStr(s),) for s in subjects])
+    self.dirty = True
+    self.deleted += self.cursor.rowcount
+
+  @utils.Synchronized
+  def DeleteAttributes(self, pairs):
+    """Deletes all values for a list of (subject, attribute) pairs."""
+    query = "DELETE FROM tbl WHERE subject = ? AND predicate = ?"
+    args = [(utils.SmartStr(subject), utils.SmartStr(attribute))
+            for subject, attribute in pairs]
+    self.ExecuteMany(query, args)
+    self.dirty = True
+    self.deleted += self.cursor.rowcount
+
+  @utils.Synchronized
+  def DeleteAttributeRanges(self, ranges):
+    """Deletes values for a list of (subject, attribute, start, end) ranges."""
+    query = """DELETE FROM tbl WHERE subject = ? AND predicate = ?
+               AND timestamp >= ? AND timestamp <= ?"""
+    args = [(utils.SmartStr(subject), utils.SmartStr(attribute), int(start),
+             int(end)) for subject, attribute, start, end in ranges]
+    self.ExecuteMany(query, args)
+    self.dirty = True
+    self.deleted += self.cursor.rowcount
+
+  @utils.Synchronized
+  def SetAttributes(self, rows):
+    """Inserts a list of (subject, attribute, value, timestamp) rows."""
+    query = "INSERT INTO tbl VALUES (?, ?, ?, ?)"
+    args = [(utils.SmartStr(subject), utils.SmartStr(attribute), timestamp,
+             value) for subject, attribute, value, timestamp in rows]
+    self.ExecuteMany(query, args)
+    self.dirty = True
+    self.deleted = max(0, self.deleted - self.cursor.rowcount)
+
   def PrettyPrint(self):
     """Print the SQLite database."""
     query = "SELECT subject, predicate, timestamp, value FROM tbl"
@@ -602,6 +650,29 @@ class SqliteConnection(object):
     self.cursor = None
 
 
+class SqliteMutations(object):
+  """Mutations that have to be applied to a single SQLite database file."""
+
+  def __init__(self, connection):
+    self.connection = connection
+    self.subjects_to_delete = []
+    self.attributes_to_delete = []
+    self.ranges_to_delete = []
+    self.rows_to_insert = []
+
+  def Apply(self):
+    """Applies all mutations in a single transaction."""
+    with self.connection as sqlite_connection:
+      if self.subjects_to_delete:
+        sqlite_connection.DeleteSubjects(self.subjects_to_delete)
+      if self.ranges_to_delete:
+        sqlite_connection.DeleteAttributeRanges(self.ranges_to_delete)
+      if self.attributes_to_delete:
+        sqlite_connection.DeleteAttributes(self.attributes_to_delete)
+      if self.rows_to_insert:
+        sqlite_connection.SetAttributes(self.rows_to_insert)
+
+
 class SqliteDataStore(data_store.DataStore):
   """A file based data store using the SQLite database."""
 
@@ -717,12 +788,58 @@ class SqliteDataStore(data_store.DataStore):
     with self.cache.Get(subject) as sqlite_connection:
       sqlite_connection.DeleteSubject(subject)
 
+  def MultiApplyMutations(self, mutation_pool):
+    """Applies a mutation pool using one transaction per database file."""
+    mutations = collections.OrderedDict()
+
+    def _GetMutations(subject):
+      connection = self.cache.Get(subject)
+      try:
+        return mutations[connection.Filename()]
+      except KeyError:
+        result = mutations[connection.Filename()] = SqliteMutations(connection)
+        return result
+
+    for subject in mutation_pool.delete_subject_requests:
+      _GetMutations(subject).subjects_to_delete.append(subject)
+
+    for subject, attributes, start, end in (
+        mutation_pool.delete_attributes_requests):
+      if isinstance(attributes, basestring):
+        raise ValueError(
+            "String passed to DeleteAttributes (non string iterable expected).")
+
+      subject_mutations = _GetMutations(subject)
+      if start is None and end is None:
+        subject_mutations.attributes_to_delete.extend(
+            (subject, attribute) for attribute in attributes)
+      else:
+        start = start or 0
+        if end is None:
+          end = (2**63) - 1  # sys.maxint
+        subject_mutations.ranges_to_delete.extend(
+            (subject, attribute, start, end) for attribute in attributes)
+
+    to_delete, to_insert = self._FlattenSetRequests(mutation_pool.set_requests)
+    for subject, attribute in to_delete:
+      _GetMutations(subject).attributes_to_delete.append((subject, attribute))
+    for subject, attribute, value, timestamp in to_insert:
+      _GetMutations(subject).rows_to_insert.append(
+          (subject, attribute, self._Encode(value), timestamp))
+
+    for database_mutations in mutations.itervalues():
+      database_mutations.Apply()
+
   def MultiResolvePrefix(self,
                          subjects,
                          attribute_prefix,
                          timestamp=None,
                          limit=None):
     """Result multiple subjects using one or more attribute prefixes."""
+    if not limit and self._GetReadPool() is not None:
+      return self._ParallelMultiResolvePrefix(subjects, attribute_prefix,
+                                              timestamp)
+
     result = {}
 
     remaining_limit = limit
@@ -740,6 +857,36 @@ class SqliteDataStore(data_store.DataStore):
 
     return result.iteritems()
 
+  def _ParallelMultiResolvePrefix(self, subjects, attribute_prefix, timestamp):
+    """Resolves subjects stored in different database files in parallel."""
+    subjects_by_file = collections.OrderedDict()
+    ordered_subjects = []
+    seen = set()
+    for subject in subjects:
+      if subject in seen:
+        continue
+      seen.add(subject)
+      ordered_subjects.append(subject)
+      filename = self.cache.Get(subject).Filename()
+      subjects_by_file.setdefault(filename, []).append(subject)
+
+    def _ResolveSubjects(file_subjects):
+      return [(subject,
+               self.ResolvePrefix(
+                   subject, attribute_prefix, timestamp=timestamp))
+              for subject in file_subjects]
+
+    result = {}
+    for file_results in self._ParallelMap(_ResolveSubjects,
+                                          subjects_by_file.values()):
+      for subject, values in file_results:
+        if values:
+          result[subject] = values
+
+    # Results are returned in the order of the requested subjects.
+    return ((subject, result[subject]) for subject in ordered_subjects
+            if subject in result)
+
   def _GetStartEndTimestamp(self, timestamp):
     if timestamp == self.ALL_TIMESTAMPS or timestamp is None:
       return 0, (2**63) - 1
@@ -851,15 +998,19 @@ class SqliteDataStore(data_store.DataStore):
                     max_records=max_records)), max_records):
           yield r
       return
+
+    def _ScanConnection(sqlite_connection):
+      return list(
+          sqlite_connection.ScanAttributes(
+              subject_prefix,
+              attributes,
+              after_urn=after_urn,
+              max_records=max_records))
+
     raw_results = []
-    for sqlite_connection in itertools.chain(first_connections,
-                                             connection_iter):
-      for record in sqlite_connection.ScanAttributes(
-          subject_prefix,
-          attributes,
-          after_urn=after_urn,
-          max_records=max_records):
-        raw_results.append(record)
+    for records in self._ParallelMap(
+        _ScanConnection, itertools.chain(first_connections, connection_iter)):
+      raw_results.extend(records)
     for r in self._GroupSubjects(
         sorted(raw_results, key=lambda x: x[0]), max_records):
       yield r
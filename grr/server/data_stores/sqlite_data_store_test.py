@@ -29,6 +29,19 @@ class SqliteDataStoreTest(data_store_test.DataStoreTestMixin, SqliteTestMixin,
                           test_lib.GRRBaseTest):
   """Test the sqlite data store."""
 
+  def testParallelMultiResolvePrefixKeepsOrder(self):
+    subjects = ["aff4:/C.%016X" % i for i in range(20)]
+    for subject in subjects:
+      data_store.DB.Set(subject, "aff4:foo", subject)
+    subjects.reverse()
+
+    with test_lib.ConfigOverrider({"Datastore.read_threadpool_size": 4}):
+      result = list(data_store.DB.MultiResolvePrefix(subjects, "aff4:"))
+
+    self.assertEqual([subject for subject, _ in result], subjects)
+    for subject, values in result:
+      self.assertEqual(values[0][1], subject)
+
 
 def main(args):
   test_lib.main(args)
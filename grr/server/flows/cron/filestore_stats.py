@@ -3,26 +3,32 @@
 
 from grr.lib import rdfvalue
 from grr.lib import stats as stats_lib
-from grr.lib import utils
 from grr.server import aff4
+from grr.server import data_store
 from grr.server import flow
 
 from grr.server.aff4_objects import cronjobs
+from grr.server.aff4_objects import filestore
 from grr.server.aff4_objects import stats as aff4_stats
 
 
 class ClassCounter(object):
   """Populates a stats.Graph with counts of each object class."""
 
-  def __init__(self, attribute, title):
+  def __init__(self, attribute, title, value_dict=None):
     self.attribute = attribute
-    self.value_dict = {}
+    self.value_dict = dict(value_dict or {})
     self.graph = self.attribute(title=title)
 
   def ProcessFile(self, fd):
-    classname = fd.__class__.__name__
+    self.AddFile(fd.__class__.__name__, fd.Get(fd.Schema.SIZE))
+
+  def AddFile(self, classname, unused_size):
     self.value_dict[classname] = self.value_dict.get(classname, 0) + 1
 
+  def GetState(self):
+    return self.value_dict
+
   def Save(self, fd):
     for classname, count in self.value_dict.items():
       self.graph.Append(label=classname, y_value=count)
@@ -34,10 +40,8 @@ class ClassFileSizeCounter(ClassCounter):
 
   GB = 1024 * 1024 * 1024
 
-  def ProcessFile(self, fd):
-    classname = fd.__class__.__name__
-    self.value_dict[classname] = self.value_dict.get(
-        classname, 0) + fd.Get(fd.Schema.SIZE)
+  def AddFile(self, classname, size):
+    self.value_dict[classname] = self.value_dict.get(classname, 0) + size
 
   def Save(self, fd):
     for classname, count in self.value_dict.items():
@@ -50,14 +54,22 @@ class GraphDistribution(stats_lib.Distribution):
 
   _bins = []
 
-  def __init__(self, attribute, title):
+  def __init__(self, attribute, title, heights=None):
     self.attribute = attribute
     self.graph = self.attribute(title=title)
     super(GraphDistribution, self).__init__(bins=self._bins)
+    if heights:
+      self.heights = list(heights)
 
   def ProcessFile(self, fd):
     raise NotImplementedError()
 
+  def AddFile(self, classname, size):
+    raise NotImplementedError()
+
+  def GetState(self):
+    return list(self.heights)
+
   def Save(self, fd):
     for x, y in sorted(self.bins_heights.items()):
       if x >= 0:
@@ -77,49 +89,152 @@ class FileSizeHistogram(GraphDistribution):
   def ProcessFile(self, fd):
     self.Record(fd.Get(fd.Schema.SIZE))
 
+  def AddFile(self, unused_classname, size):
+    self.Record(size)
+
 
 class FilestoreStatsCronFlow(cronjobs.SystemCronFlow):
-  """Build statistics about the filestore."""
-  frequency = rdfvalue.Duration("1w")
+  """Build statistics about the filestore.
+
+  The statistics are maintained incrementally. HashFileStore.AddFile records
+  the class and size of every new file in HashFileStore.ADDITIONS_URN and each
+  run only folds the records written since the previous run into aggregates
+  which are persisted together with the position in the log. The aggregates
+  are initialized by scanning the hash store once, in batches which are
+  checkpointed so that an interrupted scan resumes where it stopped.
+  """
+  frequency = rdfvalue.Duration("1d")
   lifetime = rdfvalue.Duration("1d")
   HASH_PATH = "aff4:/files/hash/generic/sha256"
   FILESTORE_STATS_URN = rdfvalue.RDFURN("aff4:/stats/FileStoreStats")
   OPEN_FILES_LIMIT = 5000
-
-  def _CreateConsumers(self):
-    self.consumers = [
-        ClassCounter(self.stats.Schema.FILESTORE_FILETYPES,
-                     "Number of files in the filestore by type"),
-        ClassFileSizeCounter(
-            self.stats.Schema.FILESTORE_FILETYPES_SIZE,
-            "Total filesize (GB) files in the filestore by type"),
-        FileSizeHistogram(self.stats.Schema.FILESTORE_FILESIZE_HISTOGRAM,
-                          "Filesize distribution in bytes"),
+  # Additions are only processed once they are this old, so records which were
+  # timestamped but not yet written when the log was read are not skipped.
+  ADDITIONS_GRACE_PERIOD = rdfvalue.Duration("10m")
+
+  def _CreateConsumers(self, state):
+    self.consumers = {
+        "class_counts":
+            ClassCounter(self.stats.Schema.FILESTORE_FILETYPES,
+                         "Number of files in the filestore by type",
+                         state.get("class_counts")),
+        "class_sizes":
+            ClassFileSizeCounter(
+                self.stats.Schema.FILESTORE_FILETYPES_SIZE,
+                "Total filesize (GB) files in the filestore by type",
+                state.get("class_sizes")),
+        "size_histogram":
+            FileSizeHistogram(self.stats.Schema.FILESTORE_FILESIZE_HISTOGRAM,
+                              "Filesize distribution in bytes",
+                              state.get("size_histogram")),
+    }
+
+  def _Checkpoint(self, state):
+    """Persists the aggregates and cursors and keeps the flow alive."""
+    for name, consumer in self.consumers.items():
+      state[name] = consumer.GetState()
+    self.stats.Set(self.stats.Schema.AGGREGATION_STATE(state))
+    self.stats.Flush()
+    self.HeartBeat()
+
+  def _ScanHashStore(self, state):
+    """Adds the files in the hash store, resuming an interrupted scan."""
+    attributes = [
+        aff4.AFF4Object.SchemaCls.TYPE.predicate,
+        aff4.AFF4Stream.SchemaCls.SIZE.predicate
     ]
+    prefix = self.HASH_PATH + "/"
+
+    while not state["hash_scan_done"]:
+      scanned = 0
+      for subject, values in data_store.DB.ScanAttributes(
+          self.HASH_PATH,
+          attributes,
+          after_urn=state["hash_scan_cursor"],
+          max_records=self.OPEN_FILES_LIMIT):
+        scanned += 1
+        state["hash_scan_cursor"] = subject
+
+        # Only the files themselves are counted, not objects nested below them.
+        if "/" in subject[len(prefix):]:
+          continue
+
+        aff4_type = attributes[0]
+        if aff4_type not in values:
+          continue
+
+        local_cache = {
+            subject: [(attribute, value, timestamp)
+                      for attribute, (timestamp, value) in values.iteritems()]
+        }
+        fd = aff4.FACTORY.Open(
+            subject, mode="r", token=self.token, local_cache=local_cache)
+        for consumer in self.consumers.values():
+          consumer.ProcessFile(fd)
+
+      state["hash_scan_done"] = scanned < self.OPEN_FILES_LIMIT
+      self._Checkpoint(state)
+
+  def _ProcessAdditions(self, state):
+    """Adds the files recorded by HashFileStore.AddFile since the last run."""
+    additions = filestore.FileStoreAdditionsCollection(
+        filestore.HashFileStore.ADDITIONS_URN)
+    cutoff = (rdfvalue.RDFDatetime.Now() - self.ADDITIONS_GRACE_PERIOD
+             ).AsMicroSecondsFromEpoch()
+
+    for batch in additions.ScanBatches(
+        batch_size=self.OPEN_FILES_LIMIT,
+        after_timestamp=tuple(state["additions_cursor"]),
+        include_suffix=True):
+      for timestamp, sample in batch:
+        if timestamp[0] > cutoff:
+          self._Checkpoint(state)
+          return
+
+        for consumer in self.consumers.values():
+          consumer.AddFile(sample.label, sample.x_value)
+        state["additions_cursor"] = list(timestamp)
+
+      self._Checkpoint(state)
+
+  def _TrimAdditions(self, state):
+    """Deletes the additions which were already counted."""
+    with data_store.DB.GetMutationPool() as mutation_pool:
+      mutation_pool.CollectionDeleteUpTo(filestore.HashFileStore.ADDITIONS_URN,
+                                         *state["additions_cursor"])
 
   @flow.StateHandler()
   def Start(self):
-    """Retrieve all the clients for the AbstractClientStatsCollectors."""
+    """Updates the filestore statistics with the files added since last run."""
     self.stats = aff4.FACTORY.Create(
         self.FILESTORE_STATS_URN,
         aff4_stats.FilestoreStats,
-        mode="w",
+        mode="rw",
         token=self.token)
 
-    self._CreateConsumers()
-    hashes = aff4.FACTORY.Open(
-        self.HASH_PATH, token=self.token).ListChildren(limit=10**8)
-
+    state = self.stats.Get(self.stats.Schema.AGGREGATION_STATE)
+    if state:
+      state = state.ToDict()
+    else:
+      # The additions log only needs to be read from the moment the hash store
+      # scan starts. Files added while the scan is running may be counted
+      # twice, this only happens on the very first run.
+      state = {
+          "hash_scan_cursor": None,
+          "hash_scan_done": False,
+          "additions_cursor": [
+              rdfvalue.RDFDatetime.Now().AsMicroSecondsFromEpoch(), 0
+          ],
+      }
+
+    self._CreateConsumers(state)
     try:
-      for urns in utils.Grouper(hashes, self.OPEN_FILES_LIMIT):
-        for fd in aff4.FACTORY.MultiOpen(
-            urns, mode="r", token=self.token, age=aff4.NEWEST_TIME):
-
-          for consumer in self.consumers:
-            consumer.ProcessFile(fd)
-        self.HeartBeat()
-
+      self._ScanHashStore(state)
+      self._ProcessAdditions(state)
+      # The cursor was persisted by _ProcessAdditions so the records before
+      # it will never be read again.
+      self._TrimAdditions(state)
     finally:
-      for consumer in self.consumers:
+      for consumer in self.consumers.values():
         consumer.Save(self.stats)
       self.stats.Close()
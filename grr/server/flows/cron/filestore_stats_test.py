@@ -2,7 +2,9 @@
 """Tests for grr.server.flows.cron.filestore_stats."""
 
 from grr.lib import flags
+from grr.lib import rdfvalue
 from grr.server import aff4
+from grr.server.aff4_objects import aff4_grr
 from grr.server.aff4_objects import filestore as aff4_filestore
 from grr.server.flows.cron import filestore_stats
 from grr.test_lib import flow_test_lib
@@ -75,6 +77,107 @@ class FilestoreStatsCronFlowTest(flow_test_lib.FlowTestsBaseclass):
     self.assertEqual(filesizes.data[9].y_value, 5)
     self.assertEqual(filesizes.data[-1].y_value, 1)
 
+  def _AddFile(self, path, content):
+    with aff4.FACTORY.Create(
+        path, aff4_grr.VFSMemoryFile, mode="rw", token=self.token) as fd:
+      fd.Write(content)
+
+    hash_store = aff4.FACTORY.Open(
+        aff4_filestore.HashFileStore.PATH,
+        aff4_type=aff4_filestore.HashFileStore,
+        mode="rw",
+        token=self.token)
+    hash_store.AddFile(aff4.FACTORY.Open(path, mode="rw", token=self.token))
+
+  def _GetFileTypes(self):
+    fd = aff4.FACTORY.Open(
+        filestore_stats.FilestoreStatsCronFlow.FILESTORE_STATS_URN,
+        token=self.token)
+    return dict((sample.label, sample.y_value)
+                for sample in fd.Get(fd.Schema.FILESTORE_FILETYPES).data)
+
+  def testOnlyAddedFilesAreProcessedAfterTheFirstRun(self):
+    now = rdfvalue.RDFDatetime.Now()
+    with test_lib.FakeTime(now):
+      for _ in flow_test_lib.TestFlowHelper(
+          filestore_stats.FilestoreStatsCronFlow.__name__, token=self.token):
+        pass
+
+    self.assertEqual(self._GetFileTypes(), {"FileStoreImage": 12})
+
+    with test_lib.FakeTime(now + rdfvalue.Duration("1h")):
+      self._AddFile("aff4:/C.0000000000000001/fs/os/new1", "new file 1")
+      self._AddFile("aff4:/C.0000000000000001/fs/os/new2", "new file 2")
+      # Adding known content again does not create a new file in the store.
+      self._AddFile("aff4:/C.0000000000000002/fs/os/new1", "new file 1")
+
+      # Files which were not added through AddFile are only picked up by the
+      # initial scan of the hash store.
+      with aff4.FACTORY.Create(
+          "aff4:/files/hash/generic/sha256/fsi_unrecorded",
+          aff4_filestore.FileStoreImage,
+          token=self.token) as newfd:
+        newfd.size = 10
+
+    # Additions are ignored until they are older than the grace period.
+    with test_lib.FakeTime(now + rdfvalue.Duration("61m")):
+      for _ in flow_test_lib.TestFlowHelper(
+          filestore_stats.FilestoreStatsCronFlow.__name__, token=self.token):
+        pass
+
+    self.assertEqual(self._GetFileTypes(), {"FileStoreImage": 12})
+
+    for _ in range(2):
+      with test_lib.FakeTime(now + rdfvalue.Duration("2h")):
+        for _ in flow_test_lib.TestFlowHelper(
+            filestore_stats.FilestoreStatsCronFlow.__name__, token=self.token):
+          pass
+
+      self.assertEqual(self._GetFileTypes(), {
+          "FileStoreImage": 12,
+          "VFSMemoryFile": 2
+      })
+
+  def testProcessedAdditionsAreDeleted(self):
+    additions = aff4_filestore.FileStoreAdditionsCollection(
+        aff4_filestore.HashFileStore.ADDITIONS_URN)
+    now = rdfvalue.RDFDatetime.Now()
+    with test_lib.FakeTime(now):
+      for _ in flow_test_lib.TestFlowHelper(
+          filestore_stats.FilestoreStatsCronFlow.__name__, token=self.token):
+        pass
+
+    with test_lib.FakeTime(now + rdfvalue.Duration("1h")):
+      self._AddFile("aff4:/C.0000000000000001/fs/os/new1", "new file 1")
+    with test_lib.FakeTime(now + rdfvalue.Duration("2h")):
+      self._AddFile("aff4:/C.0000000000000001/fs/os/new2", "new file 2")
+    self.assertEqual(len(list(additions)), 2)
+
+    # Only the addition which is older than the grace period is processed and
+    # deleted.
+    with test_lib.FakeTime(now + rdfvalue.Duration("2h")):
+      for _ in flow_test_lib.TestFlowHelper(
+          filestore_stats.FilestoreStatsCronFlow.__name__, token=self.token):
+        pass
+
+    self.assertEqual(self._GetFileTypes(), {
+        "FileStoreImage": 12,
+        "VFSMemoryFile": 1
+    })
+    self.assertEqual([sample.x_value for sample in additions],
+                     [len("new file 2")])
+
+    with test_lib.FakeTime(now + rdfvalue.Duration("3h")):
+      for _ in flow_test_lib.TestFlowHelper(
+          filestore_stats.FilestoreStatsCronFlow.__name__, token=self.token):
+        pass
+
+    self.assertEqual(self._GetFileTypes(), {
+        "FileStoreImage": 12,
+        "VFSMemoryFile": 2
+    })
+    self.assertEqual(list(additions), [])
+
 
 def main(argv):
   # Run the full test suite
@@ -9,7 +9,9 @@ import time
 from grr import config
 from grr.endtoend_tests import base
 from grr.lib import rdfvalue
+from grr.lib import registry
 from grr.lib import utils
+from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.lib.rdfvalues import stats as rdfstats
 from grr.server import access_control
@@ -38,14 +40,21 @@ class _ActiveCounter(object):
 
   active_days = [1, 7, 14, 30]
 
-  def __init__(self, attribute):
+  def __init__(self, attribute, categories=None):
     """Constructor.
 
     Args:
        attribute: The histogram object will be stored in this attribute.
+       categories: A dict holding the counts so far. It is updated in place so
+         it can be kept in the flow state.
     """
     self.attribute = attribute
-    self.categories = dict([(x, {}) for x in self.active_days])
+    if categories is None:
+      categories = {}
+
+    self.categories = categories
+    for x in self.active_days:
+      self.categories.setdefault(x, {})
 
   def Add(self, category, label, age):
     """Adds another instance of this category into the active_days counter.
@@ -90,13 +99,26 @@ class _ActiveCounter(object):
       # pylint: enable=protected-access
 
 
-class AbstractClientStatsCronFlow(cronjobs.SystemCronFlow):
-  """A cron job which opens every client in the system.
+class ClientStatsProcessor(object):
+  """Computes a statistic over all clients in the fleet.
 
-  We feed all the client objects to the AbstractClientStatsCollector instances.
+  Processors are fed every client by the single fleet scan of an
+  AbstractClientStatsCronFlow. The scan is split over several flow states, so
+  processors keep everything they accumulate in self.data, which is stored in
+  the flow state between batches. It must only contain values which can be
+  stored in a protodict.
   """
 
-  CLIENT_STATS_URN = rdfvalue.RDFURN("aff4:/stats/ClientFleetStats")
+  __metaclass__ = registry.MetaclassRegistry
+  __abstract = True  # pylint: disable=g-bad-name
+
+  # The client attributes read by ProcessClient(). Clients are read with only
+  # these attributes and their labels.
+  attributes = []
+
+  def __init__(self, cron_flow, data):
+    self.cron_flow = cron_flow
+    self.data = data
 
   def BeginProcessing(self):
     pass
@@ -114,60 +136,25 @@ class AbstractClientStatsCronFlow(cronjobs.SystemCronFlow):
     client_labels.extend(label_set)
     return client_labels
 
-  def _StatsForLabel(self, label):
-    if label not in self.stats:
-      self.stats[label] = aff4.FACTORY.Create(
-          self.CLIENT_STATS_URN.Add(label),
-          aff4_stats.ClientFleetStats,
-          mode="w",
-          token=self.token)
-    return self.stats[label]
-
-  @flow.StateHandler()
-  def Start(self):
-    """Retrieve all the clients for the AbstractClientStatsCollectors."""
-    try:
-
-      self.stats = {}
-
-      self.BeginProcessing()
-
-      root = aff4.FACTORY.Open(aff4.ROOT_URN, token=self.token)
-      children_urns = list(root.ListChildren())
-      logging.debug("Found %d children.", len(children_urns))
-
-      processed_count = 0
-      for child in aff4.FACTORY.MultiOpen(
-          children_urns, mode="r", token=self.token, age=aff4.NEWEST_TIME):
-        if isinstance(child, aff4_grr.VFSGRRClient):
-          self.ProcessClient(child)
-          processed_count += 1
-
-        # This flow is not dead: we don't want to run out of lease time.
-        self.HeartBeat()
-
-      self.FinishProcessing()
-      for fd in self.stats.values():
-        fd.Close()
-
-      logging.info("%s: processed %d clients.", self.__class__.__name__,
-                   processed_count)
-    except Exception as e:  # pylint: disable=broad-except
-      logging.exception("Error while calculating stats: %s", e)
-      raise
-
 
-class GRRVersionBreakDown(AbstractClientStatsCronFlow):
+class GRRVersionProcessor(ClientStatsProcessor):
   """Records relative ratios of GRR versions in 7 day actives."""
 
-  frequency = rdfvalue.Duration("4h")
+  attributes = [
+      aff4_grr.VFSGRRClient.SchemaCls.PING,
+      aff4_grr.VFSGRRClient.SchemaCls.CLIENT_INFO
+  ]
 
   def BeginProcessing(self):
-    self.counter = _ActiveCounter(
-        aff4_stats.ClientFleetStats.SchemaCls.GRRVERSION_HISTOGRAM)
+    self.data["counter"] = {}
+
+  def _Counter(self):
+    return _ActiveCounter(
+        aff4_stats.ClientFleetStats.SchemaCls.GRRVERSION_HISTOGRAM,
+        self.data["counter"])
 
   def FinishProcessing(self):
-    self.counter.Save(self)
+    self._Counter().Save(self.cron_flow)
 
   def ProcessClient(self, client):
     ping = client.Get(client.Schema.PING)
@@ -179,23 +166,36 @@ class GRRVersionBreakDown(AbstractClientStatsCronFlow):
           str(c_info.client_version)
       ])
 
+      counter = self._Counter()
       for label in self.GetClientLabelsList(client):
-        self.counter.Add(category, label, ping)
+        counter.Add(category, label, ping)
 
 
-class OSBreakDown(AbstractClientStatsCronFlow):
+class OSProcessor(ClientStatsProcessor):
   """Records relative ratios of OS versions in 7 day actives."""
 
+  attributes = [
+      aff4_grr.VFSGRRClient.SchemaCls.PING,
+      aff4_grr.VFSGRRClient.SchemaCls.SYSTEM,
+      aff4_grr.VFSGRRClient.SchemaCls.UNAME
+  ]
+
   def BeginProcessing(self):
-    self.counters = [
-        _ActiveCounter(aff4_stats.ClientFleetStats.SchemaCls.OS_HISTOGRAM),
-        _ActiveCounter(aff4_stats.ClientFleetStats.SchemaCls.RELEASE_HISTOGRAM),
+    self.data["os"] = {}
+    self.data["release"] = {}
+
+  def _Counters(self):
+    return [
+        _ActiveCounter(aff4_stats.ClientFleetStats.SchemaCls.OS_HISTOGRAM,
+                       self.data["os"]),
+        _ActiveCounter(aff4_stats.ClientFleetStats.SchemaCls.RELEASE_HISTOGRAM,
+                       self.data["release"]),
     ]
 
   def FinishProcessing(self):
     # Write all the counter attributes.
-    for counter in self.counters:
-      counter.Save(self)
+    for counter in self._Counters():
+      counter.Save(self.cron_flow)
 
   def ProcessClient(self, client):
     """Update counters for system, version and release attributes."""
@@ -205,41 +205,47 @@ class OSBreakDown(AbstractClientStatsCronFlow):
     system = client.Get(client.Schema.SYSTEM, "Unknown")
     uname = client.Get(client.Schema.UNAME, "Unknown")
 
+    counters = self._Counters()
     for label in self.GetClientLabelsList(client):
       # Windows, Linux, Darwin
-      self.counters[0].Add(system, label, ping)
+      counters[0].Add(system, label, ping)
 
       # Windows-2008ServerR2-6.1.7601SP1, Linux-Ubuntu-12.04,
       # Darwin-OSX-10.9.3
-      self.counters[1].Add(uname, label, ping)
+      counters[1].Add(uname, label, ping)
 
 
-class LastAccessStats(AbstractClientStatsCronFlow):
+class LastAccessProcessor(ClientStatsProcessor):
   """Calculates a histogram statistics of clients last contacted times."""
 
+  attributes = [aff4_grr.VFSGRRClient.SchemaCls.PING]
+
   # The number of clients fall into these bins (number of hours ago)
   _bins = [1, 2, 3, 7, 14, 30, 60]
 
+  def __init__(self, cron_flow, data):
+    super(LastAccessProcessor, self).__init__(cron_flow, data)
+    self._bins = [long(x * 1e6 * 24 * 60 * 60) for x in self._bins]
+
   def _ValuesForLabel(self, label):
-    if label not in self.values:
-      self.values[label] = [0] * len(self._bins)
-    return self.values[label]
+    values = self.data["values"]
+    if label not in values:
+      values[label] = [0] * len(self._bins)
+    return values[label]
 
   def BeginProcessing(self):
-    self._bins = [long(x * 1e6 * 24 * 60 * 60) for x in self._bins]
-
-    self.values = {}
+    self.data["values"] = {}
 
   def FinishProcessing(self):
     # Build and store the graph now. Day actives are cumulative.
-    for label in self.values.iterkeys():
+    for label, values in self.data["values"].iteritems():
       cumulative_count = 0
       graph = aff4_stats.ClientFleetStats.SchemaCls.LAST_CONTACTED_HISTOGRAM()
-      for x, y in zip(self._bins, self.values[label]):
+      for x, y in zip(self._bins, values):
         cumulative_count += y
         graph.Append(x_value=x, y_value=cumulative_count)
 
-      self._StatsForLabel(label).AddAttribute(graph)
+      self.cron_flow._StatsForLabel(label).AddAttribute(graph)  # pylint: disable=protected-access
 
   def ProcessClient(self, client):
     now = rdfvalue.RDFDatetime.Now()
@@ -257,6 +263,170 @@ class LastAccessStats(AbstractClientStatsCronFlow):
           pass
 
 
+class AbstractClientStatsCronFlow(cronjobs.SystemCronFlow):
+  """A cron job which feeds every client in the system to stats processors.
+
+  All processors are fed in a single scan over the clients. Only the client
+  attributes the processors declare are read. The scan is done in batches of
+  CLIENT_BATCH_SIZE clients, each in its own flow state. The scan position and
+  the processor data are stored in the flow state after every batch, so a lost
+  lease only repeats the current batch instead of the whole scan.
+  """
+
+  CLIENT_STATS_URN = rdfvalue.RDFURN("aff4:/stats/ClientFleetStats")
+
+  CLIENT_BATCH_SIZE = 5000
+
+  # The ClientStatsProcessor classes run by this cron job.
+  processors = []
+
+  def _StatsForLabel(self, label):
+    if label not in self.stats:
+      self.stats[label] = aff4.FACTORY.Create(
+          self.CLIENT_STATS_URN.Add(label),
+          aff4_stats.ClientFleetStats,
+          mode="w",
+          token=self.token)
+    return self.stats[label]
+
+  def _GetProcessors(self):
+    return [
+        cls(self, self.state.processor_data[cls.__name__])
+        for cls in self.processors
+    ]
+
+  def _ScanClients(self, processors):
+    """Reads the next batch of clients from the data store.
+
+    Args:
+      processors: The processors to read client attributes for.
+
+    Returns:
+      A tuple of the client objects and the last urn scanned, which is None if
+      the scan is complete.
+    """
+    attributes = set([aff4.AFF4Object.SchemaCls.LABELS.predicate])
+    for processor in processors:
+      attributes.update(attribute.predicate
+                        for attribute in processor.attributes)
+
+    clients = []
+    last_urn = None
+    scanned = 0
+    for subject, values in data_store.DB.ScanAttributes(
+        aff4.ROOT_URN,
+        sorted(attributes),
+        after_urn=self.state.after_urn,
+        max_records=self.CLIENT_BATCH_SIZE):
+      scanned += 1
+      last_urn = subject
+
+      # The scan also returns other objects which have one of the attributes.
+      if not rdf_client.ClientURN.CLIENT_ID_RE.match(subject):
+        continue
+
+      local_cache = {
+          subject: [(attribute, value, timestamp)
+                    for attribute, (timestamp, value) in values.iteritems()]
+      }
+      clients.append(
+          aff4_grr.VFSGRRClient(
+              subject, mode="r", token=self.token, local_cache=local_cache))
+
+    if scanned < self.CLIENT_BATCH_SIZE:
+      last_urn = None
+
+    return clients, last_urn
+
+  @flow.StateHandler()
+  def Start(self):
+    """Starts a new scan over all clients."""
+    self.state.after_urn = None
+    self.state.processed_count = 0
+    self.state.processor_data = {}
+
+    for cls in self.processors:
+      self.state.processor_data[cls.__name__] = {}
+
+    for processor in self._GetProcessors():
+      processor.BeginProcessing()
+
+    self.CallState(next_state="ProcessClients")
+
+  @flow.StateHandler()
+  def ProcessClients(self, unused_responses):
+    """Feeds the next batch of clients to the processors."""
+    try:
+      processors = self._GetProcessors()
+      clients, last_urn = self._ScanClients(processors)
+
+      for client in clients:
+        for processor in processors:
+          processor.ProcessClient(client)
+
+      self.state.processed_count += len(clients)
+
+      # This flow is not dead: we don't want to run out of lease time.
+      self.HeartBeat()
+
+      if last_urn is not None:
+        self.state.after_urn = last_urn
+        self.CallState(next_state="ProcessClients")
+        return
+
+      self.stats = {}
+      for processor in processors:
+        processor.FinishProcessing()
+
+      for fd in self.stats.values():
+        fd.Close()
+
+      logging.info("%s: processed %d clients.", self.__class__.__name__,
+                   self.state.processed_count)
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Error while calculating stats: %s", e)
+      raise
+
+
+class ClientFleetStatsCronFlow(AbstractClientStatsCronFlow):
+  """Runs all client stats processors in a single scan over the clients."""
+
+  frequency = rdfvalue.Duration("4h")
+
+  @property
+  def processors(self):
+    return ClientStatsProcessor.classes.values()
+
+
+class GRRVersionBreakDown(AbstractClientStatsCronFlow):
+  """Records relative ratios of GRR versions in 7 day actives."""
+
+  frequency = rdfvalue.Duration("4h")
+
+  # This is computed by ClientFleetStatsCronFlow.
+  disabled = True
+
+  processors = [GRRVersionProcessor]
+
+
+class OSBreakDown(AbstractClientStatsCronFlow):
+  """Records relative ratios of OS versions in 7 day actives."""
+
+  # This is computed by ClientFleetStatsCronFlow.
+  disabled = True
+
+  processors = [OSProcessor]
+
+
+class LastAccessStats(AbstractClientStatsCronFlow):
+  """Calculates a histogram statistics of clients last contacted times."""
+
+  # This is computed by ClientFleetStatsCronFlow.
+  disabled = True
+
+  processors = [LastAccessProcessor]
+
+
 class InterrogateClientsCronFlow(cronjobs.SystemCronFlow):
   """A cron job which runs an interrogate hunt on all clients.
 
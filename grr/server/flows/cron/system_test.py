@@ -183,6 +183,33 @@ class SystemCronFlowTest(flow_test_lib.FlowTestsBaseclass):
     # All our clients appeared at the same time but this label is only half.
     self._CheckAccessStats("Label2", count=10L)
 
+  def testClientFleetStatsCronFlow(self):
+    """Check that a single batched scan computes all client stats."""
+    # Scan in several batches, each of them in its own flow state.
+    with utils.Stubber(system.AbstractClientStatsCronFlow, "CLIENT_BATCH_SIZE",
+                       3):
+      for _ in flow_test_lib.TestFlowHelper(
+          system.ClientFleetStatsCronFlow.__name__, token=self.token):
+        pass
+
+    histogram = aff4_stats.ClientFleetStats.SchemaCls.GRRVERSION_HISTOGRAM
+    self._CheckVersionStats("All", histogram, [0, 0, 20, 20])
+    self._CheckVersionStats("Label1", histogram, [0, 0, 10, 10])
+
+    histogram = aff4_stats.ClientFleetStats.SchemaCls.OS_HISTOGRAM
+    self._CheckOSStats("All", histogram, [
+        0, 0, {
+            "Linux": 10,
+            "Windows": 10
+        }, {
+            "Linux": 10,
+            "Windows": 10
+        }
+    ])
+
+    self._CheckAccessStats("All", count=20L)
+    self._CheckAccessStats("Label2", count=10L)
+
   def testPurgeClientStats(self):
     max_age = system.PurgeClientStats.MAX_AGE
 
@@ -10,9 +10,11 @@ The audit system consists of a group of event listeners which receive these
 events and act upon them.
 """
 
+import collections
 
 from grr.lib import queues
 from grr.lib import rdfvalue
+from grr.lib import utils
 from grr.server import aff4
 from grr.server import data_store
 from grr.server import events
@@ -21,11 +23,114 @@ from grr.server import sequential_collection
 
 AUDIT_EVENT = "Audit"
 
+# Audit events are additionally stored in an index keyed by action and time
+# bucket and counted per user and time bucket, so that reports don't have to
+# read whole audit logs. Counts are append only records holding just the user
+# and time of an event, which are summed up when they are read.
+AUDIT_INDEX_BUCKET = rdfvalue.Duration("1d")
+AUDIT_INDEX_ROOT = rdfvalue.RDFURN("aff4:/audit/index")
+AUDIT_COUNTERS_ROOT = rdfvalue.RDFURN("aff4:/audit/counters")
+
 
 class AuditEventCollection(sequential_collection.IndexedSequentialCollection):
   RDF_TYPE = events.AuditEvent
 
 
+def _AuditIndexBucket(timestamp):
+  """Returns the start of the index bucket timestamp falls into in seconds."""
+  bucket_seconds = AUDIT_INDEX_BUCKET.seconds
+  return (timestamp.AsSecondsFromEpoch() // bucket_seconds) * bucket_seconds
+
+
+def _AuditIndexBuckets(start_time, end_time):
+  """Yields the index buckets overlapping [start_time, end_time)."""
+  bucket = _AuditIndexBucket(start_time)
+  while bucket < end_time.AsSecondsFromEpoch():
+    yield bucket
+    bucket += AUDIT_INDEX_BUCKET.seconds
+
+
+def AuditIndexURN(action, timestamp):
+  return AUDIT_INDEX_ROOT.Add(str(action)).Add(
+      str(_AuditIndexBucket(timestamp)))
+
+
+def AuditCountersURN(timestamp):
+  return AUDIT_COUNTERS_ROOT.Add(str(_AuditIndexBucket(timestamp)))
+
+
+def AuditIndexStart(token=None):
+  """Returns the time from which on audit events are indexed.
+
+  This is the time of the earliest indexed event. Events which were logged
+  before the index was introduced can only be found in the audit logs.
+
+  Args:
+    token: The access token.
+
+  Returns:
+    An RDFDatetime or None if no event has been indexed yet.
+  """
+  buckets = sorted(
+      int(urn.Basename())
+      for urn in aff4.FACTORY.Open(AUDIT_COUNTERS_ROOT,
+                                   token=token).ListChildren())
+  for bucket in buckets:
+    timestamps = [
+        record.timestamp
+        for record in AuditEventCollection(AUDIT_COUNTERS_ROOT.Add(str(bucket)))
+    ]
+    if timestamps:
+      return min(timestamps)
+  return None
+
+
+def IndexedAuditEvents(actions, start_time, end_time, token=None):
+  """Yields the indexed audit events of the given actions in a time range.
+
+  Args:
+    actions: A list of AuditEvent.Action values.
+    start_time: RDFDatetime, events older than this are not returned.
+    end_time: RDFDatetime, events newer than this are not returned.
+    token: The access token.
+
+  Yields:
+    AuditEvents.
+  """
+  _ = token
+  for action in actions:
+    for bucket in _AuditIndexBuckets(start_time, end_time):
+      index_urn = AuditIndexURN(
+          action, rdfvalue.RDFDatetime().FromSecondsFromEpoch(bucket))
+      for event in AuditEventCollection(index_urn):
+        if start_time <= event.timestamp < end_time:
+          yield event
+
+
+def IndexedAuditEventCounts(start_time, end_time, token=None):
+  """Yields the per user event counts of the buckets in a time range.
+
+  Unlike IndexedAuditEvents, whole buckets are counted: every bucket that
+  overlaps the time range is returned.
+
+  Args:
+    start_time: RDFDatetime, the start of the time range.
+    end_time: RDFDatetime, the end of the time range.
+    token: The access token.
+
+  Yields:
+    Tuples (bucket start as RDFDatetime, dict of user to event count).
+  """
+  _ = token
+  for bucket in _AuditIndexBuckets(start_time, end_time):
+    bucket_start = rdfvalue.RDFDatetime().FromSecondsFromEpoch(bucket)
+    counts = collections.Counter(
+        utils.SmartUnicode(record.user or "")
+        for record in AuditEventCollection(AuditCountersURN(bucket_start)))
+    if counts:
+      yield bucket_start, dict(counts)
+
+
 def AllAuditLogs(token=None):
   # TODO(user): This is not great, we should store this differently.
   for log in aff4.FACTORY.Open("aff4:/audit/logs", token=token).ListChildren():
@@ -61,5 +166,16 @@ class AuditEventListener(flow.EventListener):
     _ = message
     log_urn = aff4.CurrentAuditLog()
     self.EnsureLogIsIndexed(log_urn)
+    counters_urn = AuditCountersURN(event.timestamp)
+    self.EnsureLogIsIndexed(counters_urn)
     with data_store.DB.GetMutationPool() as pool:
       AuditEventCollection.StaticAdd(log_urn, event, mutation_pool=pool)
+      AuditEventCollection.StaticAdd(
+          AuditIndexURN(event.action, event.timestamp),
+          event,
+          mutation_pool=pool)
+      # Only what the counts need is kept, so summing them up is cheap.
+      AuditEventCollection.StaticAdd(
+          counters_urn,
+          events.AuditEvent(user=event.user, timestamp=event.timestamp),
+          mutation_pool=pool)
@@ -5,6 +5,7 @@
 import os
 
 from grr.lib import flags
+from grr.lib import rdfvalue
 from grr.lib.rdfvalues import paths as rdf_paths
 from grr.server import aff4
 from grr.server import events
@@ -83,6 +84,61 @@ class TestAuditSystem(flow_test_lib.FlowTestsBaseclass):
       stored_events = audit.AuditEventCollection(logs[1])
       self.assertEqual(len(stored_events), 1)
 
+  def _PublishEvent(self, action, user):
+    events.Events.PublishEventInline(
+        audit.AUDIT_EVENT,
+        events.AuditEvent(action=action, user=user),
+        token=self.token)
+
+  def testEventsAreIndexedAndCounted(self):
+    day = rdfvalue.Duration("1d")
+    start = rdfvalue.RDFDatetime.FromHumanReadable("2012/12/10")
+
+    self.assertIsNone(audit.AuditIndexStart(token=self.token))
+
+    with test_lib.FakeTime(start + rdfvalue.Duration("1h"), increment=1):
+      self._PublishEvent(events.AuditEvent.Action.RUN_FLOW, "user1")
+      self._PublishEvent(events.AuditEvent.Action.RUN_FLOW, "user2")
+      self._PublishEvent(events.AuditEvent.Action.HUNT_CREATED, "user1")
+
+    with test_lib.FakeTime(start + day + rdfvalue.Duration("1h")):
+      self._PublishEvent(events.AuditEvent.Action.RUN_FLOW, "user1")
+
+    # Events logged earlier that day were not indexed.
+    index_start = audit.AuditIndexStart(token=self.token)
+    self.assertGreaterEqual(index_start, start + rdfvalue.Duration("1h"))
+    self.assertLess(index_start, start + rdfvalue.Duration("2h"))
+
+    run_flow = list(
+        audit.IndexedAuditEvents(
+            [events.AuditEvent.Action.RUN_FLOW],
+            start,
+            start + 2 * day,
+            token=self.token))
+    self.assertEqual(
+        sorted(event.user for event in run_flow), ["user1", "user1", "user2"])
+
+    # Only the events within the time range are returned.
+    run_flow = list(
+        audit.IndexedAuditEvents(
+            [events.AuditEvent.Action.RUN_FLOW],
+            start + rdfvalue.Duration("2h"),
+            start + 2 * day,
+            token=self.token))
+    self.assertEqual([event.user for event in run_flow], ["user1"])
+
+    counts = dict(
+        audit.IndexedAuditEventCounts(start, start + 2 * day, token=self.token))
+    self.assertEqual(counts, {
+        start: {
+            "user1": 2,
+            "user2": 1
+        },
+        start + day: {
+            "user1": 1
+        }
+    })
+
 
 def main(argv):
   # Run the full test suite
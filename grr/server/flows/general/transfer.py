@@ -485,29 +485,8 @@ class MultiGetFileMixin(object):
     # Now that the check is done, reset our counter
     self.state.files_hashed_since_check = 0
     # Now copy all existing files to the client aff4 space.
-    for filestore_file_urn, hash_obj in files_in_filestore.iteritems():
-
-      for file_tracker in hash_to_tracker.get(hash_obj.sha256, []):
-        stat_entry = file_tracker["stat_entry"]
-        # Copy the existing file from the filestore to the client namespace.
-        target_urn = stat_entry.pathspec.AFF4Path(self.client_id)
-
-        aff4.FACTORY.Copy(
-            filestore_file_urn, target_urn, update_timestamps=True)
-
-        with aff4.FACTORY.Open(
-            target_urn, mode="rw", token=self.token) as new_fd:
-          new_fd.Set(new_fd.Schema.STAT, stat_entry)
-          # Due to potential filestore corruption, the existing files
-          # can have 0 size.
-          if new_fd.size == 0:
-            new_fd.size = (file_tracker["bytes_read"] or stat_entry.st_size)
-
-        # Add this file to the filestore index.
-        filestore_obj.AddURNToIndex(str(hash_obj.sha256), target_urn)
-
-        # Report this hit to the flow's caller.
-        self._ReceiveFetchedFile(file_tracker)
+    self._CopyFilesFromFileStore(filestore_obj, files_in_filestore,
+                                 hash_to_tracker)
 
     # Now we iterate over all the files which are not in the store and arrange
     # for them to be copied.
@@ -552,6 +531,54 @@ class MultiGetFileMixin(object):
       self.Log("Hashed %d files, skipped %s already stored.",
                self.state.files_hashed, self.state.files_skipped)
 
+  def _CopyFilesFromFileStore(self, filestore_obj, files_in_filestore,
+                              hash_to_tracker):
+    """Copies files found in the file store to the client namespace.
+
+    Only the attributes of the stored files (i.e. the references to their
+    blobs) are copied. The copies, their stat entries and index entries for all
+    files are written in a single batch.
+
+    Args:
+      filestore_obj: The FileStore object.
+      files_in_filestore: A dict of file store URNs to hashes.
+      hash_to_tracker: A dict of sha256 hashes to the trackers of the files
+          with this hash.
+    """
+    copies = []
+    index_entries = []
+    trackers = []
+    for filestore_file_urn, hash_obj in files_in_filestore.iteritems():
+      for file_tracker in hash_to_tracker.get(hash_obj.sha256, []):
+        stat_entry = file_tracker["stat_entry"]
+        target_urn = stat_entry.pathspec.AFF4Path(self.client_id)
+
+        schema = aff4_grr.VFSBlobImage.SchemaCls
+        attributes = {schema.STAT: schema.STAT(stat_entry)}
+        # The hash was computed over bytes_read bytes of the file so this is
+        # the size of the stored file. It is set explicitly since, due to
+        # potential filestore corruption, stored files can have 0 size.
+        if file_tracker["bytes_read"]:
+          attributes[schema.SIZE] = schema.SIZE(file_tracker["bytes_read"])
+
+        copies.append((filestore_file_urn, target_urn, attributes))
+        index_entries.append((str(hash_obj.sha256), target_urn))
+        trackers.append(file_tracker)
+
+    if not copies:
+      return
+
+    with data_store.DB.GetMutationPool() as mutation_pool:
+      aff4.FACTORY.MultiCopy(
+          copies, update_timestamps=True, mutation_pool=mutation_pool)
+
+    # Add the files to the filestore index.
+    filestore_obj.AddURNsToIndex(index_entries)
+
+    for file_tracker in trackers:
+      # Report this hit to the flow's caller.
+      self._ReceiveFetchedFile(file_tracker)
+
   @flow.StateHandler()
   def CheckHash(self, responses):
     """Adds the block hash to the file tracker responsible for this vfs URN."""
@@ -657,6 +684,10 @@ class MultiGetFileMixin(object):
           fd.Set(fd.Schema.STAT(stat_entry))
           fd.Set(fd.Schema.PATHSPEC(stat_entry.pathspec))
           fd.Set(fd.Schema.CONTENT_LAST(rdfvalue.RDFDatetime().Now()))
+          # The file store uses the client side hash to find an already
+          # stored copy of this file, it doesn't trust it otherwise.
+          if file_tracker.get("hash_obj"):
+            fd.Set(fd.Schema.HASH, file_tracker["hash_obj"])
 
           for digest, length in file_tracker["blobs"]:
             fd.AddBlob(digest, length)
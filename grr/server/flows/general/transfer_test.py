@@ -21,6 +21,7 @@ from grr.server.flows.general import transfer
 from grr.test_lib import action_mocks
 from grr.test_lib import flow_test_lib
 from grr.test_lib import test_lib
+from grr.test_lib import worker_test_lib
 
 # pylint:mode=test
 
@@ -404,6 +405,57 @@ class TestTransfer(flow_test_lib.FlowTestsBaseclass):
 
     self.assertEqual(client_mock.action_counts["TransferBuffer"], 1)
 
+  def testMultiGetFileCopiesFilesFoundInFileStore(self):
+    path = os.path.join(self.temp_dir, "stored.txt")
+    with open(path, "wb") as fd:
+      fd.write("Hello")
+
+    client_mock = action_mocks.MultiGetFileClientMock()
+    args = transfer.MultiGetFileArgs(pathspecs=[
+        rdf_paths.PathSpec(pathtype=rdf_paths.PathSpec.PathType.OS, path=path)
+    ])
+    for _ in flow_test_lib.TestFlowHelper(
+        transfer.MultiGetFile.__name__,
+        client_mock,
+        token=self.token,
+        client_id=self.client_id,
+        args=args):
+      pass
+
+    # Process the FileStore.AddFileToStore events.
+    worker_test_lib.MockWorker(token=self.token).Simulate()
+
+    pathspecs = []
+    for i in xrange(10):
+      path = os.path.join(self.temp_dir, "copy_%s.txt" % i)
+      with open(path, "wb") as fd:
+        fd.write("Hello")
+
+      pathspecs.append(
+          rdf_paths.PathSpec(
+              pathtype=rdf_paths.PathSpec.PathType.OS, path=path))
+
+    client_mock = action_mocks.MultiGetFileClientMock()
+    args = transfer.MultiGetFileArgs(pathspecs=pathspecs)
+    for _ in flow_test_lib.TestFlowHelper(
+        transfer.MultiGetFile.__name__,
+        client_mock,
+        token=self.token,
+        client_id=self.client_id,
+        args=args):
+      pass
+
+    # The files were copied from the file store without reading any blocks.
+    self.assertEqual(client_mock.action_counts.get("HashBuffer", 0), 0)
+    self.assertEqual(client_mock.action_counts.get("TransferBuffer", 0), 0)
+
+    for pathspec in pathspecs:
+      fd = aff4.FACTORY.Open(
+          pathspec.AFF4Path(self.client_id), token=self.token)
+      self.assertEqual(fd.Read(100), "Hello")
+      self.assertEqual(fd.Get(fd.Schema.SIZE), 5)
+      self.assertEqual(fd.Get(fd.Schema.STAT).pathspec.path, pathspec.path)
+
   def testMultiGetFileSetsFileHashAttributeWhenMultipleChunksDownloaded(self):
     client_mock = action_mocks.MultiGetFileClientMock()
     pathspec = rdf_paths.PathSpec(
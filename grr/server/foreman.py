@@ -4,6 +4,7 @@
 
 
 import itertools
+import operator
 
 from grr.lib import rdfvalue
 from grr.lib import utils
@@ -42,6 +43,18 @@ class ForemanClientRuleBase(rdf_structs.RDFProtoStruct):
     """
     raise NotImplementedError
 
+  def Compile(self):
+    """Returns a function evaluating this rule.
+
+    The returned function takes the same arguments as Evaluate. Everything
+    that doesn't depend on the client is done once here, so the function can
+    be used for evaluating the rule on many clients.
+
+    Returns:
+      A callable (objects, client_id) -> bool.
+    """
+    return self.Evaluate
+
   def Validate(self):
     raise NotImplementedError
 
@@ -63,6 +76,21 @@ class ForemanOsClientRule(ForemanClientRuleBase):
             (self.os_linux and value.startswith("Linux")) or
             (self.os_darwin and value.startswith("Darwin")))
 
+  def Compile(self):
+    prefixes = tuple(
+        prefix
+        for prefix, enabled in [("Windows", self.os_windows), (
+            "Linux", self.os_linux), ("Darwin", self.os_darwin)] if enabled)
+    attribute = aff4.Attribute.NAMES.get("System")
+
+    def Predicate(objects, client_id):
+      fd = objects.get(client_id)
+      if fd is None or attribute is None:
+        return False
+      return utils.SmartStr(fd.Get(attribute)).startswith(prefixes)
+
+    return Predicate
+
   def Validate(self):
     pass
 
@@ -71,27 +99,43 @@ class ForemanLabelClientRule(ForemanClientRuleBase):
   """This rule will fire if the client has the selected label."""
   protobuf = jobs_pb2.ForemanLabelClientRule
 
-  def Evaluate(self, objects, client_id):
-    try:
-      fd = objects[client_id]
-    except KeyError:
-      return False
-
+  def _GetQuantifier(self):
     if self.match_mode == ForemanLabelClientRule.MatchMode.MATCH_ALL:
-      quantifier = all
+      return all
     elif self.match_mode == ForemanLabelClientRule.MatchMode.MATCH_ANY:
-      quantifier = any
+      return any
     elif self.match_mode == ForemanLabelClientRule.MatchMode.DOES_NOT_MATCH_ALL:
-      quantifier = lambda iterable: not all(iterable)
+      return lambda iterable: not all(iterable)
     elif self.match_mode == ForemanLabelClientRule.MatchMode.DOES_NOT_MATCH_ANY:
-      quantifier = lambda iterable: not any(iterable)
+      return lambda iterable: not any(iterable)
     else:
       raise ValueError("Unexpected match mode value: %s" % self.match_mode)
 
+  def Evaluate(self, objects, client_id):
+    try:
+      fd = objects[client_id]
+    except KeyError:
+      return False
+
+    quantifier = self._GetQuantifier()
     client_label_names = set(fd.GetLabelsNames())
 
     return quantifier((name in client_label_names) for name in self.label_names)
 
+  def Compile(self):
+    quantifier = self._GetQuantifier()
+    label_names = list(self.label_names)
+
+    def Predicate(objects, client_id):
+      fd = objects.get(client_id)
+      if fd is None:
+        return False
+
+      client_label_names = set(fd.GetLabelsNames())
+      return quantifier((name in client_label_names) for name in label_names)
+
+    return Predicate
+
   def Validate(self):
     pass
 
@@ -119,6 +163,19 @@ class ForemanRegexClientRule(ForemanClientRuleBase):
 
     return self.attribute_regex.Search(value)
 
+  def Compile(self):
+    path = self.path
+    attribute = aff4.Attribute.NAMES.get(self.attribute_name)
+    regex = self.attribute_regex
+
+    def Predicate(objects, client_id):
+      fd = objects.get(client_id.Add(path))
+      if fd is None or attribute is None:
+        return False
+      return bool(regex.Search(utils.SmartStr(fd.Get(attribute))))
+
+    return Predicate
+
   def Validate(self):
     if not self.attribute_name:
       raise ValueError("ForemanRegexClientRule rule invalid - "
@@ -163,6 +220,32 @@ class ForemanIntegerClientRule(ForemanClientRuleBase):
       # Unknown operator.
       return False
 
+  def Compile(self):
+    operators = {
+        ForemanIntegerClientRule.Operator.LESS_THAN: operator.lt,
+        ForemanIntegerClientRule.Operator.GREATER_THAN: operator.gt,
+        ForemanIntegerClientRule.Operator.EQUAL: operator.eq,
+    }
+    compare = operators.get(self.operator)
+    path = self.path
+    attribute = aff4.Attribute.NAMES.get(self.attribute_name)
+    rule_value = self.value
+
+    def Predicate(objects, client_id):
+      fd = objects.get(client_id.Add(path))
+      if fd is None or attribute is None or compare is None:
+        return False
+
+      try:
+        value = int(fd.Get(attribute))
+      except (ValueError, TypeError):
+        # Not an integer attribute.
+        return False
+
+      return compare(value, rule_value)
+
+    return Predicate
+
   def Validate(self):
     if not self.attribute_name:
       raise ValueError("ForemanIntegerClientRule rule invalid - "
@@ -195,6 +278,9 @@ class ForemanClientRule(ForemanClientRuleBase):
   def Evaluate(self, objects, client_id):
     return self.UnionCast().Evaluate(objects, client_id)
 
+  def Compile(self):
+    return self.UnionCast().Compile()
+
   def Validate(self):
     self.UnionCast().Validate()
 
@@ -227,14 +313,34 @@ class ForemanClientRuleSet(rdf_structs.RDFProtoStruct):
     Raises:
       ValueError: The match mode is of unknown value.
     """
+    quantifier = self._GetQuantifier()
+    return quantifier(rule.Evaluate(objects, client_id) for rule in self.rules)
+
+  def _GetQuantifier(self):
     if self.match_mode == ForemanClientRuleSet.MatchMode.MATCH_ALL:
-      quantifier = all
+      return all
     elif self.match_mode == ForemanClientRuleSet.MatchMode.MATCH_ANY:
-      quantifier = any
+      return any
     else:
       raise ValueError("Unexpected match mode value: %s" % self.match_mode)
 
-    return quantifier(rule.Evaluate(objects, client_id) for rule in self.rules)
+  def Compile(self):
+    """Returns a function evaluating the rules held in the rule set.
+
+    Returns:
+      A callable (objects, client_id) -> bool, see Evaluate.
+
+    Raises:
+      ValueError: The match mode is of unknown value.
+    """
+    quantifier = self._GetQuantifier()
+    predicates = [rule.Compile() for rule in self.rules]
+
+    def Predicate(objects, client_id):
+      return quantifier(predicate(objects, client_id)
+                        for predicate in predicates)
+
+    return Predicate
 
   def Validate(self):
     for rule in self.rules:
@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 """The GRR frontend server."""
 
+import atexit
 import logging
+import multiprocessing
 import operator
+import threading
 import time
 
 from grr import config
@@ -14,6 +17,7 @@ from grr.lib import stats
 from grr.lib import uploads
 from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
+from grr.lib.rdfvalues import crypto as rdf_crypto
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.server import access_control
 from grr.server import aff4
@@ -24,14 +28,177 @@ from grr.server import file_store
 from grr.server import flow
 from grr.server import queue_manager
 from grr.server import rekall_profile_server
+from grr.server import server_startup
 from grr.server import threadpool
 from grr.server.aff4_objects import aff4_grr
 
 
+# The private key of a cipher decryption process.
+_decryption_process_key = None
+
+
+def _InitDecryptionProcess(serialized_private_key):
+  global _decryption_process_key
+  # The processes are usually started before the frontend drops privileges.
+  server_startup.DropPrivileges()
+  _decryption_process_key = rdf_crypto.RSAPrivateKey(serialized_private_key)
+
+
+def _DecryptCipher(encrypted_cipher):
+  """Decrypts a session cipher, runs in a cipher decryption process."""
+  return _decryption_process_key.Decrypt(encrypted_cipher)
+
+
+def CreateCipherDecryptionPool(processes, private_key):
+  """Creates a pool of processes decrypting session ciphers.
+
+  The processes are forked so the pool has to be created before any threads
+  are started. A process forked while another thread holds a lock, e.g. the
+  logging lock, can deadlock.
+
+  Args:
+    processes: The number of processes.
+    private_key: The server's RSAPrivateKey.
+
+  Returns:
+    A multiprocessing.Pool.
+  """
+  return multiprocessing.Pool(
+      processes,
+      initializer=_InitDecryptionProcess,
+      initargs=(private_key.SerializeToString(),))
+
+
+# The pool used by the frontend, see StartCipherDecryptionPool().
+CIPHER_DECRYPTION_POOL = None
+
+
+def StartCipherDecryptionPool():
+  """Starts the pool configured in Frontend.cipher_decryption_processes.
+
+  Must be called after the config was parsed but before any threads are
+  started, see CreateCipherDecryptionPool().
+  """
+  global CIPHER_DECRYPTION_POOL
+  processes = config.CONFIG["Frontend.cipher_decryption_processes"]
+  if processes and CIPHER_DECRYPTION_POOL is None:
+    CIPHER_DECRYPTION_POOL = CreateCipherDecryptionPool(
+        processes, config.CONFIG["PrivateKeys.server_key"])
+
+
+class ClientHeartbeatBuffer(object):
+  """Writes the metadata updates of polling clients in bulk.
+
+  Every poll updates the ip, clock and ping of the client's AFF4 object.
+  Instead of flushing each object right away, the modified objects are
+  collected here and flushed together through a single mutation pool every
+  flush_interval seconds. Since the attributes are not versioned, an object
+  that is updated several times within an interval is only written once.
+
+  A process uses a single buffer, see GetClientHeartbeatBuffer().
+  """
+
+  def __init__(self, flush_interval):
+    self.flush_interval = flush_interval
+    self.lock = threading.Lock()
+    self.flush_lock = threading.Lock()
+    self.clients = {}
+    self.stop_event = threading.Event()
+    self.flush_thread = None
+
+  def Start(self):
+    self.flush_thread = threading.Thread(
+        target=self._FlushLoop, name="ClientHeartbeatBuffer")
+    self.flush_thread.daemon = True
+    self.flush_thread.start()
+
+  def Stop(self):
+    """Stops the flush thread and writes the remaining client objects."""
+    self.stop_event.set()
+    if self.flush_thread is not None:
+      self.flush_thread.join()
+      self.flush_thread = None
+    self.Flush()
+
+  def Add(self, client):
+    """Schedules the modified client object to be written."""
+    with self.lock:
+      self.clients[client.urn] = client
+
+  def Flush(self):
+    """Writes all buffered client objects."""
+    with self.flush_lock:
+      with self.lock:
+        clients, self.clients = self.clients, {}
+
+      if not clients:
+        return
+
+      with data_store.DB.GetMutationPool() as pool:
+        for client in clients.itervalues():
+          # The object might be modified by a poll at the same time.
+          with client.lock:
+            client.mutation_pool = pool
+            try:
+              client.Flush()
+            finally:
+              client.mutation_pool = None
+
+      stats.STATS.IncrementCounter(
+          "grr_frontendserver_heartbeats_written", delta=len(clients))
+
+  def _FlushLoop(self):
+    while not self.stop_event.wait(self.flush_interval):
+      try:
+        self.Flush()
+      except Exception:  # pylint: disable=broad-except
+        logging.exception("Error writing client heartbeats.")
+
+
+# The buffer shared by all ServerCommunicators, see GetClientHeartbeatBuffer().
+HEARTBEAT_BUFFER = None
+HEARTBEAT_BUFFER_LOCK = threading.Lock()
+
+
+def GetClientHeartbeatBuffer(flush_interval):
+  """Returns the heartbeat buffer of the process, starting it on first use.
+
+  Args:
+    flush_interval: The flush interval of the buffer if it is started.
+
+  Returns:
+    A running ClientHeartbeatBuffer.
+  """
+  global HEARTBEAT_BUFFER
+  with HEARTBEAT_BUFFER_LOCK:
+    if HEARTBEAT_BUFFER is None:
+      HEARTBEAT_BUFFER = ClientHeartbeatBuffer(flush_interval)
+      HEARTBEAT_BUFFER.Start()
+    return HEARTBEAT_BUFFER
+
+
+def StopClientHeartbeatBuffer():
+  """Flushes and stops the heartbeat buffer if it was started."""
+  global HEARTBEAT_BUFFER
+  with HEARTBEAT_BUFFER_LOCK:
+    if HEARTBEAT_BUFFER is not None:
+      HEARTBEAT_BUFFER.Stop()
+      HEARTBEAT_BUFFER = None
+
+
+# Don't lose the last updates when the process exits.
+atexit.register(StopClientHeartbeatBuffer)
+
+
 class ServerCommunicator(communicator.Communicator):
   """A communicator which stores certificates using AFF4."""
 
-  def __init__(self, certificate, private_key, token=None):
+  def __init__(self,
+               certificate,
+               private_key,
+               token=None,
+               decryption_pool=None,
+               heartbeat_flush_interval=0):
     self.client_cache = utils.FastStore(1000)
     self.token = token
     super(ServerCommunicator, self).__init__(
@@ -40,6 +207,30 @@ class ServerCommunicator(communicator.Communicator):
     # Our common name as an RDFURN.
     self.common_name = rdfvalue.RDFURN(self.certificate.GetCN())
 
+    # The RSA decryption of new session ciphers is the most expensive part of
+    # decoding a message. If a pool is given, it is done in separate processes
+    # so it can use more than one core.
+    self.decryption_pool = decryption_pool
+
+    self.heartbeat_buffer = None
+    if heartbeat_flush_interval:
+      self.heartbeat_buffer = GetClientHeartbeatBuffer(
+          heartbeat_flush_interval)
+
+  def _CreateReceivedCipher(self, response_comms):
+    if self.decryption_pool is None or not response_comms.encrypted_cipher:
+      return super(ServerCommunicator,
+                   self)._CreateReceivedCipher(response_comms)
+
+    try:
+      serialized_cipher = self.decryption_pool.apply(
+          _DecryptCipher, (response_comms.encrypted_cipher,))
+    except rdf_crypto.CipherError as e:
+      raise communicator.DecryptionError(e)
+
+    return communicator.ReceivedCipher(
+        response_comms, self.private_key, serialized_cipher=serialized_cipher)
+
   def _GetRemotePublicKey(self, common_name):
     try:
       # See if we have this client already cached.
@@ -72,6 +263,46 @@ class ServerCommunicator(communicator.Communicator):
     self.pub_key_cache.Put(common_name, pub_key)
     return pub_key
 
+  def PrewarmPublicKeyCache(self, client_urns, min_ping):
+    """Loads the public keys of the given clients into the cache.
+
+    Args:
+      client_urns: The clients to load the keys for.
+      min_ping: Only clients seen after this RDFDatetime are loaded.
+
+    Returns:
+      The number of keys added to the cache.
+    """
+    schema = aff4_grr.VFSGRRClient.SchemaCls
+    keys = []
+    for batch in utils.Grouper(client_urns, 1000):
+      for client_urn, values in data_store.DB.MultiResolvePrefix(
+          batch, [schema.CERT.predicate, schema.PING.predicate]):
+        values = dict((attribute, value) for attribute, value, _ in values)
+        try:
+          ping = schema.PING.attribute_type.FromSerializedString(
+              values[schema.PING.predicate])
+          if ping < min_ping:
+            continue
+
+          cert = schema.CERT.attribute_type.FromSerializedString(
+              values[schema.CERT.predicate])
+          if rdfvalue.RDFURN(cert.GetCN()) != rdfvalue.RDFURN(client_urn):
+            logging.error("Stored cert mismatch for %s", client_urn)
+            continue
+
+          keys.append((ping, str(client_urn), cert.GetPublicKey()))
+        except (KeyError, ValueError, rdfvalue.DecodeError) as e:
+          logging.debug("Not prewarming key of %s: %s", client_urn, e)
+
+    # The most recently seen clients are most likely to come back soon so they
+    # are added last and are the last ones to be expired.
+    keys.sort()
+    for _, common_name, pub_key in keys:
+      self.pub_key_cache.Put(common_name, pub_key)
+
+    return len(keys)
+
   def VerifyMessageSignature(self, response_comms, packed_message_list, cipher,
                              cipher_verified, api_version, remote_public_key):
     """Verifies the message list signature.
@@ -90,8 +321,10 @@ class ServerCommunicator(communicator.Communicator):
     Returns:
       An rdf_flows.GrrMessage.AuthorizationState.
     """
-    if (not cipher_verified and
-        not cipher.VerifyCipherSignature(remote_public_key)):
+    if not cipher_verified:
+      with communicator.DecodingStage("verify"):
+        cipher_verified = cipher.VerifyCipherSignature(remote_public_key)
+    if not cipher_verified:
       stats.STATS.IncrementCounter("grr_unauthenticated_messages")
       return rdf_flows.GrrMessage.AuthorizationState.UNAUTHENTICATED
 
@@ -109,50 +342,64 @@ class ServerCommunicator(communicator.Communicator):
         stats.STATS.SetGaugeValue("grr_frontendserver_client_cache_size",
                                   len(self.client_cache))
 
-      ip = response_comms.orig_request.source_ip
-      client.Set(client.Schema.CLIENT_IP(ip))
-
-      # The very first packet we see from the client we do not have its clock
-      remote_time = client.Get(client.Schema.CLOCK) or 0
-      client_time = packed_message_list.timestamp or 0
-
-      # This used to be a strict check here so absolutely no out of
-      # order messages would be accepted ever. Turns out that some
-      # proxies can send your request with some delay even if the
-      # client has already timed out (and sent another request in
-      # the meantime, making the first one out of order). In that
-      # case we would just kill the whole flow as a
-      # precaution. Given the behavior of those proxies, this seems
-      # now excessive and we have changed the replay protection to
-      # only trigger on messages that are more than one hour old.
-
-      if client_time < long(remote_time - rdfvalue.Duration("1h")):
-        logging.warning("Message desynchronized for %s: %s >= %s", client_id,
-                        long(remote_time), int(client_time))
-        # This is likely an old message
-        return rdf_flows.GrrMessage.AuthorizationState.DESYNCHRONIZED
-
-      stats.STATS.IncrementCounter("grr_authenticated_messages")
-
-      # Update the client and server timestamps only if the client
-      # time moves forward.
-      if client_time > long(remote_time):
-        client.Set(client.Schema.CLOCK, rdfvalue.RDFDatetime(client_time))
-        client.Set(client.Schema.PING, rdfvalue.RDFDatetime.Now())
-        for label in client.Get(client.Schema.LABELS, []):
-          stats.STATS.IncrementCounter(
-              "client_pings_by_label", fields=[label.name])
-      else:
-        logging.warning("Out of order message for %s: %s >= %s", client_id,
-                        long(remote_time), int(client_time))
+      with client.lock:
+        result = self._UpdateClient(client_id, client, response_comms,
+                                    packed_message_list)
+      if result != rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED:
+        return result
 
-      client.Flush()
+      if self.heartbeat_buffer:
+        self.heartbeat_buffer.Add(client)
+      else:
+        client.Flush()
 
     except communicator.UnknownClientCert:
       pass
 
     return rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED
 
+  def _UpdateClient(self, client_id, client, response_comms,
+                    packed_message_list):
+    """Updates the ip, clock and ping of the client object."""
+    ip = response_comms.orig_request.source_ip
+    client.Set(client.Schema.CLIENT_IP(ip))
+
+    # The very first packet we see from the client we do not have its clock
+    remote_time = client.Get(client.Schema.CLOCK) or 0
+    client_time = packed_message_list.timestamp or 0
+
+    # This used to be a strict check here so absolutely no out of
+    # order messages would be accepted ever. Turns out that some
+    # proxies can send your request with some delay even if the
+    # client has already timed out (and sent another request in
+    # the meantime, making the first one out of order). In that
+    # case we would just kill the whole flow as a
+    # precaution. Given the behavior of those proxies, this seems
+    # now excessive and we have changed the replay protection to
+    # only trigger on messages that are more than one hour old.
+
+    if client_time < long(remote_time - rdfvalue.Duration("1h")):
+      logging.warning("Message desynchronized for %s: %s >= %s", client_id,
+                      long(remote_time), int(client_time))
+      # This is likely an old message
+      return rdf_flows.GrrMessage.AuthorizationState.DESYNCHRONIZED
+
+    stats.STATS.IncrementCounter("grr_authenticated_messages")
+
+    # Update the client and server timestamps only if the client
+    # time moves forward.
+    if client_time > long(remote_time):
+      client.Set(client.Schema.CLOCK, rdfvalue.RDFDatetime(client_time))
+      client.Set(client.Schema.PING, rdfvalue.RDFDatetime.Now())
+      for label in client.Get(client.Schema.LABELS, []):
+        stats.STATS.IncrementCounter(
+            "client_pings_by_label", fields=[label.name])
+    else:
+      logging.warning("Out of order message for %s: %s >= %s", client_id,
+                      long(remote_time), int(client_time))
+
+    return rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED
+
 
 class FrontEndServer(object):
   """This is the front end server.
@@ -181,9 +428,19 @@ class FrontEndServer(object):
         username="GRRFrontEnd", reason="Implied.")
     self.token.supervisor = True
 
+    if (config.CONFIG["Frontend.cipher_decryption_processes"] and
+        CIPHER_DECRYPTION_POOL is None):
+      logging.warning("The cipher decryption processes were not started, "
+                      "ciphers are decrypted inline.")
+
     # This object manages our crypto.
     self._communicator = ServerCommunicator(
-        certificate=certificate, private_key=private_key, token=self.token)
+        certificate=certificate,
+        private_key=private_key,
+        token=self.token,
+        decryption_pool=CIPHER_DECRYPTION_POOL,
+        heartbeat_flush_interval=config.CONFIG[
+            "Frontend.heartbeat_flush_interval"])
 
     self.data_store = store or data_store.DB
     self.receive_thread_pool = {}
@@ -264,6 +521,28 @@ class FrontEndServer(object):
 
     return source, len(messages)
 
+  def PrewarmPublicKeyCache(self, max_age=None):
+    """Loads the public keys of recently seen clients into the cache.
+
+    Args:
+      max_age: Keys of clients seen within this Duration are loaded. Defaults
+        to Frontend.public_key_prewarm_age.
+
+    Returns:
+      The number of keys loaded.
+    """
+    if max_age is None:
+      max_age = config.CONFIG["Frontend.public_key_prewarm_age"]
+    if not max_age:
+      return 0
+
+    min_ping = rdfvalue.RDFDatetime.Now() - max_age
+    index = client_index.CreateClientIndex(token=self.token)
+    count = self._communicator.PrewarmPublicKeyCache(
+        index.LookupClients(["."]), min_ping)
+    logging.info("Loaded %d public keys of recently seen clients.", count)
+    return count
+
   def DrainTaskSchedulerQueueForClient(self, client, max_count=None):
     """Drains the client's Task Scheduler queue.
 
@@ -532,6 +811,7 @@ class FrontendInit(registry.InitHook):
     stats.STATS.RegisterCounterMetric("grr_frontendserver_handle_num")
     stats.STATS.RegisterGaugeMetric("grr_frontendserver_client_cache_size", int)
     stats.STATS.RegisterCounterMetric("grr_messages_sent")
+    stats.STATS.RegisterCounterMetric("grr_frontendserver_heartbeats_written")
 
     stats.STATS.RegisterCounterMetric(
         "grr_pub_key_cache", fields=[("type", str)])
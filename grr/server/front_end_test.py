@@ -63,6 +63,7 @@ class GRRFEServerTestBase(flow_test_lib.FlowTestsBaseclass):
     self.InitTestServer()
 
   def tearDown(self):
+    front_end.StopClientHeartbeatBuffer()
     super(GRRFEServerTestBase, self).tearDown()
     self.config_overrider.Stop()
 
@@ -4,10 +4,15 @@
 
 
 import itertools
+import Queue
 import re
+import sys
+import threading
+import time
 
 from grr.lib import rdfvalue
 from grr.lib import registry
+from grr.lib import stats
 from grr.lib import utils
 from grr.server import export
 
@@ -94,6 +99,154 @@ class InstantOutputPlugin(object):
     """
 
 
+class _ConversionBatch(object):
+  """A batch of values passing through the _ConversionPipeline."""
+
+  def __init__(self, values):
+    self.values = values
+    self.results = None
+    self.exc_info = None
+    self.done = threading.Event()
+
+  def Finish(self, results=None, exc_info=None):
+    self.values = None
+    self.results = results
+    self.exc_info = exc_info
+    self.done.set()
+
+
+class _ConversionPipeline(object):
+  """Converts batches of values in background threads.
+
+  The pipeline has three stages connected by bounded queues: a reader thread
+  reading the input batches, converter threads converting them and the
+  consumer iterating over the pipeline. Up to prefetch batches are read and
+  converted ahead of the consumer. Results are yielded in input order.
+
+  Each converter thread uses its own converter instance, since converters may
+  keep state between calls.
+  """
+
+  # Marks the end of the input.
+  _DONE = object()
+
+  def __init__(self,
+               batches,
+               converter_cls,
+               options,
+               token=None,
+               threads=4,
+               prefetch=4):
+    """Constructor.
+
+    Args:
+      batches: An iterable with lists of (metadata, value) pairs.
+      converter_cls: The ExportConverter class to convert values with.
+      options: ExportOptions passed to the converters.
+      token: Security token.
+      threads: The number of converter threads.
+      prefetch: The number of batches to read and convert ahead.
+    """
+    self.batches = batches
+    self.converter_cls = converter_cls
+    self.options = options
+    self.token = token
+    self.threads = threads
+
+    self.pending = Queue.Queue(maxsize=prefetch)
+    self.to_convert = Queue.Queue()
+    self.stop = threading.Event()
+
+    reader = threading.Thread(
+        target=self._Read, name="ExportConversionReader")
+    reader.daemon = True
+    reader.start()
+
+    for i in range(threads):
+      converter = threading.Thread(
+          target=self._Convert, name="ExportConverter%d" % i)
+      converter.daemon = True
+      converter.start()
+
+  def _Put(self, item):
+    while not self.stop.is_set():
+      try:
+        self.pending.put(item, timeout=1)
+        return True
+      except Queue.Full:
+        pass
+    return False
+
+  def _Read(self):
+    try:
+      iterator = iter(self.batches)
+      while True:
+        start = time.time()
+        try:
+          values = next(iterator)
+        except StopIteration:
+          break
+        _RecordStage("read", start, len(values))
+
+        batch = _ConversionBatch(values)
+        if not self._Put(batch):
+          return
+        self.to_convert.put(batch)
+      self._Put(self._DONE)
+    except Exception:  # pylint: disable=broad-except
+      batch = _ConversionBatch(None)
+      batch.Finish(exc_info=sys.exc_info())
+      self._Put(batch)
+    finally:
+      for _ in range(self.threads):
+        self.to_convert.put(None)
+
+  def _Convert(self):
+    converter = self.converter_cls(self.options)
+    while True:
+      batch = self.to_convert.get()
+      if batch is None:
+        return
+      if self.stop.is_set():
+        batch.Finish()
+        continue
+
+      start = time.time()
+      try:
+        results = list(converter.BatchConvert(batch.values, token=self.token))
+      except Exception:  # pylint: disable=broad-except
+        batch.Finish(exc_info=sys.exc_info())
+        continue
+      _RecordStage("convert", start, len(results))
+      batch.Finish(results=results)
+
+  def __iter__(self):
+    try:
+      while True:
+        batch = self.pending.get()
+        if batch is self._DONE:
+          return
+
+        batch.done.wait()
+        if batch.exc_info:
+          raise batch.exc_info[0], batch.exc_info[1], batch.exc_info[2]
+
+        start = time.time()
+        for result in batch.results:
+          yield result
+        _RecordStage("write", start, len(batch.results))
+    finally:
+      # Stops the reader and the converters if the consumer gives up early.
+      self.stop.set()
+
+
+def _RecordStage(stage, start, values_count):
+  stats.STATS.RecordEvent(
+      "instant_output_stage_latency", time.time() - start, fields=[stage])
+  stats.STATS.IncrementCounter(
+      "instant_output_stage_values", values_count, fields=[stage])
+
+
 class InstantOutputPluginWithExportConversion(InstantOutputPlugin):
   """Instant output plugin that flattens data before exporting."""
 
@@ -101,6 +254,12 @@ class InstantOutputPluginWithExportConversion(InstantOutputPlugin):
 
   BATCH_SIZE = 5000
 
+  # The number of threads converting batches and the number of batches read
+  # and converted ahead of the plugin. If CONVERSION_THREADS is 0, batches are
+  # converted on the calling thread.
+  CONVERSION_THREADS = 4
+  CONVERSION_PREFETCH = 4
+
   def GetDefaultMetadata(self):
     """Returns metadata to be used by export converters."""
     return export.ExportedMetadata(source_urn=self.source_urn)
@@ -178,18 +337,14 @@ class InstantOutputPluginWithExportConversion(InstantOutputPlugin):
 
       yield converted_response
 
-  def _GenerateConvertedValues(self, converter, grr_messages):
-    """Generates converted values using given converter from given messages.
-
-    Groups values in batches of BATCH_SIZE size and applies the converter
-    to each batch.
+  def _GenerateBatchesWithMetadata(self, grr_messages):
+    """Groups messages in batches of (metadata, payload) pairs.
 
     Args:
-      converter: ExportConverter instance.
       grr_messages: An iterable (a generator is assumed) with GRRMessage values.
 
     Yields:
-      Values generated by the converter.
+      Lists of up to BATCH_SIZE (metadata, payload) pairs.
 
     Raises:
       ValueError: if any of the GrrMessage objects doesn't have "source" set.
@@ -204,22 +359,55 @@ class InstantOutputPluginWithExportConversion(InstantOutputPlugin):
         metadata.client_urn = grr_message.source
         batch_with_metadata.append((metadata, grr_message.payload))
 
-      for result in converter.BatchConvert(
-          batch_with_metadata, token=self.token):
-        yield result
+      yield batch_with_metadata
+
+  def _GenerateConvertedValues(self, converter_cls, grr_messages):
+    """Generates converted values using given converter from given messages.
+
+    Groups values in batches of BATCH_SIZE size and applies the converter
+    to each batch. Batches are converted by a _ConversionPipeline while the
+    plugin processes the results of the previous ones.
+
+    Args:
+      converter_cls: ExportConverter class.
+      grr_messages: An iterable (a generator is assumed) with GRRMessage values.
+
+    Yields:
+      Values generated by the converter.
+
+    Raises:
+      ValueError: if any of the GrrMessage objects doesn't have "source" set.
+    """
+    batches = self._GenerateBatchesWithMetadata(grr_messages)
+
+    if not self.CONVERSION_THREADS:
+      converter = converter_cls(self.GetExportOptions())
+      for batch in batches:
+        for result in converter.BatchConvert(batch, token=self.token):
+          yield result
+      return
+
+    pipeline = _ConversionPipeline(
+        batches,
+        converter_cls,
+        self.GetExportOptions(),
+        token=self.token,
+        threads=self.CONVERSION_THREADS,
+        prefetch=self.CONVERSION_PREFETCH)
+    for result in pipeline:
+      yield result
 
   def ProcessValues(self, value_type, values_generator_fn):
     converter_classes = export.ExportConverter.GetConvertersByClass(value_type)
     if not converter_classes:
       return
-    converters = [cls(self.GetExportOptions()) for cls in converter_classes]
 
     next_types = set()
     processed_types = set()
     while True:
       converted_responses = itertools.chain.from_iterable(
-          self._GenerateConvertedValues(converter, values_generator_fn())
-          for converter in converters)
+          self._GenerateConvertedValues(converter_cls, values_generator_fn())
+          for converter_cls in converter_classes)
 
       generator = self._GenerateSingleTypeIteration(next_types, processed_types,
                                                     converted_responses)
@@ -231,6 +419,16 @@ class InstantOutputPluginWithExportConversion(InstantOutputPlugin):
         break
 
 
+class InstantOutputPluginInit(registry.InitHook):
+  """Registers instant output plugin stats variables."""
+
+  def RunOnce(self):
+    stats.STATS.RegisterEventMetric(
+        "instant_output_stage_latency", fields=[("stage", str)])
+    stats.STATS.RegisterCounterMetric(
+        "instant_output_stage_values", fields=[("stage", str)])
+
+
 def ApplyPluginToMultiTypeCollection(plugin, output_collection,
                                      source_urn=None):
   """Applies instant output plugin to a multi-type collection.
@@ -253,11 +451,12 @@ def ApplyPluginToMultiTypeCollection(plugin, output_collection,
 
     # pylint: disable=cell-var-from-loop
     def GetValues():
-      for timestamp, value in output_collection.ScanByType(stored_type_name):
-        _ = timestamp
-        if source_urn:
-          value.source = source_urn
-        yield value
+      # Reading the next batches overlaps with the plugin processing values.
+      for batch in output_collection.ScanBatchesByType(stored_type_name):
+        for _, value in batch:
+          if source_urn:
+            value.source = source_urn
+          yield value
 
     # pylint: enable=cell-var-from-loop
 
@@ -4,6 +4,7 @@
 
 from grr.lib import flags
 from grr.lib import rdfvalue
+from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.server import data_store
@@ -225,6 +226,34 @@ class InstantOutputPluginWithExportConversionTest(
         "Finish"
     ])  # pyformat: disable
 
+  def testKeepsOrderOfValuesConvertedInParallelBatches(self):
+    values = [DummySrcValue1("foo%d" % i) for i in range(25)]
+    with utils.MultiStubber(
+        (self.plugin_cls, "BATCH_SIZE", 2),
+        (self.plugin_cls, "CONVERSION_THREADS", 3),
+        (self.plugin_cls, "CONVERSION_PREFETCH", 2)):
+      lines = self.ProcessValuesToLines({DummySrcValue1: values})
+
+    self.assertListEqual(
+        lines, ["Start", "Original: DummySrcValue1"] +
+        ["Exported value: exp-foo%d" % i for i in range(25)] + ["Finish"])
+
+  def testRaisesConversionErrors(self):
+
+    def BatchConvert(converter, metadata_value_pairs, token=None):
+      _ = converter
+      _ = token
+      if any(str(value) == "bar" for _, value in metadata_value_pairs):
+        raise ValueError("Conversion failed")
+      return []
+
+    with utils.Stubber(TestConverter1, "BatchConvert", BatchConvert):
+      with self.assertRaises(ValueError):
+        self.ProcessValuesToLines({
+            DummySrcValue1: [DummySrcValue1("foo"),
+                             DummySrcValue1("bar")]
+        })
+
 
 def main(argv):
   test_lib.main(argv)
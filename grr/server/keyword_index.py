@@ -7,10 +7,56 @@ possible to search for those names which match all keywords.
 """
 
 
+import array
+import bisect
+import itertools
+
+from grr.lib import utils
 from grr.server import aff4
 from grr.server import data_store
 
 
+class PostingList(object):
+  """The names associated with a keyword.
+
+  Names are stored as sorted keys together with the latest timestamp they were
+  seen at, so that a name can be looked up by binary search.
+  """
+
+  def __init__(self, keys_and_timestamps, typecode=None):
+    """Constructor.
+
+    Args:
+      keys_and_timestamps: An iterable of (key, timestamp) pairs.
+      typecode: If set, keys are stored in an array of this type instead of a
+          list.
+    """
+    keys_and_timestamps = sorted(keys_and_timestamps)
+    keys = [key for key, _ in keys_and_timestamps]
+    if typecode:
+      self.keys = array.array(typecode, keys)
+    else:
+      self.keys = keys
+    # Timestamps in microseconds are exactly representable as doubles.
+    self.timestamps = array.array("d", [ts for _, ts in keys_and_timestamps])
+
+  def __len__(self):
+    return len(self.keys)
+
+  def Get(self, key):
+    """Returns the timestamp of key or None if key is not in the list."""
+    i = bisect.bisect_left(self.keys, key)
+    if i < len(self.keys) and self.keys[i] == key:
+      return int(self.timestamps[i])
+    return None
+
+  def Iterate(self, start_time, end_time):
+    """Yields (key, timestamp) in key order for keys seen in the time range."""
+    for key, ts in itertools.izip(self.keys, self.timestamps):
+      if start_time <= ts <= end_time:
+        yield key, int(ts)
+
+
 class AFF4KeywordIndex(aff4.AFF4Object):
   """An index linking keywords to names of objects.
   """
@@ -18,11 +64,104 @@ class AFF4KeywordIndex(aff4.AFF4Object):
   FIRST_TIMESTAMP = 0
   LAST_TIMESTAMP = (2**63) - 2  # maxint64 - 1
 
+  # The type of the array posting list keys are stored in, None for a list.
+  POSTING_LIST_TYPECODE = None
+
+  # Posting lists of popular keywords are cached in memory. Small lists are
+  # cheap to read and would only push the popular ones out of the cache.
+  posting_list_cache_max_size = 100
+  posting_list_cache_age = 60
+  posting_list_cache_min_length = 1000
+
+  _posting_list_cache = None
+
+  @classmethod
+  def _GetPostingListCache(cls):
+    if AFF4KeywordIndex._posting_list_cache is None:
+      AFF4KeywordIndex._posting_list_cache = utils.AgeBasedCache(
+          max_size=cls.posting_list_cache_max_size,
+          max_age=cls.posting_list_cache_age)
+    return AFF4KeywordIndex._posting_list_cache
+
+  @classmethod
+  def FlushPostingListCache(cls):
+    """Drops all cached posting lists."""
+    cls._GetPostingListCache().Flush()
+
+  def _NameToPostingKey(self, name):
+    """Converts a name to the key stored in posting lists."""
+    return name
+
+  def _PostingKeyToName(self, key):
+    """Converts a posting list key back to the name."""
+    return key
+
+  def _ReadPostingListObjects(self, keywords, start_time, end_time):
+    """Reads the PostingList of each keyword, from the cache if possible.
+
+    Cached posting lists hold the latest timestamp of every name since the
+    start time they were read for, so they can only answer queries which are
+    not bounded by an end time.
+
+    Args:
+      keywords: A collection of keywords that we are interested in.
+      start_time: Only considers keywords added at or after this point in time.
+      end_time: Only considers keywords at or before this point in time.
+
+    Returns:
+      A dict mapping each keyword to a PostingList.
+    """
+    cache = self._GetPostingListCache()
+    cacheable = end_time >= self.LAST_TIMESTAMP
+
+    index_urn = str(self.urn)
+    result = {}
+    to_read = []
+    for keyword in set(keywords):
+      if cacheable:
+        try:
+          read_start_time, posting_list = cache.Get((index_urn, keyword))
+          if read_start_time <= start_time:
+            result[keyword] = posting_list
+            continue
+        except KeyError:
+          pass
+      to_read.append(keyword)
+
+    if not to_read:
+      return result
+
+    last_seen_map = {}
+    data_store.DB.IndexReadPostingLists(
+        self.urn, to_read, start_time, end_time, last_seen_map=last_seen_map)
+
+    keys_and_timestamps = dict((keyword, []) for keyword in to_read)
+    for (keyword, name), ts in last_seen_map.iteritems():
+      try:
+        key = self._NameToPostingKey(name)
+      except ValueError:
+        continue
+      keys_and_timestamps[keyword].append((key, ts))
+
+    for keyword, entries in keys_and_timestamps.iteritems():
+      posting_list = PostingList(entries, typecode=self.POSTING_LIST_TYPECODE)
+      result[keyword] = posting_list
+      if cacheable and len(entries) >= self.posting_list_cache_min_length:
+        cache.Put((index_urn, keyword), (start_time, posting_list))
+
+    return result
+
+  def _ExpireCachedPostingLists(self, keywords):
+    cache = self._GetPostingListCache()
+    for keyword in keywords:
+      cache.ExpireObject((str(self.urn), keyword))
+
   def Lookup(self,
              keywords,
              start_time=FIRST_TIMESTAMP,
              end_time=LAST_TIMESTAMP,
-             last_seen_map=None):
+             last_seen_map=None,
+             limit=None):
     """Finds objects associated with keywords.
 
     Find the names related to all keywords.
@@ -33,24 +172,37 @@ class AFF4KeywordIndex(aff4.AFF4Object):
       end_time: Only considers keywords at or before this point in time.
       last_seen_map: If present, is treated as a dict and populated to map pairs
         (keyword, name) to the timestamp of the latest connection found.
+      limit: If set, only the first limit names in key order are returned.
     Returns:
       A set of potentially relevant names.
 
     """
-    posting_lists = self.ReadPostingLists(
-        keywords,
-        start_time=start_time,
-        end_time=end_time,
-        last_seen_map=last_seen_map)
+    posting_lists = self._ReadPostingListObjects(keywords, start_time, end_time)
+    if not posting_lists:
+      return set()
 
-    results = posting_lists.values()
-    relevant_set = results[0]
+    # Walk the shortest list and look its names up in the others.
+    ordered = sorted(posting_lists.items(), key=lambda item: len(item[1]))
+    shortest_keyword, shortest = ordered[0]
+    others = ordered[1:]
 
-    for hits in results:
-      relevant_set &= hits
+    relevant_set = set()
+    for key, ts in shortest.Iterate(start_time, end_time):
+      timestamps = [(shortest_keyword, ts)]
+      for keyword, posting_list in others:
+        other_ts = posting_list.Get(key)
+        if other_ts is None or not start_time <= other_ts <= end_time:
+          break
+        timestamps.append((keyword, other_ts))
+      else:
+        name = self._PostingKeyToName(key)
+        relevant_set.add(name)
+        if last_seen_map is not None:
+          for keyword, ts in timestamps:
+            last_seen_map[(keyword, name)] = ts
 
-      if not relevant_set:
-        return relevant_set
+        if limit and len(relevant_set) >= limit:
+          break
 
     return relevant_set
 
@@ -71,8 +223,18 @@ class AFF4KeywordIndex(aff4.AFF4Object):
       A dict mapping each keyword to a set of relevant names.
 
     """
-    return data_store.DB.IndexReadPostingLists(
-        self.urn, keywords, start_time, end_time, last_seen_map=last_seen_map)
+    posting_lists = self._ReadPostingListObjects(keywords, start_time, end_time)
+
+    result = {}
+    for keyword, posting_list in posting_lists.iteritems():
+      names = result[keyword] = set()
+      for key, ts in posting_list.Iterate(start_time, end_time):
+        name = self._PostingKeyToName(key)
+        names.add(name)
+        if last_seen_map is not None:
+          last_seen_map[(keyword, name)] = ts
+
+    return result
 
   def AddKeywordsForName(self, name, keywords):
     """Associates keywords with name.
@@ -84,6 +246,7 @@ class AFF4KeywordIndex(aff4.AFF4Object):
       keywords: A collection of keywords to associate with name.
     """
     data_store.DB.IndexAddKeywordsForName(self.urn, name, keywords)
+    self._ExpireCachedPostingLists(keywords)
 
   def RemoveKeywordsForName(self, name, keywords):
     """Removes keywords for a name.
@@ -93,3 +256,4 @@ class AFF4KeywordIndex(aff4.AFF4Object):
       keywords: A collection of keywords.
     """
     data_store.DB.IndexRemoveKeywordsForName(self.urn, name, keywords)
+    self._ExpireCachedPostingLists(keywords)
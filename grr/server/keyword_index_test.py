@@ -3,7 +3,9 @@
 
 
 from grr.lib import flags
+from grr.lib import utils
 from grr.server import aff4
+from grr.server import data_store
 from grr.server import keyword_index
 from grr.test_lib import aff4_test_lib
 from grr.test_lib import test_lib
@@ -86,6 +88,59 @@ class KeywordIndexTest(aff4_test_lib.AFF4ObjectTest):
     self.assertEqual(2004 * 1000000, ls_map[("popular_keyword1", "C.000000")])
     self.assertEqual(1009 * 1000000, ls_map[("popular_keyword2", "C.000000")])
 
+  def testKeywordIndexLookupLimit(self):
+    index = aff4.FACTORY.Create(
+        "aff4:/index3/",
+        aff4_type=keyword_index.AFF4KeywordIndex,
+        mode="rw",
+        token=self.token)
+    for i in range(20):
+      index.AddKeywordsForName("C.%02d" % i, ["popular_keyword1"])
+    for i in range(10, 50):
+      index.AddKeywordsForName("C.%02d" % i, ["popular_keyword2"])
+
+    results = index.Lookup(["popular_keyword1", "popular_keyword2"], limit=3)
+    self.assertEqual(results, set(["C.10", "C.11", "C.12"]))
+
+  def testKeywordIndexCachesPopularPostingLists(self):
+    index = aff4.FACTORY.Create(
+        "aff4:/index4/",
+        aff4_type=keyword_index.AFF4KeywordIndex,
+        mode="rw",
+        token=self.token)
+    for i in range(10):
+      index.AddKeywordsForName("C.%02d" % i, ["popular_keyword1"])
+    index.AddKeywordsForName("C.00", ["rare_keyword"])
+
+    read_keywords = []
+    original_read = data_store.DB.IndexReadPostingLists
+
+    def IndexReadPostingLists(index_urn, keywords, *args, **kwargs):
+      read_keywords.extend(keywords)
+      return original_read(index_urn, keywords, *args, **kwargs)
+
+    with utils.MultiStubber(
+        (keyword_index.AFF4KeywordIndex, "posting_list_cache_min_length", 5),
+        (data_store.DB, "IndexReadPostingLists", IndexReadPostingLists)):
+      for _ in range(3):
+        self.assertEqual(len(index.Lookup(["popular_keyword1"])), 10)
+        self.assertEqual(
+            index.Lookup(["popular_keyword1", "rare_keyword"]), set(["C.00"]))
+      self.assertEqual(
+          sorted(read_keywords),
+          ["popular_keyword1"] + ["rare_keyword"] * 3)
+
+      # Lists bounded by an end time are always read from the data store.
+      del read_keywords[:]
+      index.Lookup(["popular_keyword1"], end_time=2**62)
+      self.assertEqual(read_keywords, ["popular_keyword1"])
+
+      # Changing the keywords of a name drops the cached list.
+      del read_keywords[:]
+      index.AddKeywordsForName("C.10", ["popular_keyword1"])
+      self.assertEqual(len(index.Lookup(["popular_keyword1"])), 11)
+      self.assertEqual(read_keywords, ["popular_keyword1"])
+
 
 def main(argv):
   test_lib.main(argv)
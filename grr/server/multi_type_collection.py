@@ -117,6 +117,28 @@ class MultiTypeCollection(object):
         max_records=max_records):
       yield item
 
+  def ScanBatchesByType(self, type_name, batch_size=1000, prefetch=2):
+    """Scans for stored records of the given type in batches.
+
+    See SequentialCollection.ScanBatches for details.
+
+    Args:
+      type_name: Type of the records to scan.
+
+      batch_size: The number of records in each batch.
+
+      prefetch: The number of batches to read ahead.
+
+    Yields:
+      Lists of (timestamp, rdf_value) pairs.
+    """
+    sub_collection_urn = self.collection_id.Add(type_name)
+    sub_collection = sequential_collection.GrrMessageCollection(
+        sub_collection_urn)
+    for batch in sub_collection.ScanBatches(
+        batch_size=batch_size, prefetch=prefetch):
+      yield batch
+
   def LengthByType(self, type_name):
     sub_collection_urn = self.collection_id.Add(type_name)
     sub_collection = sequential_collection.GrrMessageCollection(
@@ -113,6 +113,23 @@ class MultiTypeCollectionTest(aff4_test_lib.AFF4ObjectTest):
         self.collection.ScanByType(rdfvalue.RDFString.__name__)):
       self.assertEqual(str(index), v.payload)
 
+  def testValuesOfMultipleTypesCanBeScannedInBatchesPerType(self):
+    with self.pool:
+      for i in range(15):
+        self.collection.Add(
+            rdf_flows.GrrMessage(payload=rdfvalue.RDFInteger(i)),
+            mutation_pool=self.pool)
+        self.collection.Add(
+            rdf_flows.GrrMessage(payload=rdfvalue.RDFString(i)),
+            mutation_pool=self.pool)
+
+    batches = list(
+        self.collection.ScanBatchesByType(
+            rdfvalue.RDFInteger.__name__, batch_size=10))
+    self.assertEqual([len(batch) for batch in batches], [10, 5])
+    self.assertEqual([v.payload for batch in batches for _, v in batch],
+                     range(15))
+
   def testLengthIsReportedCorrectlyForEveryType(self):
     with self.pool:
       for i in range(99):
@@ -2,8 +2,11 @@
 """This is the manager for the various queues."""
 
 import collections
+import functools
 import logging
 import random
+import threading
+import weakref
 
 from grr import config
 from grr.lib import rdfvalue
@@ -50,6 +53,72 @@ def _GetClientIdFromQueue(q):
   return str_client_id
 
 
+class NotificationSubscription(object):
+  """Collects the queue shards which received notifications for a worker."""
+
+  def __init__(self, queues):
+    self.queues = set(str(queue) for queue in queues)
+    self._condition = threading.Condition()
+    # Sets of queue shards with new notifications by queue name.
+    self._queue_shards = {}
+
+  def Add(self, queue, queue_shard):
+    with self._condition:
+      self._queue_shards.setdefault(str(queue), set()).add(queue_shard)
+      self._condition.notify_all()
+
+  def PopQueueShards(self, queue):
+    """Returns and forgets the shards of queue with new notifications."""
+    with self._condition:
+      return self._queue_shards.pop(str(queue), set())
+
+  def Wait(self, timeout):
+    """Waits for new notifications.
+
+    Args:
+      timeout: The maximum time to wait in seconds.
+
+    Returns:
+      True if some queue shards received notifications.
+    """
+    with self._condition:
+      if not self._queue_shards:
+        self._condition.wait(timeout)
+      return bool(self._queue_shards)
+
+
+class NotificationWakeups(object):
+  """Tells workers in this process about new notifications.
+
+  Workers subscribe to their queues and are woken up as soon as notifications
+  for these queues are written, instead of finding them on their next poll.
+  Only notifications written by this process are published, so workers still
+  poll for the ones written by other processes.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self._subscriptions = weakref.WeakSet()
+
+  def Subscribe(self, queues):
+    """Returns a NotificationSubscription for the given queues."""
+    subscription = NotificationSubscription(queues)
+    with self.lock:
+      self._subscriptions.add(subscription)
+    return subscription
+
+  def Publish(self, queue, queue_shard):
+    with self.lock:
+      subscriptions = list(self._subscriptions)
+
+    for subscription in subscriptions:
+      if str(queue) in subscription.queues:
+        subscription.Add(queue, queue_shard)
+
+
+WAKEUPS = NotificationWakeups()
+
+
 class QueueManager(object):
   """This class manages the representation of the flow within the data store.
 
@@ -427,13 +496,29 @@ class QueueManager(object):
 
     return output_dict
 
-  def GetNotificationsByPriority(self, queue):
-    """Retrieves session ids for processing grouped by priority."""
+  def GetNotificationsByPriority(self, queue, extra_queue_shards=None):
+    """Retrieves session ids for processing grouped by priority.
+
+    Args:
+      queue: usually rdfvalue.RDFURN("aff4:/W")
+      extra_queue_shards: Shards of the queue known to have new notifications,
+        they are read besides the next shard in turn.
+    Returns:
+      dict of notifications objects keyed by priority.
+    """
     # Check which sessions have new data.
     # Read all the sessions that have notifications.
-    queue_shard = self.GetNotificationShard(queue)
-    return self._SortByPriority(
-        self._GetUnsortedNotifications(queue_shard).values(), queue)
+    queue_shards = [self.GetNotificationShard(queue)]
+    for queue_shard in extra_queue_shards or []:
+      if queue_shard not in queue_shards:
+        queue_shards.append(queue_shard)
+
+    notifications_by_session_id = {}
+    for queue_shard in queue_shards:
+      self._GetUnsortedNotifications(
+          queue_shard, notifications_by_session_id=notifications_by_session_id)
+
+    return self._SortByPriority(notifications_by_session_id.values(), queue)
 
   def GetNotificationsByPriorityForAllShards(self, queue):
     """Same as GetNotificationsByPriority but for all shards.
@@ -554,8 +639,11 @@ class QueueManager(object):
 
       notification_list.append(notification)
 
-    mutation_pool.CreateNotifications(
-        self.GetNotificationShard(queue), notification_list)
+    queue_shard = self.GetNotificationShard(queue)
+    mutation_pool.CreateNotifications(queue_shard, notification_list)
+    # Workers are only woken up once the notifications can be read.
+    mutation_pool.OnFlush(
+        functools.partial(WAKEUPS.Publish, queue, queue_shard))
 
   def DeleteNotification(self, session_id, start=None, end=None):
     self.DeleteNotifications([session_id], start=start, end=end)
@@ -2,19 +2,75 @@
 """A collection of records stored sequentially.
 """
 
+import array
+import bisect
 import collections
+import Queue
 import random
+import sys
 import threading
 import time
 
 from grr.lib import rdfvalue
 from grr.lib import registry
+from grr.lib import utils
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.lib.rdfvalues import protodict as rdf_protodict
 
 from grr.server import data_store
 
 
+class _PrefetchingReader(object):
+  """Iterates over a generator which runs in a background thread.
+
+  The thread stays up to prefetch items ahead of the consumer. Exceptions
+  raised by the generator are re-raised in the consumer.
+  """
+
+  # Marks the end of the iteration.
+  _DONE = object()
+
+  def __init__(self, generator, prefetch):
+    self.generator = generator
+    self.queue = Queue.Queue(maxsize=prefetch)
+    self.stop = threading.Event()
+    self.thread = threading.Thread(
+        target=self._Read, name="SequentialCollectionReader")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _Put(self, item):
+    while not self.stop.is_set():
+      try:
+        self.queue.put(item, timeout=1)
+        return True
+      except Queue.Full:
+        pass
+    return False
+
+  def _Read(self):
+    try:
+      for item in self.generator:
+        if not self._Put((item, None)):
+          return
+      self._Put((self._DONE, None))
+    except Exception:  # pylint: disable=broad-except
+      self._Put((self._DONE, sys.exc_info()))
+
+  def __iter__(self):
+    try:
+      while True:
+        item, exc_info = self.queue.get()
+        if exc_info:
+          raise exc_info[0], exc_info[1], exc_info[2]
+        if item is self._DONE:
+          return
+        yield item
+    finally:
+      # Stops the reader if the consumer gives up early.
+      self.stop.set()
+
+
 class SequentialCollection(object):
   """A sequential collection of RDFValues.
 
@@ -155,6 +211,61 @@ class SequentialCollection(object):
       else:
         yield (timestamp, item)
 
+  def ScanBatches(self,
+                  batch_size=1000,
+                  prefetch=2,
+                  after_timestamp=None,
+                  include_suffix=False,
+                  max_records=None):
+    """Scans for stored records in batches.
+
+    Records are read by a background thread which fetches up to prefetch
+    batches ahead while the caller processes the current one. The values of a
+    batch are only deserialized once the batch is handed to the caller.
+
+    Args:
+      batch_size: The number of records in each batch.
+
+      prefetch: The number of batches to read ahead. If 0, batches are read
+        on the calling thread.
+
+      after_timestamp: If set, only returns values recorded after timestamp.
+
+      include_suffix: If true, the timestamps returned are pairs of the form
+        (micros_since_epoc, suffix). Otherwise only micros_since_epoc is
+        returned.
+
+      max_records: The maximum number of records to return. Defaults to
+        unlimited.
+
+    Yields:
+      Lists of (timestamp, rdf_value) pairs, ordered by timestamp.
+    """
+    suffix = None
+    if isinstance(after_timestamp, tuple):
+      suffix = after_timestamp[1]
+      after_timestamp = after_timestamp[0]
+
+    raw_batches = utils.Grouper(
+        data_store.DB.CollectionScanRawItems(
+            self.collection_id,
+            after_timestamp=after_timestamp,
+            after_suffix=suffix,
+            limit=max_records), batch_size)
+    if prefetch > 0:
+      raw_batches = _PrefetchingReader(raw_batches, prefetch)
+
+    for raw_batch in raw_batches:
+      batch = []
+      for serialized_value, timestamp, record_suffix in raw_batch:
+        rdf_value = self.RDF_TYPE.FromSerializedString(serialized_value)
+        rdf_value.age = timestamp
+        if include_suffix:
+          batch.append(((timestamp, record_suffix), rdf_value))
+        else:
+          batch.append((timestamp, rdf_value))
+      yield batch
+
   def MultiResolve(self, records):
     """Lookup multiple values by their record objects."""
     for value, timestamp in data_store.DB.CollectionReadItems(records):
@@ -231,6 +342,57 @@ class UpdaterStartHook(registry.InitHook):
     t.start()
 
 
+class CollectionIndex(object):
+  """The index of an IndexedSequentialCollection.
+
+  Index points are kept in two packed arrays: the timestamp and suffix of
+  record number i * spacing are stored at position i. Only consecutive index
+  points are kept so the index can be used like a dict mapping record numbers
+  to (timestamp, suffix) tuples.
+
+  Python 2 arrays have no 64 bit integer type that is available on all
+  platforms so timestamps are stored as doubles. Microsecond timestamps stay
+  well below 2**53 and are therefore represented exactly.
+  """
+
+  def __init__(self, spacing):
+    self.spacing = spacing
+    self.timestamps = array.array("d", [0])
+    self.suffixes = array.array("l", [0])
+
+  @property
+  def max_indexed(self):
+    return (len(self.timestamps) - 1) * self.spacing
+
+  def Load(self, index_points):
+    """Adds (index, ts, suffix) tuples as read from the data store."""
+    for index, ts, suffix in sorted(index_points):
+      if index == self.max_indexed + self.spacing:
+        self.Append(ts, suffix)
+
+  def Append(self, ts, suffix):
+    self.timestamps.append(ts)
+    self.suffixes.append(suffix)
+
+  def __getitem__(self, index):
+    position, remainder = divmod(index, self.spacing)
+    if remainder or not 0 <= position < len(self.timestamps):
+      raise KeyError(index)
+    return (int(self.timestamps[position]), self.suffixes[position])
+
+  def __contains__(self, index):
+    return index % self.spacing == 0 and 0 <= index <= self.max_indexed
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def __len__(self):
+    return len(self.timestamps)
+
+  def keys(self):
+    return range(0, self.max_indexed + 1, self.spacing)
+
+
 class IndexedSequentialCollection(SequentialCollection):
   """An indexed sequential collection of RDFValues.
 
@@ -245,6 +407,11 @@ class IndexedSequentialCollection(SequentialCollection):
   # full index must fit comfortably in RAM, default is meant to be reasonable
   # for collections of up to ~1b small records. (Assumes we can have ~1m index
   # points in ram, and that reading 1k records is reasonably fast.)
+  #
+  # Random access reads the records from the closest index point onwards in a
+  # single ranged scan, so collection[i] reads at most INDEX_SPACING records.
+  # A dense index would make this a direct lookup but would cost one index
+  # attribute in the data store and 16 bytes of RAM per record.
 
   INDEX_SPACING = 1024
 
@@ -259,6 +426,9 @@ class IndexedSequentialCollection(SequentialCollection):
 
   INDEX_WRITE_DELAY = rdfvalue.Duration("3m")
 
+  # How long UpdateIndex may hold the lock for merging the record counts.
+  COUNT_MERGE_LEASE = 600
+
   def __init__(self, *args, **kwargs):
     super(IndexedSequentialCollection, self).__init__(*args, **kwargs)
     self._index = None
@@ -266,23 +436,24 @@ class IndexedSequentialCollection(SequentialCollection):
   def _ReadIndex(self):
     if self._index:
       return
-    self._index = {0: (0, 0)}
-    self._max_indexed = 0
-    for (index, ts, suffix) in data_store.DB.CollectionReadIndex(
-        self.collection_id):
-      self._index[index] = (ts, suffix)
-      self._max_indexed = max(index, self._max_indexed)
+    self._index = CollectionIndex(self.INDEX_SPACING)
+    self._index.Load(data_store.DB.CollectionReadIndex(self.collection_id))
+    self._max_indexed = self._index.max_indexed
+
+  def _IndexCutoff(self):
+    # We only persist index points and record counts if the timestamp is more
+    # than INDEX_WRITE_DELAY in the past: hacky defense against a late write
+    # changing the count.
+    return (rdfvalue.RDFDatetime.Now() -
+            self.INDEX_WRITE_DELAY).AsMicroSecondsFromEpoch()
 
   def _MaybeWriteIndex(self, i, ts, mutation_pool):
     """Write index marker i."""
-    if i > self._max_indexed and i % self.INDEX_SPACING == 0:
-      # We only write the index if the timestamp is more than 5 minutes in the
-      # past: hacky defense against a late write changing the count.
-      if ts[0] < (rdfvalue.RDFDatetime.Now() -
-                  self.INDEX_WRITE_DELAY).AsMicroSecondsFromEpoch():
-        mutation_pool.CollectionAddIndex(self.collection_id, i, ts[0], ts[1])
-        self._index[i] = ts
-        self._max_indexed = max(i, self._max_indexed)
+    if (i == self._max_indexed + self.INDEX_SPACING and
+        ts[0] < self._IndexCutoff()):
+      mutation_pool.CollectionAddIndex(self.collection_id, i, ts[0], ts[1])
+      self._index.Append(ts[0], ts[1])
+      self._max_indexed = i
 
   def _IndexedScan(self, i, max_records=None):
     """Scan records starting with index i."""
@@ -330,22 +501,75 @@ class IndexedSequentialCollection(SequentialCollection):
     else:
       raise RuntimeError("Index must be >= 0")
 
-  def CalculateLength(self):
+  def _CountRecordsBefore(self, timestamp):
+    """Counts the records stored before timestamp, all if it is None."""
     self._ReadIndex()
-    highest_index = None
-    for (i, _, _) in self._IndexedScan(self._max_indexed):
-      highest_index = i
-    if highest_index is None:
-      return 0
-    return highest_index + 1
+    if timestamp is None:
+      length = self._max_indexed
+    else:
+      position = bisect.bisect_left(self._index.timestamps, timestamp) - 1
+      length = min(max(0, position) * self.INDEX_SPACING, self._max_indexed)
+
+    ts, suffix = self._index[length]
+    for (ts, _) in self.Scan(
+        after_timestamp=max((0, 0), (ts, suffix - 1)), include_suffix=True):
+      if timestamp is not None and ts[0] >= timestamp:
+        break
+      length += 1
+    return length
+
+  def _CalculateLength(self, base_count, counts):
+    length = sum(count for _, count, _ in counts)
+    if base_count is not None:
+      return base_count + length
+
+    # Records which were written before counts were maintained are older than
+    # all counts and have to be counted.
+    oldest = min(ts for _, _, ts in counts) if counts else None
+    return length + self._CountRecordsBefore(oldest)
+
+  def CalculateLength(self):
+    """Returns the number of records in the collection.
+
+    Writers store the number of records they add, so only these counts are
+    read and added up. Records which were written before counts were
+    maintained are counted until UpdateIndex merged the counts the first time.
+    This never writes to the data store.
+
+    Returns:
+      The number of records.
+    """
+    return self._CalculateLength(
+        *data_store.DB.CollectionReadCounts(self.collection_id))
 
   def __len__(self):
     return self.CalculateLength()
 
+  def _MergeCounts(self):
+    """Replaces the record counts by a single base count."""
+    try:
+      with data_store.DB.LockRetryWrapper(
+          self.collection_id, blocking=False,
+          lease_time=self.COUNT_MERGE_LEASE):
+        base_count, counts = data_store.DB.CollectionReadCounts(
+            self.collection_id)
+        if base_count is not None and len(counts) < 2:
+          return
+
+        length = self._CalculateLength(base_count, counts)
+        with data_store.DB.GetMutationPool() as mutation_pool:
+          mutation_pool.CollectionMergeCounts(
+              self.collection_id, length, [attr for attr, _, _ in counts])
+    except data_store.DBSubjectLockError:
+      # Another process is merging the counts.
+      pass
+
   def UpdateIndex(self):
+    """Writes new index points and merges the record counts."""
     self._ReadIndex()
     for _ in self._IndexedScan(self._max_indexed):
       pass
+    self._MergeCounts()
 
   @classmethod
   def StaticAdd(cls,
@@ -360,6 +584,7 @@ class IndexedSequentialCollection(SequentialCollection):
         timestamp=timestamp,
         suffix=suffix,
         mutation_pool=mutation_pool)
+    mutation_pool.CollectionAddCount(rdfvalue.RDFURN(collection_urn), 1, r[0])
     if random.randint(0, cls.INDEX_SPACING) == 0:
       BACKGROUND_INDEX_UPDATER.AddIndexToUpdate(cls, collection_urn)
     return r
@@ -391,6 +616,10 @@ class GeneralIndexedCollection(IndexedSequentialCollection):
                                         self).Scan(**kwargs):
       yield (timestamp, rdf_value.payload)
 
+  def ScanBatches(self, **kwargs):
+    for batch in super(GeneralIndexedCollection, self).ScanBatches(**kwargs):
+      yield [(timestamp, rdf_value.payload) for timestamp, rdf_value in batch]
+
 
 class GrrMessageCollection(IndexedSequentialCollection):
   """Sequential HuntResultCollection."""
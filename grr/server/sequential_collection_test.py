@@ -10,6 +10,7 @@ from grr.lib import utils
 from grr.server import data_store
 from grr.server import sequential_collection
 from grr.test_lib import aff4_test_lib
+from grr.test_lib import benchmark_test_lib
 from grr.test_lib import test_lib
 
 
@@ -80,6 +81,51 @@ class SequentialCollectionTest(aff4_test_lib.AFF4ObjectTest):
     self.assertEqual(even_results[0], 0)
     self.assertEqual(even_results[49], 98)
 
+  def testScanBatches(self):
+    collection = self._TestCollection(
+        "aff4:/sequential_collection/testScanBatches")
+    with data_store.DB.GetMutationPool() as pool:
+      for i in range(25):
+        collection.Add(rdfvalue.RDFInteger(i), mutation_pool=pool)
+
+    for prefetch in [0, 1, 2]:
+      batches = list(collection.ScanBatches(batch_size=10, prefetch=prefetch))
+      self.assertEqual([len(batch) for batch in batches], [10, 10, 5])
+      self.assertEqual([v for batch in batches for _, v in batch], range(25))
+
+    scanned = list(collection.Scan(include_suffix=True))
+    batches = list(
+        collection.ScanBatches(
+            batch_size=10,
+            after_timestamp=scanned[9][0],
+            include_suffix=True,
+            max_records=12))
+    self.assertEqual([r for batch in batches for r in batch],
+                     scanned[10:22])
+
+  def testScanBatchesStopsEarly(self):
+    collection = self._TestCollection(
+        "aff4:/sequential_collection/testScanBatchesStopsEarly")
+    with data_store.DB.GetMutationPool() as pool:
+      for i in range(100):
+        collection.Add(rdfvalue.RDFInteger(i), mutation_pool=pool)
+
+    batches = collection.ScanBatches(batch_size=10, prefetch=1)
+    self.assertEqual(len(next(batches)), 10)
+    batches.close()
+
+  def testScanBatchesRaisesReaderErrors(self):
+    collection = self._TestCollection(
+        "aff4:/sequential_collection/testScanBatchesRaisesReaderErrors")
+
+    def ScanRawItems(*unused_args, **unused_kwargs):
+      yield ("", 0, 0)
+      raise data_store.Error("Read failed.")
+
+    with utils.Stubber(data_store.DB, "CollectionScanRawItems", ScanRawItems):
+      with self.assertRaises(data_store.Error):
+        list(collection.ScanBatches(batch_size=1, prefetch=1))
+
   def testDelete(self):
     collection = self._TestCollection("aff4:/sequential_collection/testDelete")
     with data_store.DB.GetMutationPool() as pool:
@@ -175,6 +221,11 @@ class IndexedSequentialCollectionTest(aff4_test_lib.AFF4ObjectTest):
         _ = collection[0]
         self.assertEqual(sorted(collection._index.keys()), [0])
 
+        # Reading the length doesn't write the index either.
+        self.assertEqual(collection.CalculateLength(), 10 * spacing)
+        self.assertEqual(sorted(collection._index.keys()), [0])
+
+        collection.UpdateIndex()
         self.assertEqual(collection.CalculateLength(), 10 * spacing)
         self.assertEqual(
             sorted(collection._index.keys()), [i * spacing for i in xrange(10)])
@@ -269,6 +320,143 @@ class IndexedSequentialCollectionTest(aff4_test_lib.AFF4ObjectTest):
       if not indexing_done.wait(timeout=10):
         self.fail("Indexing did not finish in time.")
 
+  def testMaintainedLength(self):
+    urn = rdfvalue.RDFURN("aff4:/sequential_collection/testMaintainedLength")
+    collection = self._TestCollection(urn)
+    with data_store.DB.GetMutationPool() as pool:
+      for i in range(100):
+        collection.Add(rdfvalue.RDFInteger(i), mutation_pool=pool)
+    with data_store.DB.GetMutationPool() as pool:
+      for i in range(5):
+        collection.Add(rdfvalue.RDFInteger(i), mutation_pool=pool)
+
+    # Every pool wrote one count and reading the length does not merge them.
+    self.assertEqual(len(collection), 105)
+    base_count, counts = data_store.DB.CollectionReadCounts(urn)
+    self.assertIsNone(base_count)
+    self.assertEqual(sorted(count for _, count, _ in counts), [5, 100])
+
+    collection.UpdateIndex()
+    self.assertEqual(data_store.DB.CollectionReadCounts(urn), (105, []))
+
+    with data_store.DB.GetMutationPool() as pool:
+      collection.Add(rdfvalue.RDFInteger(0), mutation_pool=pool)
+
+    # No records are read.
+    collection = self._TestCollection(urn)
+    with test_lib.Instrument(sequential_collection.SequentialCollection,
+                             "Scan") as scan:
+      self.assertEqual(len(collection), 106)
+      self.assertEqual(scan.call_count, 0)
+
+    collection.Delete()
+    self.assertEqual(data_store.DB.CollectionReadCounts(urn), (None, []))
+    self.assertEqual(len(self._TestCollection(urn)), 0)
+
+  def testLengthOfRecordsWithoutCounts(self):
+    urn = rdfvalue.RDFURN(
+        "aff4:/sequential_collection/testLengthOfRecordsWithoutCounts")
+    collection = self._TestCollection(urn)
+    now = rdfvalue.RDFDatetime.Now().AsMicroSecondsFromEpoch()
+    # Records written before counts were maintained.
+    with data_store.DB.GetMutationPool() as pool:
+      for i in range(20):
+        pool.CollectionAddItem(urn, rdfvalue.RDFInteger(i), now - 100 + i)
+    self.assertEqual(len(collection), 20)
+
+    with data_store.DB.GetMutationPool() as pool:
+      for i in range(3):
+        collection.Add(rdfvalue.RDFInteger(i), mutation_pool=pool)
+    self.assertEqual(len(collection), 23)
+
+    with utils.Stubber(TestIndexedSequentialCollection, "INDEX_SPACING", 8):
+      with test_lib.FakeTime(rdfvalue.RDFDatetime.Now() +
+                             rdfvalue.Duration("10m")):
+        collection = self._TestCollection(urn)
+        self.assertEqual(len(collection), 23)
+        collection.UpdateIndex()
+      self.assertEqual(data_store.DB.CollectionReadCounts(urn), (23, []))
+      self.assertEqual(len(self._TestCollection(urn)), 23)
+
+  def testCollectionIndex(self):
+    index = sequential_collection.CollectionIndex(10)
+    self.assertEqual(index.keys(), [0])
+    self.assertEqual(index[0], (0, 0))
+
+    # Index points after a gap can't be used.
+    index.Load([(20, 2000, 2), (10, 1000, 1), (40, 4000, 4)])
+    self.assertEqual(index.max_indexed, 20)
+    self.assertEqual(sorted(index.keys()), [0, 10, 20])
+    self.assertEqual(index[20], (2000, 2))
+    self.assertIn(10, index)
+    self.assertNotIn(15, index)
+    self.assertNotIn(40, index)
+    self.assertRaises(KeyError, index.__getitem__, 15)
+    self.assertRaises(KeyError, index.__getitem__, 40)
+
+
+class IndexedSequentialCollectionBenchmark(
+    benchmark_test_lib.MicroBenchmarks):
+  """Benchmarks the length and random reads of large collections."""
+
+  units = "s"
+
+  RECORD_COUNTS = [10**6, 10**7]
+  RANDOM_READS = 100
+  RECORDS_PER_POOL = 10000
+
+  def _CreateCollection(self, urn, record_count):
+    # The records are old enough to be indexed right away.
+    for start in range(0, record_count, self.RECORDS_PER_POOL):
+      with data_store.DB.GetMutationPool() as pool:
+        for i in range(start, min(start + self.RECORDS_PER_POOL,
+                                  record_count)):
+          TestIndexedSequentialCollection.StaticAdd(
+              urn, rdfvalue.RDFInteger(i), timestamp=10**12 + i,
+              mutation_pool=pool)
+
+  @test_lib.SetLabel("benchmark")
+  def testIndexedCollection(self):
+    for record_count in self.RECORD_COUNTS:
+      urn = rdfvalue.RDFURN("aff4:/sequential_collection/benchmark_%d" %
+                            record_count)
+      start = time.time()
+      self._CreateCollection(urn, record_count)
+      self.AddResult("Write %d records" % record_count,
+                     time.time() - start, record_count)
+
+      start = time.time()
+      collection = TestIndexedSequentialCollection(urn)
+      self.assertEqual(len(collection), record_count)
+      self.AddResult("len() of %d records, unmerged counts" % record_count,
+                     time.time() - start, 1)
+
+      start = time.time()
+      collection.UpdateIndex()
+      self.AddResult("UpdateIndex of %d records" % record_count,
+                     time.time() - start, 1)
+
+      start = time.time()
+      collection = TestIndexedSequentialCollection(urn)
+      self.assertEqual(len(collection), record_count)
+      self.AddResult("len() of %d records" % record_count,
+                     time.time() - start, 1)
+
+      start = time.time()
+      collection._ReadIndex()
+      self.AddResult("Read index of %d records" % record_count,
+                     time.time() - start, 1)
+
+      start = time.time()
+      for i in range(self.RANDOM_READS):
+        index = i * 7919 * 1009 % record_count
+        self.assertEqual(collection[index], index)
+      self.AddResult("Random reads in %d records" % record_count,
+                     time.time() - start, self.RANDOM_READS)
+
+      with data_store.DB.GetMutationPool() as pool:
+        pool.CollectionDelete(urn)
+
 
 class GeneralIndexedCollectionTest(aff4_test_lib.AFF4ObjectTest):
 
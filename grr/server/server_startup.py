@@ -35,10 +35,14 @@ def DropPrivileges():
 INIT_RAN = False
 
 
-def Init():
-  """Run all required startup routines and initialization hooks."""
-  global INIT_RAN
-  if INIT_RAN:
+# Make sure we parse the config only once.
+CONFIG_INIT_RAN = False
+
+
+def ConfigInit():
+  """Parses the config, Init() does this if it was not done before."""
+  global CONFIG_INIT_RAN
+  if CONFIG_INIT_RAN:
     return
 
   # Set up a temporary syslog handler so we have somewhere to log problems
@@ -58,6 +62,17 @@ def Init():
     syslog_logger.exception("Died during config initialization")
     raise
 
+  CONFIG_INIT_RAN = True
+
+
+def Init():
+  """Run all required startup routines and initialization hooks."""
+  global INIT_RAN
+  if INIT_RAN:
+    return
+
+  ConfigInit()
+
   if hasattr(registry_init, "stats"):
     logging.debug("Using local stats collector.")
     stats.STATS = registry_init.stats.StatsCollector()
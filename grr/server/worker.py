@@ -93,6 +93,10 @@ class GRRWorker(object):
     self.token = token
     self.last_active = 0
 
+    # Tells us which queue shards got notifications written by this process.
+    self.notification_subscription = queue_manager_lib.WAKEUPS.Subscribe(
+        queues)
+
     # Well known flows are just instantiated.
     self.well_known_flows = flow.WellKnownFlow.GetAllWellKnownFlows(token=token)
 
@@ -115,7 +119,9 @@ class GRRWorker(object):
           else:
             interval = self.SHORT_POLLING_INTERVAL
 
-          time.sleep(interval)
+          # Notifications written by this process end the wait early, the
+          # interval is the fallback for the ones written by other processes.
+          self.notification_subscription.Wait(interval)
         else:
           self.last_active = time.time()
 
@@ -141,9 +147,13 @@ class GRRWorker(object):
       # notifications to avoid possible race conditions.
       queue_manager.FreezeTimestamp()
 
+      # Besides the next shard in turn, we read the shards we know received
+      # notifications.
+      extra_queue_shards = self.notification_subscription.PopQueueShards(queue)
+
       fetch_messages_start = time.time()
       notifications_by_priority = queue_manager.GetNotificationsByPriority(
-          queue)
+          queue, extra_queue_shards=extra_queue_shards)
       stats.STATS.RecordEvent("worker_time_to_retrieve_notifications",
                               time.time() - fetch_messages_start)
 
@@ -44,6 +44,7 @@ from grr.server import client_index
 from grr.server import data_store
 from grr.server import email_alerts
 from grr.server import flow
+from grr.server import keyword_index
 from grr.server.aff4_objects import aff4_grr
 from grr.server.aff4_objects import filestore
 from grr.server.aff4_objects import users
@@ -132,6 +133,7 @@ class GRRBaseTest(unittest.TestCase):
     data_store.DB.ClearTestDB()
 
     aff4.FACTORY.Flush()
+    keyword_index.AFF4KeywordIndex.FlushPostingListCache()
 
     # Create a Foreman and Filestores, they are used in many tests.
     aff4_grr.GRRAFF4Init().Run()
@@ -3,14 +3,19 @@
 
 
 
+import asynchat
+import asyncore
 import BaseHTTPServer
 import cgi
+import collections
 import cStringIO
 import logging
+import os
 import pdb
 import socket
 import SocketServer
 import threading
+import time
 
 
 import ipaddr
@@ -33,6 +38,7 @@ from grr.server import front_end
 from grr.server import master
 from grr.server import server_logging
 from grr.server import server_startup
+from grr.server import threadpool
 
 
 class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
@@ -48,13 +54,13 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
   active_counter_lock = threading.Lock()
   active_counter = 0
 
-  def Send(self,
-           data,
-           status=200,
-           ctype="application/octet-stream",
-           additional_headers=None,
-           last_modified=0):
-    """Sends a response to the client."""
+  def SendHeaders(self,
+                  length,
+                  status=200,
+                  ctype="application/octet-stream",
+                  additional_headers=None,
+                  last_modified=0):
+    """Sends the headers of a response with a body of the given length."""
     if additional_headers:
       header_strings = [
           "%s: %s\r\n" % (name, val)
@@ -62,16 +68,20 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       ]
     else:
       header_strings = []
-    data = ("HTTP/1.0 %s\r\n"
-            "Server: GRR Server\r\n"
-            "Content-type: %s\r\n"
-            "Content-Length: %d\r\n"
-            "Last-Modified: %s\r\n"
-            "%s"
-            "\r\n"
-            "%s") % (self.statustext[status], ctype, len(data),
-                     self.date_time_string(last_modified),
-                     "".join(header_strings), data)
+    self.wfile.write(("%s %s\r\n"
+                      "Server: GRR Server\r\n"
+                      "Content-type: %s\r\n"
+                      "Content-Length: %d\r\n"
+                      "Last-Modified: %s\r\n"
+                      "%s"
+                      "\r\n") % (self.protocol_version,
+                                  self.statustext[status], ctype, length,
+                                  self.date_time_string(last_modified),
+                                  "".join(header_strings)))
+
+  def Send(self, data, **kwargs):
+    """Sends a response to the client."""
+    self.SendHeaders(len(data), **kwargs)
     self.wfile.write(data)
 
   rekall_profile_path = "/rekall_profiles"
@@ -93,6 +103,9 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       stats.STATS.IncrementCounter(
           "frontend_http_requests", fields=["static", "http"])
       self.ServeStatic(self.path[len(self.static_content_path):])
+    else:
+      self.close_connection = 1
+      self.Send("Not found.", status=404, ctype="text/plain")
 
   def ServeRekallProfile(self, path):
     """This servers rekall profiles from the frontend server.
@@ -138,18 +151,28 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
   AFF4_READ_BLOCK_SIZE = 10 * 1024 * 1024
 
   def ServeStatic(self, path):
+    """Serves a file below the static content path as a single response."""
+    # Static files can be large, the connection is not reused afterwards.
+    self.close_connection = 1
     aff4_path = aff4.FACTORY.GetStaticContentPath().Add(path)
     try:
       logging.info("Serving %s", aff4_path)
       fd = aff4.FACTORY.Open(aff4_path, token=aff4.FACTORY.root_token)
-      while True:
-        data = fd.Read(self.AFF4_READ_BLOCK_SIZE)
-        if not data:
-          break
-
-        self.Send(data)
+      size = fd.size
     except (IOError, AttributeError):
       self.Send("", status=404)
+      return
+
+    self.SendHeaders(size)
+    while size > 0:
+      data = fd.Read(min(size, self.AFF4_READ_BLOCK_SIZE))
+      if not data:
+        # The client notices the short response as the connection is closed.
+        logging.error("%s is shorter than its size %d.", aff4_path, fd.size)
+        break
+
+      self.wfile.write(data)
+      size -= len(data)
 
   def ServerPem(self):
     self.Send(self.server.server_cert.AsPEM())
@@ -311,6 +334,23 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             "frontend_active_count", self.active_counter, fields=["http"])
 
 
+def _CreateFrontEnd():
+  return front_end.FrontEndServer(
+      certificate=config.CONFIG["Frontend.certificate"],
+      private_key=config.CONFIG["PrivateKeys.server_key"],
+      max_queue_size=config.CONFIG["Frontend.max_queue_size"],
+      message_expiry_time=config.CONFIG["Frontend.message_expiry_time"],
+      max_retransmission_time=config.CONFIG["Frontend.max_retransmission_time"])
+
+
+def _GetAddressFamily(server_address):
+  (address, _) = server_address
+  version = ipaddr.IPAddress(address).version
+  if version == 4:
+    return socket.AF_INET
+  return socket.AF_INET6
+
+
 class GRRHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
   """The GRR HTTP frontend server."""
 
@@ -326,27 +366,517 @@ class GRRHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
     if frontend:
       self.frontend = frontend
     else:
-      self.frontend = front_end.FrontEndServer(
-          certificate=config.CONFIG["Frontend.certificate"],
-          private_key=config.CONFIG["PrivateKeys.server_key"],
-          max_queue_size=config.CONFIG["Frontend.max_queue_size"],
-          message_expiry_time=config.CONFIG["Frontend.message_expiry_time"],
-          max_retransmission_time=config.CONFIG[
-              "Frontend.max_retransmission_time"])
+      self.frontend = _CreateFrontEnd()
     self.server_cert = config.CONFIG["Frontend.certificate"]
 
-    (address, _) = server_address
-    version = ipaddr.IPAddress(address).version
-    if version == 4:
-      self.address_family = socket.AF_INET
-    elif version == 6:
-      self.address_family = socket.AF_INET6
+    self.address_family = _GetAddressFamily(server_address)
 
     logging.info("Will attempt to listen on %s", server_address)
     BaseHTTPServer.HTTPServer.__init__(self, server_address, handler, *args,
                                        **kwargs)
 
 
+class GRRBufferedHTTPServerHandler(GRRHTTPServerHandler):
+  """Handles a request that was read by the event loop server.
+
+  A file like object holding the request is passed in instead of a socket and
+  the response is collected in self.response. Connections are kept alive
+  unless the client asks to close them.
+  """
+
+  protocol_version = "HTTP/1.1"
+
+  def setup(self):
+    self.rfile = self.request
+    self.wfile = cStringIO.StringIO()
+    self.response = ""
+
+  def handle(self):
+    # There is exactly one request in the buffer.
+    self.close_connection = 1
+    self.handle_one_request()
+
+  def finish(self):
+    self.response = self.wfile.getvalue()
+
+  def SendHeaders(self, length, additional_headers=None, **kwargs):
+    if self.close_connection:
+      additional_headers = dict(additional_headers or {})
+      additional_headers["Connection"] = "close"
+    # BaseHTTPRequestHandler is an old style class so super() can't be used.
+    GRRHTTPServerHandler.SendHeaders(
+        self, length, additional_headers=additional_headers, **kwargs)
+
+
+class _RequestStream(object):
+  """A file like object passing a request from the event loop to a worker.
+
+  The event loop feeds the request while it is read from the connection and
+  reads on the worker thread block until enough data is available. The
+  connection stops reading while MAX_BUFFERED bytes are waiting for the
+  worker.
+  """
+
+  MAX_BUFFERED = 1024 * 1024
+
+  def __init__(self, data, wake_loop):
+    self.chunks = collections.deque([data])
+    # Position of the next unread byte in the first chunk.
+    self.offset = 0
+    self.size = len(data)
+    self.closed = False
+    self.wake_loop = wake_loop
+    self.cv = threading.Condition()
+
+  def Feed(self, data):
+    """Adds data read from the connection, called in the event loop."""
+    with self.cv:
+      if not self.closed:
+        self.chunks.append(data)
+        self.size += len(data)
+        self.cv.notify()
+
+  def Close(self):
+    """Marks the end of the request, data fed afterwards is dropped."""
+    with self.cv:
+      self.closed = True
+      self.cv.notify()
+
+  def Full(self):
+    with self.cv:
+      return self.size >= self.MAX_BUFFERED
+
+  def _Find(self, char):
+    """Returns the length of the buffered data up to and including char."""
+    length = 0
+    offset = self.offset
+    for chunk in self.chunks:
+      position = chunk.find(char, offset)
+      if position >= 0:
+        return length + position - offset + 1
+      length += len(chunk) - offset
+      offset = 0
+
+  def _Consume(self, size):
+    was_full = self.size >= self.MAX_BUFFERED
+    result = []
+    while size > 0 and self.chunks:
+      chunk = self.chunks[0]
+      end = min(len(chunk), self.offset + size)
+      result.append(chunk[self.offset:end])
+      size -= end - self.offset
+      self.size -= end - self.offset
+      if end == len(chunk):
+        self.chunks.popleft()
+        self.offset = 0
+      else:
+        self.offset = end
+
+    if was_full and self.size < self.MAX_BUFFERED:
+      self.wake_loop()
+    return "".join(result)
+
+  def read(self, size=-1):
+    with self.cv:
+      while not self.closed and (size < 0 or self.size < size):
+        self.cv.wait()
+      if size < 0:
+        size = self.size
+      return self._Consume(size)
+
+  def readline(self, size=-1):
+    with self.cv:
+      while True:
+        length = self._Find("\n")
+        if length is not None or self.closed:
+          break
+        if size >= 0 and self.size >= size:
+          break
+        self.cv.wait()
+
+      if length is None:
+        length = self.size
+      if size >= 0:
+        length = min(length, size)
+      return self._Consume(length)
+
+
+class _HTTPConnection(asynchat.async_chat):
+  """Reads HTTP requests from a client connection in the event loop.
+
+  Once a request (including its body) was read completely, it is handed to
+  the server for processing and no more data is read from the connection
+  until the response was sent. Bodies larger than the server's
+  max_request_size are rejected with status 413.
+
+  Uploads can be arbitrarily large so they are handed to the server as soon as
+  the headers were read and the body is streamed to the worker through a
+  _RequestStream.
+
+  Pipelined requests are not supported, such connections are closed once the
+  first response was sent. Connections which neither send nor receive data for
+  the server's idle_timeout while no request is processed are closed.
+  """
+
+  MAX_HEADER_SIZE = 64 * 1024
+
+  # The asynchat default of 4k makes large uploads very slow.
+  ac_in_buffer_size = 64 * 1024
+
+  def __init__(self, sock, client_address, server):
+    asynchat.async_chat.__init__(self, sock=sock, map=server.socket_map)
+    self.client_address = client_address
+    self.server = server
+    self.busy = False
+    self.pipelined = False
+    self.last_activity = time.time()
+    self._StartRequest()
+
+  def _StartRequest(self):
+    self.request_data = []
+    self.token_data = []
+    self.body_size = 0
+    self.stream = None
+    self.state = "headers"
+    self.set_terminator("\r\n\r\n")
+
+  def readable(self):
+    if self.state == "done":
+      return False
+    if self.stream is not None and self.stream.Full():
+      return False
+    return asynchat.async_chat.readable(self)
+
+  def handle_read(self):
+    self.last_activity = time.time()
+    asynchat.async_chat.handle_read(self)
+
+  def handle_write(self):
+    self.last_activity = time.time()
+    asynchat.async_chat.handle_write(self)
+
+  def IsIdle(self, now):
+    return not self.busy and now - self.last_activity > self.server.idle_timeout
+
+  def collect_incoming_data(self, data):
+    if self.state == "done":
+      self.pipelined = True
+      return
+
+    if self.stream is not None and self.state in ["body", "chunk_data"]:
+      self.stream.Feed(data)
+      return
+
+    self.token_data.append(data)
+    if (self.state in ["headers", "chunk_size", "trailer"] and
+        sum(len(x) for x in self.token_data) > self.MAX_HEADER_SIZE):
+      logging.error("Request headers from %s too large.",
+                    self.client_address[0])
+      self.close()
+
+  def found_terminator(self):
+    terminator = self.get_terminator()
+    token = "".join(self.token_data)
+    self.token_data = []
+    data = token
+    if isinstance(terminator, str):
+      data += terminator
+    if self.stream is not None:
+      self.stream.Feed(data)
+    else:
+      self.request_data.append(data)
+
+    if self.state == "headers":
+      self._ParseHeaders(token)
+    elif self.state == "body":
+      self._RequestComplete()
+    elif self.state == "chunk_size":
+      # We do not support chunked extensions, just ignore them.
+      chunk_size = int(token.split(";")[0], 16)
+      self.body_size += chunk_size
+      if self.stream is None and self.body_size > self.server.max_request_size:
+        self._RequestTooLarge()
+      elif chunk_size:
+        # The chunk is followed by \r\n.
+        self.state = "chunk_data"
+        self.set_terminator(chunk_size + 2)
+      else:
+        self.state = "trailer"
+        self.set_terminator("\r\n")
+    elif self.state == "chunk_data":
+      self.state = "chunk_size"
+      self.set_terminator("\r\n")
+    elif self.state == "trailer":
+      if not token:
+        self._RequestComplete()
+
+  def _ParseHeaders(self, data):
+    lines = data.split("\r\n")
+    request_line = lines[0].split()
+    content_length = 0
+    chunked = False
+    for line in lines[1:]:
+      name, _, value = line.partition(":")
+      name = name.strip().lower()
+      if name == "content-length":
+        content_length = int(value)
+      elif name == "transfer-encoding":
+        chunked = value.strip().lower() == "chunked"
+
+    if not chunked and not content_length:
+      self._RequestComplete()
+      return
+
+    if len(request_line) > 1 and request_line[1].startswith("/upload"):
+      self._StreamRequest()
+    elif content_length > self.server.max_request_size:
+      self._RequestTooLarge()
+      return
+
+    if chunked:
+      self.state = "chunk_size"
+      self.set_terminator("\r\n")
+    else:
+      self.state = "body"
+      self.set_terminator(content_length)
+
+  def _StreamRequest(self):
+    self.stream = _RequestStream("".join(self.request_data),
+                                 self.server.waker.Wake)
+    self.request_data = []
+    self.busy = True
+    self.server.Dispatch(self, self.stream)
+
+  def _RequestComplete(self):
+    self.state = "done"
+    self.set_terminator(None)
+    if self.stream is None:
+      self.busy = True
+      self.server.Dispatch(self,
+                           cStringIO.StringIO("".join(self.request_data)))
+      return
+
+    self.stream.Close()
+    if not self.busy:
+      # The response was sent before the whole body was read.
+      self.close_when_done()
+
+  def _RequestTooLarge(self):
+    logging.error("Request from %s is larger than %d bytes.",
+                  self.client_address[0], self.server.max_request_size)
+    self.state = "done"
+    self.set_terminator(None)
+    self.push("HTTP/1.1 413 Request Entity Too Large\r\n"
+              "Content-Length: 0\r\n"
+              "Connection: close\r\n\r\n")
+    self.close_when_done()
+
+  def RequestDone(self, response, close_connection):
+    """Sends the response, called in the event loop."""
+    if not self.connected:
+      return
+
+    self.push(response)
+    self.busy = False
+    if self.state != "done":
+      # The handler did not read the whole streamed body. The rest of it is
+      # read and dropped before the connection is closed so the client gets
+      # to see the response.
+      self.stream.Close()
+    elif close_connection or self.pipelined:
+      self.close_when_done()
+    else:
+      self._StartRequest()
+
+  def close(self):
+    if self.stream is not None:
+      # Unblocks a worker waiting for more data.
+      self.stream.Close()
+    asynchat.async_chat.close(self)
+
+  def handle_error(self):
+    logging.exception("Error on connection from %s.", self.client_address[0])
+    self.close()
+
+
+class _Waker(asyncore.file_dispatcher):
+  """Runs callbacks from other threads in the event loop."""
+
+  def __init__(self, socket_map):
+    self.read_fd, self.write_fd = os.pipe()
+    asyncore.file_dispatcher.__init__(self, self.read_fd, map=socket_map)
+    os.close(self.read_fd)
+    self.callbacks = collections.deque()
+
+  def writable(self):
+    return False
+
+  def handle_read(self):
+    self.recv(8192)
+    while self.callbacks:
+      callback, args = self.callbacks.popleft()
+      try:
+        callback(*args)
+      except Exception:  # pylint: disable=broad-except
+        logging.exception("Error in event loop callback.")
+
+  def CallFromLoop(self, callback, *args):
+    self.callbacks.append((callback, args))
+    self.Wake()
+
+  def Wake(self):
+    """Makes the event loop check all connections again."""
+    os.write(self.write_fd, "x")
+
+  def close(self):
+    asyncore.file_dispatcher.close(self)
+    os.close(self.write_fd)
+
+
+class GRRAsyncHTTPServer(asyncore.dispatcher):
+  """An event loop based GRR HTTP frontend server.
+
+  All connections are handled by a single event loop which reads complete
+  requests. Requests are then processed by GRRBufferedHTTPServerHandler on a
+  bounded worker pool, so the number of threads does not grow with the number
+  of connected clients.
+  """
+
+  request_queue_size = 500
+
+  # Idle connections are looked for at most once in this many seconds.
+  idle_check_interval = 1
+
+  def __init__(self,
+               server_address,
+               frontend=None,
+               worker_threads=None,
+               max_request_size=None,
+               idle_timeout=None):
+    self.socket_map = {}
+    asyncore.dispatcher.__init__(self, map=self.socket_map)
+
+    stats.STATS.SetGaugeValue("frontend_max_active_count",
+                              self.request_queue_size)
+
+    if frontend:
+      self.frontend = frontend
+    else:
+      self.frontend = _CreateFrontEnd()
+    self.server_cert = config.CONFIG["Frontend.certificate"]
+
+    logging.info("Will attempt to listen on %s", server_address)
+    self.create_socket(_GetAddressFamily(server_address), socket.SOCK_STREAM)
+    try:
+      self.set_reuse_addr()
+      self.bind(server_address)
+      self.listen(self.request_queue_size)
+    except socket.error:
+      self.close()
+      raise
+
+    if worker_threads is None:
+      worker_threads = config.CONFIG["Frontend.worker_threads"]
+    if max_request_size is None:
+      max_request_size = config.CONFIG["Frontend.max_request_size"]
+    self.max_request_size = max_request_size
+    if idle_timeout is None:
+      idle_timeout = config.CONFIG["Frontend.idle_timeout"]
+    self.idle_timeout = idle_timeout
+    self.last_idle_check = time.time()
+    self.thread_pool = threadpool.ThreadPool.Factory(
+        "grr_frontend_workers_%d" % self.socket.getsockname()[1],
+        worker_threads,
+        max_threads=worker_threads)
+    self.thread_pool.Start()
+    # Requests waiting for a free worker.
+    self.pending = collections.deque()
+
+    self.waker = _Waker(self.socket_map)
+    self.shutdown_requested = False
+    self.is_shut_down = threading.Event()
+
+  def handle_accept(self):
+    pair = self.accept()
+    if pair is not None:
+      sock, client_address = pair
+      _HTTPConnection(sock, client_address, self)
+
+  def handle_error(self):
+    # The default implementation would close the listening socket.
+    logging.exception("Error accepting connection.")
+
+  def Dispatch(self, connection, request):
+    self.pending.append((connection, request))
+    self._DispatchPending()
+
+  def _DispatchPending(self):
+    while self.pending:
+      try:
+        self.thread_pool.AddTask(
+            self._ProcessRequest,
+            self.pending[0],
+            name="FrontendRequest",
+            blocking=False,
+            inline=False)
+      except threadpool.Full:
+        return
+      self.pending.popleft()
+
+  def _ProcessRequest(self, connection, request):
+    """Processes a single request on a worker thread."""
+    try:
+      handler = GRRBufferedHTTPServerHandler(
+          request, connection.client_address, self)
+      response, close_connection = handler.response, handler.close_connection
+    except Exception:  # pylint: disable=broad-except
+      logging.exception("Error processing request from %s.",
+                        connection.client_address[0])
+      response, close_connection = "", True
+
+    self.waker.CallFromLoop(self._RequestDone, connection, response,
+                            close_connection)
+
+  def _RequestDone(self, connection, response, close_connection):
+    connection.RequestDone(response, close_connection)
+    self._DispatchPending()
+
+  def _CloseIdleConnections(self):
+    now = time.time()
+    if now - self.last_idle_check < self.idle_check_interval:
+      return
+    self.last_idle_check = now
+
+    for dispatcher in self.socket_map.values():
+      if isinstance(dispatcher, _HTTPConnection) and dispatcher.IsIdle(now):
+        logging.debug("Closing idle connection from %s.",
+                      dispatcher.client_address[0])
+        dispatcher.close()
+
+  def serve_forever(self, poll_interval=0.5):
+    self.is_shut_down.clear()
+    try:
+      while not self.shutdown_requested:
+        # select() fails for file descriptors above FD_SETSIZE (1024).
+        asyncore.loop(
+            timeout=poll_interval,
+            map=self.socket_map,
+            count=1,
+            use_poll=True)
+        self._CloseIdleConnections()
+    finally:
+      # Workers post their results to the waker so they have to be stopped
+      # before its pipe is closed.
+      self.thread_pool.Stop()
+      asyncore.close_all(map=self.socket_map)
+      self.is_shut_down.set()
+
+  def shutdown(self):
+    self.shutdown_requested = True
+    self.waker.Wake()
+    self.is_shut_down.wait()
+
+
 def CreateServer(frontend=None):
   """Start frontend http server."""
   max_port = config.CONFIG.Get("Frontend.port_max",
@@ -356,8 +886,11 @@ def CreateServer(frontend=None):
 
     server_address = (config.CONFIG["Frontend.bind_address"], port)
     try:
-      httpd = GRRHTTPServer(
-          server_address, GRRHTTPServerHandler, frontend=frontend)
+      if config.CONFIG["Frontend.server_mode"] == "event_loop":
+        httpd = GRRAsyncHTTPServer(server_address, frontend=frontend)
+      else:
+        httpd = GRRHTTPServer(
+            server_address, GRRHTTPServerHandler, frontend=frontend)
       break
     except socket.error as e:
       if e.errno == socket.errno.EADDRINUSE and port < max_port:
@@ -375,12 +908,22 @@ def main(argv):
   del argv  # Unused.
   config.CONFIG.AddContext("HTTPServer Context")
 
+  server_startup.ConfigInit()
+  # The decryption processes are forked, this has to happen before Init()
+  # starts any threads.
+  front_end.StartCipherDecryptionPool()
   server_startup.Init()
 
   httpd = CreateServer()
 
   server_startup.DropPrivileges()
 
+  # Clients are served while the keys are loaded.
+  prewarm_thread = threading.Thread(
+      target=httpd.frontend.PrewarmPublicKeyCache, name="PublicKeyPrewarm")
+  prewarm_thread.daemon = True
+  prewarm_thread.start()
+
   try:
     httpd.serve_forever()
   except KeyboardInterrupt:
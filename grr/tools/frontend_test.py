@@ -7,6 +7,7 @@ import logging
 import os
 import socket
 import threading
+import time
 
 
 import ipaddr
@@ -33,6 +34,7 @@ from grr.server import worker_mocks
 from grr.server.aff4_objects import filestore
 from grr.server.flows.general import file_finder
 from grr.test_lib import action_mocks
+from grr.test_lib import benchmark_test_lib
 from grr.test_lib import flow_test_lib
 from grr.test_lib import rekall_test_lib
 from grr.test_lib import test_lib
@@ -58,8 +60,7 @@ class GRRHTTPServerTest(test_lib.GRRBaseTest):
     # Bring up a local server for testing.
     port = portpicker.PickUnusedPort()
     ip = utils.ResolveHostnameToIP("localhost", port)
-    cls.httpd = frontend.GRRHTTPServer((ip, port),
-                                       frontend.GRRHTTPServerHandler)
+    cls.httpd = cls._CreateServer((ip, port))
 
     if ipaddr.IPAddress(ip).version == 6:
       cls.address_family = socket.AF_INET6
@@ -72,9 +73,15 @@ class GRRHTTPServerTest(test_lib.GRRBaseTest):
     cls.httpd_thread.daemon = True
     cls.httpd_thread.start()
 
+  @classmethod
+  def _CreateServer(cls, server_address):
+    return frontend.GRRHTTPServer(server_address,
+                                  frontend.GRRHTTPServerHandler)
+
   @classmethod
   def tearDownClass(cls):
     cls.httpd.shutdown()
+    front_end.StopClientHeartbeatBuffer()
     cls.config_overrider.Stop()
 
   def setUp(self):
@@ -86,6 +93,27 @@ class GRRHTTPServerTest(test_lib.GRRBaseTest):
     self.assertEqual(req.status_code, 200)
     self.assertTrue("BEGIN CERTIFICATE" in req.content)
 
+  def testUnknownPath(self):
+    req = requests.get(self.base_url + "unknown")
+    self.assertEqual(req.status_code, 404)
+
+  def testStaticContent(self):
+    content = "".join("line %d\n" % i for i in range(1000))
+    with aff4.FACTORY.Create(
+        aff4.FACTORY.GetStaticContentPath().Add("test.txt"),
+        aff4.AFF4MemoryStream,
+        token=self.token) as fd:
+      fd.Write(content)
+
+    with utils.Stubber(frontend.GRRHTTPServerHandler, "AFF4_READ_BLOCK_SIZE",
+                       1000):
+      req = requests.get(self.base_url + "static/test.txt")
+    self.assertEqual(req.status_code, 200)
+    self.assertEqual(req.content, content)
+
+    req = requests.get(self.base_url + "static/missing.txt")
+    self.assertEqual(req.status_code, 404)
+
   def _UploadFile(self, args):
     with test_lib.ConfigOverrider({"Client.server_urls": [self.base_url]}):
       client = comms.GRRHTTPClient(
@@ -395,6 +423,363 @@ class GRRHTTPServerTest(test_lib.GRRBaseTest):
     self.assertEqual(profile.data[:2], "\x1f\x8b")
 
 
+class GRRAsyncHTTPServerTest(GRRHTTPServerTest):
+  """Runs the http server tests against the event loop server."""
+
+  @classmethod
+  def _CreateServer(cls, server_address):
+    return frontend.GRRAsyncHTTPServer(server_address, worker_threads=5)
+
+  def testKeepAlive(self):
+    session = requests.Session()
+    for _ in range(3):
+      req = session.get(self.base_url + "server.pem")
+      self.assertEqual(req.status_code, 200)
+      self.assertTrue("BEGIN CERTIFICATE" in req.content)
+    # All requests were sent over the same connection.
+    self.assertEqual(len(session.get_adapter(self.base_url).poolmanager.pools),
+                     1)
+
+  def testConnectionClose(self):
+    req = requests.get(
+        self.base_url + "server.pem", headers={"Connection": "close"})
+    self.assertEqual(req.status_code, 200)
+    self.assertEqual(req.headers["Connection"], "close")
+
+  def testStaticContentClosesConnection(self):
+    with aff4.FACTORY.Create(
+        aff4.FACTORY.GetStaticContentPath().Add("test.txt"),
+        aff4.AFF4MemoryStream,
+        token=self.token) as fd:
+      fd.Write("content")
+
+    session = requests.Session()
+    for path in ["static/test.txt", "unknown"]:
+      req = session.get(self.base_url + path)
+      self.assertEqual(req.headers["Connection"], "close")
+
+  def testIdleConnectionsAreClosed(self):
+    sock = socket.create_connection(self.httpd.socket.getsockname()[:2])
+    try:
+      sock.settimeout(10)
+      with utils.MultiStubber((self.httpd, "idle_timeout", 0.1),
+                              (self.httpd, "idle_check_interval", 0)):
+        # A partial request does not keep the connection open either.
+        sock.sendall("GET /server.pem HTTP/1.1\r\n")
+        self.assertEqual(sock.recv(4096), "")
+    finally:
+      sock.close()
+
+  def testChunkedUpload(self):
+
+    def Chunks():
+      yield "a" * 10
+      yield "b" * 20
+
+    # An unknown upload results in an error response before the body was
+    # read.
+    req = requests.post(self.base_url + "upload", data=Chunks())
+    self.assertEqual(req.status_code, 500)
+
+    req = requests.get(self.base_url + "server.pem")
+    self.assertEqual(req.status_code, 200)
+
+  def _SendRawRequest(self, data):
+    sock = socket.create_connection(self.httpd.socket.getsockname()[:2])
+    try:
+      sock.sendall(data)
+      response = []
+      while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+          return "".join(response)
+        response.append(chunk)
+    finally:
+      sock.close()
+
+  def testRequestTooLarge(self):
+    response = self._SendRawRequest("POST /control HTTP/1.1\r\n"
+                                    "Content-Length: %d\r\n\r\n" %
+                                    (self.httpd.max_request_size + 1))
+    self.assertTrue(response.startswith("HTTP/1.1 413 "))
+
+  def testChunkedRequestTooLarge(self):
+    with utils.Stubber(self.httpd, "max_request_size", 100):
+      response = self._SendRawRequest("POST /control HTTP/1.1\r\n"
+                                      "Transfer-Encoding: chunked\r\n\r\n"
+                                      "50\r\n%s\r\n"
+                                      "50\r\n" % ("a" * 0x50))
+    self.assertTrue(response.startswith("HTTP/1.1 413 "))
+
+  def testLargeUploadIsStreamed(self):
+    received = []
+
+    def HandleUpload(encoding_header, encoded_upload_token, data_generator):
+      del encoding_header, encoded_upload_token  # Unused.
+      for data in data_generator:
+        received.append(len(data))
+      return str(sum(received))
+
+    def Chunks():
+      for _ in range(100):
+        yield "a" * 10000
+
+    with utils.MultiStubber((self.httpd, "max_request_size", 1000),
+                            (self.httpd.frontend, "HandleUpload",
+                             HandleUpload),
+                            (frontend._RequestStream, "MAX_BUFFERED", 20000)):
+      req = requests.post(self.base_url + "upload", data=Chunks())
+
+    self.assertEqual(req.status_code, 200)
+    self.assertEqual(req.content, str(100 * 10000))
+
+    req = requests.get(self.base_url + "server.pem")
+    self.assertEqual(req.status_code, 200)
+
+
+class RequestStreamTest(test_lib.GRRBaseTest):
+  """Tests the stream passing requests to the event loop server's workers."""
+
+  def testReads(self):
+    wakeups = []
+    stream = frontend._RequestStream("GET / HTTP/1.1\r\nHost", wakeups.append)
+    stream.Feed(": x\r\n\r\nab")
+    stream.Feed("cd")
+    stream.Close()
+    stream.Feed("dropped")
+
+    self.assertEqual(stream.readline(), "GET / HTTP/1.1\r\n")
+    self.assertEqual(stream.readline(4), "Host")
+    self.assertEqual(stream.readline(), ": x\r\n")
+    self.assertEqual(stream.readline(), "\r\n")
+    self.assertEqual(stream.read(3), "abc")
+    self.assertEqual(stream.readline(), "d")
+    self.assertEqual(stream.read(), "")
+    self.assertEqual(wakeups, [])
+
+  def testWakesLoopWhenDrained(self):
+    wakeups = []
+    with utils.Stubber(frontend._RequestStream, "MAX_BUFFERED", 10):
+      stream = frontend._RequestStream("", lambda: wakeups.append(1))
+      stream.Feed("a" * 15)
+      self.assertTrue(stream.Full())
+      stream.read(5)
+      self.assertTrue(stream.Full())
+      self.assertEqual(wakeups, [])
+      stream.read(1)
+      self.assertFalse(stream.Full())
+      self.assertEqual(wakeups, [1])
+
+  def testReadBlocksUntilDataArrives(self):
+    stream = frontend._RequestStream("", lambda: None)
+    result = []
+    reader = threading.Thread(target=lambda: result.append(stream.read(4)))
+    reader.start()
+    stream.Feed("ab")
+    stream.Feed("cd")
+    reader.join()
+    self.assertEqual(result, ["abcd"])
+
+
+class FrontendServerBenchmark(benchmark_test_lib.MicroBenchmarks):
+  """Compares the frontend server modes with many concurrent pollers.
+
+  Every request is delayed to simulate a slow data store, the event loop server
+  processes all requests on a fixed number of worker threads.
+  """
+
+  units = "s"
+
+  # More than 1024 connections do not fit into select().
+  POLLER_COUNTS = [50, 200, 1500]
+  REQUESTS_PER_POLLER = 10
+  REQUEST_DELAY = 0.01
+  WORKER_THREADS = 20
+
+  def _Poll(self, base_url, latencies, all_connected):
+    session = requests.Session()
+    for i in range(self.REQUESTS_PER_POLLER):
+      start = time.time()
+      req = session.get(base_url + "server.pem")
+      latencies.append(time.time() - start)
+      self.assertEqual(req.status_code, 200)
+      if i == 0:
+        # Keeps the connection open until all pollers are connected.
+        all_connected.wait(60)
+
+  def _RunPollers(self, name, server_factory, poller_count):
+    threads_before = threading.active_count()
+    httpd = server_factory()
+    ip, port = httpd.socket.getsockname()[:2]
+    if ipaddr.IPAddress(ip).version == 6:
+      base_url = "http://[%s]:%d/" % (ip, port)
+    else:
+      base_url = "http://%s:%d/" % (ip, port)
+
+    server_thread = threading.Thread(target=httpd.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    latencies = []
+    all_connected = threading.Event()
+    pollers = [
+        threading.Thread(
+            target=self._Poll, args=(base_url, latencies, all_connected))
+        for _ in range(poller_count)
+    ]
+    # Threads used by the server, not counting the serve_forever thread.
+    server_threads = 0
+    start = time.time()
+    for poller in pollers:
+      poller.start()
+    while True:
+      if len(latencies) >= poller_count:
+        all_connected.set()
+      active_pollers = sum(1 for poller in pollers if poller.is_alive())
+      if not active_pollers:
+        break
+      server_threads = max(
+          server_threads,
+          threading.active_count() - threads_before - active_pollers - 1)
+      time.sleep(0.01)
+    duration = time.time() - start
+    httpd.shutdown()
+
+    requests_count = poller_count * self.REQUESTS_PER_POLLER
+    self.assertEqual(len(latencies), requests_count)
+    latencies.sort()
+    self.AddResult("%s, %d pollers" % (name, poller_count), duration,
+                   requests_count, "%.4f" % latencies[len(latencies) // 2],
+                   "%.4f" % latencies[len(latencies) * 99 // 100],
+                   server_threads)
+
+  def setUp(self):
+    super(FrontendServerBenchmark, self).setUp(
+        ["Median (s)", "99th pct (s)", "Server threads"],
+        ["<20", "<20", "<20"])
+
+    original_server_pem = frontend.GRRHTTPServerHandler.ServerPem.im_func
+    delay = self.REQUEST_DELAY
+
+    def SlowServerPem(handler):
+      time.sleep(delay)
+      original_server_pem(handler)
+
+    self.server_pem_stubber = utils.Stubber(frontend.GRRHTTPServerHandler,
+                                            "ServerPem", SlowServerPem)
+    self.server_pem_stubber.Start()
+
+  def tearDown(self):
+    self.server_pem_stubber.Stop()
+    super(FrontendServerBenchmark, self).tearDown()
+
+  @test_lib.SetLabel("benchmark")
+  def testPollers(self):
+    ip = utils.ResolveHostnameToIP("localhost", 0)
+
+    def ThreadingServer():
+      return frontend.GRRHTTPServer(
+          (ip, portpicker.PickUnusedPort()),
+          frontend.GRRHTTPServerHandler,
+          frontend=object())
+
+    def EventLoopServer():
+      return frontend.GRRAsyncHTTPServer(
+          (ip, portpicker.PickUnusedPort()),
+          frontend=object(),
+          worker_threads=self.WORKER_THREADS)
+
+    for poller_count in self.POLLER_COUNTS:
+      self._RunPollers("threading", ThreadingServer, poller_count)
+      self._RunPollers("event_loop", EventLoopServer, poller_count)
+
+
+class _DrainingFrontend(object):
+  """A frontend which reads and drops all uploaded data."""
+
+  def HandleUpload(self, encoding_header, encoded_upload_token,
+                   data_generator):
+    del encoding_header, encoded_upload_token  # Unused.
+    return str(sum(len(data) for data in data_generator))
+
+
+class FrontendUploadBenchmark(benchmark_test_lib.MicroBenchmarks):
+  """Compares the frontend server modes with large concurrent uploads."""
+
+  units = "s"
+
+  UPLOAD_SIZES = [10 * 1024 * 1024, 100 * 1024 * 1024]
+  CONCURRENT_UPLOADS = 4
+  CHUNK_SIZE = 64 * 1024
+  WORKER_THREADS = 20
+
+  def setUp(self):
+    super(FrontendUploadBenchmark, self).setUp(["MB/s"], ["<20"])
+
+  def _Upload(self, base_url, upload_size, results):
+    chunk = "a" * self.CHUNK_SIZE
+
+    def Chunks():
+      for _ in range(upload_size // self.CHUNK_SIZE):
+        yield chunk
+
+    req = requests.post(base_url + "upload", data=Chunks())
+    results.append((req.status_code, req.content))
+
+  def _RunUploads(self, name, server_factory, upload_size):
+    httpd = server_factory()
+    ip, port = httpd.socket.getsockname()[:2]
+    if ipaddr.IPAddress(ip).version == 6:
+      base_url = "http://[%s]:%d/" % (ip, port)
+    else:
+      base_url = "http://%s:%d/" % (ip, port)
+
+    server_thread = threading.Thread(target=httpd.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    results = []
+    uploaders = [
+        threading.Thread(
+            target=self._Upload, args=(base_url, upload_size, results))
+        for _ in range(self.CONCURRENT_UPLOADS)
+    ]
+    start = time.time()
+    for uploader in uploaders:
+      uploader.start()
+    for uploader in uploaders:
+      uploader.join()
+    duration = time.time() - start
+    httpd.shutdown()
+
+    self.assertEqual(results,
+                     [(200, str(upload_size))] * self.CONCURRENT_UPLOADS)
+    total_mb = upload_size * self.CONCURRENT_UPLOADS / 1024.0 / 1024.0
+    self.AddResult("%s, %d x %d MB" % (name, self.CONCURRENT_UPLOADS,
+                                       upload_size // 1024 // 1024), duration,
+                   self.CONCURRENT_UPLOADS, "%.1f" % (total_mb / duration))
+
+  @test_lib.SetLabel("benchmark")
+  def testUploads(self):
+    ip = utils.ResolveHostnameToIP("localhost", 0)
+
+    def ThreadingServer():
+      return frontend.GRRHTTPServer(
+          (ip, portpicker.PickUnusedPort()),
+          frontend.GRRHTTPServerHandler,
+          frontend=_DrainingFrontend())
+
+    def EventLoopServer():
+      return frontend.GRRAsyncHTTPServer(
+          (ip, portpicker.PickUnusedPort()),
+          frontend=_DrainingFrontend(),
+          worker_threads=self.WORKER_THREADS)
+
+    for upload_size in self.UPLOAD_SIZES:
+      self._RunUploads("threading", ThreadingServer, upload_size)
+      self._RunUploads("event_loop", EventLoopServer, upload_size)
+
+
 def main(args):
   test_lib.main(args)
 
@@ -216,7 +216,7 @@ class ShardedQueueManager(queue_manager.QueueManager):
   at its own shard. This class gives the worker visibility across all shards.
   """
 
-  def GetNotificationsByPriority(self, queue):
+  def GetNotificationsByPriority(self, queue, extra_queue_shards=None):
     return self.GetNotificationsByPriorityForAllShards(queue)
 
   def GetNotifications(self, queue):
@@ -237,6 +237,7 @@ class GrrWorkerTest(flow_test_lib.FlowTestsBaseclass):
     del RESULTS[:]
 
   def tearDown(self):
+    front_end.StopClientHeartbeatBuffer()
     super(GrrWorkerTest, self).tearDown()
     self.patch_get_notifications.stop()
 
@@ -342,6 +343,29 @@ class GrrWorkerTest(flow_test_lib.FlowTestsBaseclass):
         flow_obj.context.state == rdf_flows.FlowContext.State.TERMINATED)
     self.assertEqual(flow_obj.context.current_state, "End")
 
+  def testNotificationsWakeUpWorker(self):
+    worker_obj = worker.GRRWorker(token=self.token)
+    subscription = worker_obj.notification_subscription
+    self.assertFalse(subscription.Wait(0))
+
+    session_id = rdfvalue.SessionID(queue=queues.FLOWS, flow_name="123456")
+    manager = queue_manager.QueueManager(token=self.token)
+    with data_store.DB.GetMutationPool() as pool:
+      manager.NotifyQueue(
+          rdf_flows.GrrNotification(session_id=session_id), mutation_pool=pool)
+
+      # Workers are not woken up before the notification is written.
+      self.assertFalse(subscription.Wait(0))
+
+    self.assertTrue(subscription.Wait(0))
+    queue_shards = subscription.PopQueueShards(queues.FLOWS)
+    self.assertEqual(len(queue_shards), 1)
+    self.assertFalse(subscription.Wait(0))
+
+    notifications = data_store.DB.GetNotifications(
+        queue_shards.pop(), rdfvalue.RDFDatetime.Now())
+    self.assertEqual([n.session_id for n in notifications], [session_id])
+
   def testNoNotificationRescheduling(self):
     """Test that no notifications are rescheduled when a flow raises."""
 